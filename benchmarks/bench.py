@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+'''Throughput and latency of calls on localhost.
+
+Runs an echo server in a child process for each transport and server kind,
+then calls it from client threads for each payload size and concurrency,
+the payload going both ways. Writes the results as JSON, see `--out`, and
+compares them to those of an earlier run with `--compare`.
+
+    benchmarks/bench.py --quick --out before.json
+    benchmarks/bench.py --quick --out after.json --compare before.json
+
+`--protocols 7,8` runs each case with clients of each protocol version, e.g.
+calls naming their method (7) against calls sending its id (8), and
+`--codecs pickle,marshal,json` with clients of each codec (json payloads are
+str, the others bytes).
+'''
+import multiprocessing
+import subprocess
+import itertools
+import threading
+import argparse
+import platform
+import tempfile
+import shutil
+import socket
+import json
+import time
+import sys
+import os
+
+sys.path.append(os.path.abspath(__file__+'/../..'))
+
+from pyrpc import Client, Server
+
+TRANSPORTS = ('tcp', 'unix')
+SERVERS = ('sync', 'threaded', 'nonblocking', 'asyncio')
+SIZES = (10, 1000, 10**5, 10**7, 10**9)
+CONCURRENCY = (1, 10, 100, 1000)
+QUICK = {
+    'servers': ('sync', 'threaded', 'nonblocking'),
+    'sizes': (10, 10**4, 10**6),
+    'concurrency': (1, 16),
+    'duration': 0.5,
+}
+
+
+class EchoServer(Server):
+    def echo(self, payload):
+        return payload
+
+
+def serve(kind, address):
+    kwargs = {
+        'sync': {'synchronous': True},
+        'threaded': {},
+        'nonblocking': {'nonblocking': True},
+        'asyncio': {'engine': 'asyncio'},
+    }[kind]
+    EchoServer(address=address, **kwargs).start()
+
+
+def start_server(kind, transport, tmpdir):
+    if transport == 'unix':
+        address = os.path.join(tmpdir, kind)
+    else:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            address = sock.getsockname()
+    process = multiprocessing.get_context('fork').Process(
+        target=serve, args=(kind, address), daemon=True
+    )
+    process.start()
+    client = Client(address=address)
+    for i in range(100):
+        if client.connected(timeout=1):
+            return process, address
+        time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('{} server on {} did not start'.format(kind, transport))
+
+
+def run_case(address, kind, size, concurrency, duration, timeout,
+             protocol=Client.protocol, codec=Client.codec):
+    '''Calls the server from `concurrency` threads for `duration` seconds,
+    at least once from each.'''
+    client = Client(
+        address=address, call_timeout=timeout, protocol=protocol, codec=codec
+    )
+    method_name = 'nb_echo' if kind == 'nonblocking' else 'echo'
+    payload = 'x' * size if codec == 'json' else b'x' * size
+    latencies = []
+    errors = []
+    barrier = threading.Barrier(concurrency+1)
+    def work():
+        own = []
+        barrier.wait()
+        due_time = time.perf_counter() + duration
+        while True:
+            start = time.perf_counter()
+            try:
+                ret = getattr(client, method_name)(payload)
+                if len(ret) != size:
+                    raise ValueError('echoed {} bytes'.format(len(ret)))
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                own.append(time.perf_counter()-start)
+            if time.perf_counter() >= due_time:
+                break
+        latencies.extend(own)
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    calls = len(latencies)
+    return {
+        'calls': calls,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': elapsed,
+        'calls_per_second': calls / elapsed,
+        'mb_per_second': 2 * calls * size / elapsed / 1e6,
+        'latency_mean': sum(latencies) / calls if calls else None,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p90': percentile(latencies, 0.9),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_p999': percentile(latencies, 0.999),
+        'latency_max': latencies[-1] if calls else None,
+    }
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    i = min(int(q * len(sorted_values)), len(sorted_values)-1)
+    return sorted_values[i]
+
+
+def case_key(result):
+    key = '{transport}/{server}/{size}/{concurrency}'.format(**result)
+    # the cases of the defaults keep the keys of earlier runs
+    if result.get('protocol', Client.protocol) != Client.protocol:
+        key += '/p{}'.format(result['protocol'])
+    if result.get('codec', Client.codec) != Client.codec:
+        key += '/{}'.format(result['codec'])
+    return key
+
+
+def compare(results, path, threshold):
+    '''Prints the cases slower than in the results at `path` by more than
+    `threshold` (a fraction), returns how many there are.'''
+    with open(path) as f:
+        old = {case_key(r): r for r in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        before = old.get(case_key(result))
+        if not before or not before['calls'] or not result['calls']:
+            continue
+        ratio = result['calls_per_second'] / before['calls_per_second']
+        p99 = result['latency_p99'] / before['latency_p99']
+        slower = ratio < 1-threshold or p99 > 1+threshold
+        regressions += slower
+        print('{:<36} calls/s x{:.2f} p99 x{:.2f}{}'.format(
+            case_key(result), ratio, p99, '  REGRESSION' if slower else ''
+        ))
+    return regressions
+
+
+def meta(args):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode().strip()
+    except Exception:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+    }
+
+
+def numbers(text):
+    return tuple(int(float(x)) for x in text.split(','))
+
+
+def names(text):
+    return tuple(text.split(','))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--transports', type=names, default=TRANSPORTS)
+    parser.add_argument('--servers', type=names, default=SERVERS,
+                        help='of ' + ','.join(SERVERS))
+    parser.add_argument('--sizes', type=numbers, default=SIZES,
+                        help='payload bytes, e.g. 10,1e6')
+    parser.add_argument('--concurrency', type=numbers, default=CONCURRENCY,
+                        help='client threads')
+    parser.add_argument('--protocols', type=numbers,
+                        default=(Client.protocol,),
+                        help='protocol versions of the clients, e.g. 7,8')
+    parser.add_argument('--codecs', type=names, default=(Client.codec,),
+                        help='codecs of the calls, e.g. pickle,marshal,json')
+    parser.add_argument('--duration', type=float, default=2,
+                        help='seconds per case')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='call_timeout')
+    parser.add_argument('--max-bytes', type=float, default=2**31,
+                        help='skip cases with more payload bytes in flight')
+    parser.add_argument('--quick', action='store_true',
+                        help='a smaller matrix, for a run of a minute')
+    parser.add_argument('--out', help='JSON file of the results, - stdout')
+    parser.add_argument('--compare', help='JSON file of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression')
+    args = parser.parse_args()
+    if args.quick:
+        for name, value in QUICK.items():
+            if getattr(args, name) == parser.get_default(name):
+                setattr(args, name, value)
+    return args
+
+
+def main():
+    args = parse_args()
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='pyrpc_bench_')
+    for transport in args.transports:
+        for kind in args.servers:
+            process, address = start_server(kind, transport, tmpdir)
+            try:
+                for size, concurrency, protocol, codec in itertools.product(
+                    args.sizes, args.concurrency, args.protocols, args.codecs
+                ):
+                    if size * concurrency > args.max_bytes:
+                        continue
+                    result = {
+                        'transport': transport,
+                        'server': kind,
+                        'size': size,
+                        'concurrency': concurrency,
+                        'protocol': protocol,
+                        'codec': codec,
+                    }
+                    result.update(run_case(
+                        address, kind, size, concurrency,
+                        args.duration, args.timeout, protocol, codec,
+                    ))
+                    results.append(result)
+                    print(
+                        '{:<36} {:>10.1f} calls/s {:>9.1f} MB/s '
+                        'p50 {:>9.1f} us p99 {:>9.1f} us errors {}'.format(
+                            case_key(result),
+                            result['calls_per_second'],
+                            result['mb_per_second'],
+                            (result['latency_p50'] or 0) * 1e6,
+                            (result['latency_p99'] or 0) * 1e6,
+                            result['errors'],
+                        ),
+                        file=sys.stderr,
+                    )
+            finally:
+                process.kill()
+                process.join()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    report = {'meta': meta(args), 'results': results}
+    if args.out == '-':
+        json.dump(report, sys.stdout, indent=1)
+    elif args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,8 +8,14 @@ net.core.optmem_max=25165824
 
 $ sudo sysctl -p # to apply
 '''
-from .ut import NoSocket, ProtocolError, Timeout
+from .ut import NoSocket, ProtocolError, Timeout, Overloaded, UnknownJob
+from .ut import Expired, Cancelled
+from .context import current_call
 from .nbrelay import NbRelay
 from .server import Server
 from .client import Client
 from .relay import Relay
+from .corelay import Corelay
+from .streamrelay import StreamRelay
+from .batch import Batch
+from .stub import Stub
@@ -0,0 +1,601 @@
+import traceback
+import threading
+import asyncio
+import inspect
+import pickle
+import socket
+import time
+
+from .handler import (
+    _call, _exception, _fetch_result, _run_nonblocking, _batch_calls,
+    _send_batch, _store, _put_reply, _complete, _wait_time, _when_ready,
+    _forget_callback, _decode, _cached, _coalesced, _Encoded, _join_job,
+    _measured, _method, _deadline, _expired, _expired_output, _priority,
+    _cancel, _cancelled_output, _method_names, _encode,
+)
+from . import context as contextmod
+from . import protocol
+from . import codec as codecmod
+from . import compression
+from . import ut
+
+
+class AioServer:
+    '''Serves all connections on one asyncio event loop.
+
+    `async def` methods are awaited on the loop, plain methods run in the
+    server's worker pool (inline with `Server.synchronous`). Both protocols
+    are served, the same way as `Handler` and `NbHandler` do. Streamed calls
+    iterate over async generators on the loop and take each item of other
+    iterables in the worker pool. Over the multiplexed protocol, the results
+    and items taken in the worker pool are encoded (and compressed) there
+    too, large buffers returned by `async def` methods in the default
+    executor.
+
+    Mimics the part of the socketserver interface `Server` uses.
+    '''
+    def __init__(self, parent, address):
+        self.parent = parent
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(4096)
+        self._loop = None
+        self._stop = None
+        self._stopped = threading.Event()
+        self._writer_task = {}
+        self._tasks = set()
+
+    def serve_forever(self):
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._stop.set)
+            self._stopped.wait()
+
+    def close_connections(self):
+        pass # done by the loop on the way out
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        if self.socket.family == socket.AF_UNIX:
+            server = await asyncio.start_unix_server(
+                self._handle, sock=self.socket, limit=2**20
+            )
+        else:
+            server = await asyncio.start_server(
+                self._handle, sock=self.socket, limit=2**20
+            )
+        await self._stop.wait()
+        server.close()
+        handlers = list(self._writer_task.values())
+        for writer in list(self._writer_task):
+            writer.close()
+        if handlers:
+            await asyncio.wait(handlers, timeout=1)
+
+    async def _handle(self, reader, writer):
+        self._writer_task[writer] = asyncio.current_task()
+        try:
+            while True:
+                header = await self._read_idle(reader, 4)
+                if header == protocol.HANDSHAKE:
+                    await self._handle_mux(reader, writer)
+                    return
+                body = await reader.readexactly(int.from_bytes(header, 'big'))
+                send = lambda output: _write_frame(writer, output)
+                if not await self._dispatch([body], send, flow=writer):
+                    return
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError,
+                ut.ProtocolError):
+            pass
+        finally:
+            self._writer_task.pop(writer, None)
+            writer.close()
+
+    async def _handle_mux(self, reader, writer):
+        version = min((await reader.readexactly(1))[0], protocol.VERSION)
+        if version == 3:
+            # asyncio streams can't receive file descriptors
+            version = 2
+        if version >= 4:
+            reply = protocol.HANDSHAKE + bytes([version, 0])
+            if version >= 8:
+                reply += protocol.pack_methods(_method_names(self.parent))
+            writer.write(reply)
+            await reader.readexactly(1) # no shared memory frames sent either
+        else:
+            writer.write(protocol.HANDSHAKE + bytes([version]))
+        if version < 2:
+            return
+        # not done by asyncio for a listening socket made with proto 0
+        protocol.nodelay(writer.get_extra_info('socket'))
+        default_compressor = None
+        if version >= 5:
+            default_compressor = compression.get(self.parent.compression)
+        tasks = set()
+        id_stream = {}
+        try:
+            while True:
+                if tasks:
+                    header = await reader.readexactly(protocol.HEADER.size)
+                else:
+                    header = await self._read_idle(
+                        reader, protocol.HEADER.size
+                    )
+                id_, kind, flags, nbytes = protocol.HEADER.unpack(header)
+                body = await protocol.read_body_async(reader, flags, nbytes)
+                stream = id_stream.get(id_)
+                if kind == protocol.CREDIT:
+                    if stream is not None:
+                        stream.grant(int.from_bytes(body[0], 'big'))
+                    continue
+                if kind == protocol.CANCEL:
+                    if stream is not None:
+                        stream.cancel()
+                    continue
+                if kind != protocol.REQUEST:
+                    return
+                codec = codecmod.PICKLE
+                if version >= 4:
+                    codec = codecmod.from_flags(flags)
+                compressor = default_compressor
+                if flags & protocol.COMPRESSED:
+                    try:
+                        compressor, body = protocol.decompress(
+                            body, flags, self.parent.max_decompressed
+                        )
+                    except ut.ProtocolError as e:
+                        e.traceback = ''
+                        _write_mux_frame(writer, id_, (None, e), codec=codec)
+                        continue
+                if flags & protocol.STREAM:
+                    stream = id_stream[id_] = _Stream(
+                        writer, id_, codec, compressor,
+                        self.parent.keepalive_timeout,
+                    )
+                task = asyncio.ensure_future(self._serve_request(
+                    writer, id_, body, stream, codec, compressor
+                ))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                if stream is not None:
+                    task.add_done_callback(
+                        lambda _, id_=id_: id_stream.pop(id_, None)
+                    )
+        finally:
+            for stream in id_stream.values():
+                stream.cancel()
+
+    async def _serve_request(self, writer, id_, body, stream=None,
+                             codec=codecmod.PICKLE, compressor=None):
+        sent = []
+        threshold = self.parent.compress_threshold
+        def send(output):
+            sent.append(True)
+            return _write_mux_frame(
+                writer, id_, output, codec=codec, compressor=compressor,
+                threshold=threshold,
+            )
+        def encode(output):
+            return _encode_frame(output, codec, compressor, threshold)
+        try:
+            await self._dispatch(body, send, stream, codec, writer, encode)
+        except Exception as e:
+            if sent:
+                raise
+            send((None, _exception(self.parent, e)))
+        try:
+            await writer.drain()
+        except OSError:
+            pass
+
+    async def _read_idle(self, reader, n):
+        return await asyncio.wait_for(
+            reader.readexactly(n), self.parent.keepalive_timeout
+        )
+
+    async def _dispatch(self, body, send, stream=None, codec=codecmod.PICKLE,
+                        flow=None, encode=None):
+        '''`flow`, the writer of the connection, takes turns with the other
+        ones at the workers. `encode(output)`, the output as `_Encoded`, is
+        done off the loop where the call runs off it.'''
+        start = time.perf_counter()
+        try:
+            data = _decode(self.parent, codec, body)
+            calls = _batch_calls(data)
+            deadline = priority = None
+            if calls is not None or isinstance(data, tuple):
+                deadline = _deadline(data)
+                priority = _priority(data)
+        except ut.ProtocolError as e:
+            e.traceback = ''
+            send((None, e))
+            return False
+        except Exception:
+            send((None, Exception('read_error')))
+            return False
+        if self.parent._metrics is not None:
+            send = _measured(self.parent, data, body, start, send)
+        if calls is not None:
+            if data.get('parallel') and not self.parent.synchronous:
+                results = await asyncio.gather(*(
+                    self._call(*call, True, deadline, priority, flow)
+                    for call in calls
+                ))
+            else:
+                results = [
+                    await self._call(*call, True, deadline, priority, flow)
+                    for call in calls
+                ]
+            _send_batch(self.parent, calls, list(results), send)
+        elif isinstance(data, tuple):
+            method_name, args, kwargs, *_ = data
+            if stream is None:
+                send = _cached(
+                    self.parent, codec, method_name, args, kwargs, send
+                )
+                if send is not None:
+                    send = _coalesced(
+                        self.parent, codec, method_name, args, kwargs, send
+                    )
+                if send is None:
+                    return True
+            output = await self._call(
+                method_name, args, kwargs, stream is None, deadline, priority,
+                flow, encode=encode if stream is None else None,
+            )
+            ret, exc = output.output if type(output) is _Encoded else output
+            if stream is not None and exc is None:
+                output = ret, exc = await stream.run(self, ret)
+            elif exc is None and _expired(deadline):
+                # nobody reads the result, it is not worth sending
+                output = ret, exc = _expired_output(
+                    'deadline passed while the call ran'
+                )
+            try:
+                send(output)
+            finally:
+                if exc is not None:
+                    self.parent.log_exception(exc, method_name, args, kwargs)
+                else:
+                    self.parent.log_call(ret, method_name, args, kwargs)
+        elif isinstance(data, dict) and self.parent.nonblocking:
+            if data['predicate'] == 'cancel':
+                send(await self._forwarding(_cancel, self.parent, data))
+            elif data['predicate'] == 'put':
+                _store(self.parent, data)
+                send(self._put(data, flow))
+            else: # get
+                send(await self._get(data))
+        else:
+            send((None, Exception('protocol_error')))
+            return False
+        return True
+
+    def _put(self, request, flow=None):
+        method = getattr(self.parent.callee, request['method_name'], None)
+        try:
+            if _join_job(self.parent, request):
+                pass
+            elif inspect.iscoroutinefunction(method):
+                task = asyncio.ensure_future(self._await_nonblocking(request))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            else:
+                self.parent._workers.submit(
+                    _run_nonblocking, self.parent, request,
+                    key=request['method_name'],
+                    priority=_priority(request), flow=flow,
+                )
+        except ut.Overloaded as e:
+            e.traceback = ''
+            _complete(self.parent, request, None, e)
+            return None, e
+        return _put_reply(self.parent)
+
+    async def _get(self, data):
+        parent = self.parent
+        wait = _wait_time(parent, data)
+        if wait:
+            future = self._loop.create_future()
+            def callback():
+                _set_result_threadsafe(self._loop, future, None)
+            if _when_ready(parent, data, callback):
+                try:
+                    await asyncio.wait_for(future, wait)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    _forget_callback(parent, data, callback)
+        return await self._forwarding(_fetch_result, parent, data)
+
+    async def _forwarding(self, func, *args):
+        '''Returns func(*args), run off the loop if it may forward the
+        request to another worker (and wait for its answer).'''
+        if self.parent._prefork is None:
+            return func(*args)
+        return await self._loop.run_in_executor(None, func, *args)
+
+    async def _await_nonblocking(self, request):
+        ret, exc = await self._call(
+            request['method_name'], request['args'], request['kwargs'],
+            job=request,
+        )
+        _complete(self.parent, request, ret, exc)
+
+    async def _call(self, method_name, args, kwargs, materialize=True,
+                    deadline=None, priority=None, flow=None, job=None,
+                    encode=None):
+        '''Returns (ret, exc), or `encode(...)` of it if given and done off
+        the loop.'''
+        parent = self.parent
+        try:
+            method = _method(parent, method_name)
+        except Exception as e:
+            return None, _exception(parent, e)
+        if not inspect.iscoroutinefunction(method):
+            if parent.synchronous:
+                return _call(
+                    parent, method_name, args, kwargs, materialize, deadline,
+                    job,
+                )
+            try:
+                future = self._in_worker(
+                    method_name, _call,
+                    parent, method_name, args, kwargs, materialize, deadline,
+                    job, priority=priority, flow=flow, encode=encode,
+                )
+            except ut.Overloaded as e:
+                e.traceback = ''
+                return None, e
+            return await future
+        if _expired(deadline):
+            return _expired_output('deadline passed before the call ran')
+        if job is not None and job.get('cancelled'):
+            return _cancelled_output()
+        try:
+            parent._workers.enter(method_name)
+        except ut.Overloaded as e:
+            e.traceback = ''
+            return None, e
+        token = None
+        if deadline is not None or job is not None:
+            token = contextmod.enter(deadline, job)
+        start = time.perf_counter()
+        ret, exc = None, None
+        try:
+            ret = await method(*args, **kwargs)
+        except Exception as e:
+            exc = _exception(parent, e)
+        finally:
+            parent._workers.leave(method_name)
+            if token is not None:
+                contextmod.leave(token)
+        if parent._metrics is not None:
+            parent._metrics.add(
+                method_name, 'execute', time.perf_counter()-start,
+                exc is not None,
+            )
+        if encode is not None and _large(ret, parent.compress_threshold):
+            return await self._loop.run_in_executor(None, encode, (ret, exc))
+        return ret, exc
+
+    def _in_worker(self, key, func, *args, priority=None, flow=None,
+                   encode=None):
+        '''Returns a future of func(*args), or of encode(func(*args)), run in
+        the worker pool. Neither must raise.'''
+        future = self._loop.create_future()
+        def job():
+            output = func(*args)
+            if encode is not None:
+                output = encode(output)
+            _set_result_threadsafe(self._loop, future, output)
+        self.parent._workers.submit(
+            job, key=key, priority=priority, flow=flow
+        )
+        return future
+
+
+class _Stream:
+    '''The server side of a streamed call, see `handler._Stream`.'''
+    def __init__(self, writer, id_, codec=codecmod.PICKLE, compressor=None,
+                 timeout=None):
+        self._writer = writer
+        self._id = id_
+        self._codec = codec
+        self._compressor = compressor
+        self._timeout = timeout
+        self._credit = 0
+        self._cancelled = False
+        self._event = asyncio.Event()
+
+    def grant(self, n):
+        self._credit += n
+        self._event.set()
+
+    def cancel(self):
+        self._cancelled = True
+        self._event.set()
+
+    async def run(self, server, result):
+        parent = server.parent
+        def encode(item):
+            return _encode_frame(
+                item, self._codec, self._compressor, parent.compress_threshold
+            )
+        items = None
+        try:
+            if hasattr(result, '__aiter__'):
+                items = result.__aiter__()
+            else:
+                items = iter(result)
+            while True:
+                n = await self._acquire()
+                if not n:
+                    break
+                if hasattr(items, '__anext__'):
+                    batch, exc = [], None
+                    try:
+                        for _ in range(n):
+                            batch.append(await items.__anext__())
+                    except StopAsyncIteration:
+                        batch.append(_END)
+                    except Exception as e:
+                        exc = _exception(parent, e)
+                elif parent.synchronous:
+                    batch, exc = _next_items(parent, items, n)
+                else:
+                    # the items granted at once in one trip to a worker
+                    batch, exc = await server._in_worker(
+                        None, _next_items, parent, items, n, encode
+                    )
+                for item in batch:
+                    if item is _END:
+                        return None, None
+                    _write_mux_frame(
+                        self._writer, self._id, item, protocol.ITEM,
+                        self._codec, self._compressor,
+                        parent.compress_threshold,
+                    )
+                if exc is not None:
+                    return None, exc
+                await self._writer.drain()
+        except ut.Overloaded as e:
+            e.traceback = ''
+            return None, e
+        except Exception as e:
+            return None, _exception(parent, e)
+        finally:
+            if hasattr(items, 'aclose'):
+                await items.aclose()
+            elif hasattr(items, 'close'):
+                items.close()
+        return None, None
+
+    async def _acquire(self):
+        '''Returns the number of items granted, 0 if cancelled.'''
+        while not self._credit and not self._cancelled:
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), self._timeout)
+            except asyncio.TimeoutError:
+                raise ut.Timeout(
+                    'no item taken for {} s'.format(self._timeout)
+                ) from None
+        if self._cancelled:
+            return 0
+        n, self._credit = self._credit, 0
+        return n
+
+
+def _next_items(parent, items, n, encode=None):
+    '''Returns (up to n items, exc), _END follows the last item. The items
+    are given to `encode` if given.'''
+    batch = []
+    try:
+        for _ in range(n):
+            item = next(items)
+            batch.append(item if encode is None else encode(item))
+    except StopIteration:
+        batch.append(_END)
+    except Exception as e:
+        return batch, _exception(parent, e)
+    return batch, None
+
+
+_END = object()
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_result_threadsafe(loop, future, result):
+    '''Sets the result from another thread, dropped if the loop is closed
+    (the server shut down meanwhile).'''
+    if loop.is_closed():
+        return
+    try:
+        loop.call_soon_threadsafe(_set_result, future, result)
+    except RuntimeError:
+        if not loop.is_closed():
+            raise
+
+
+def _large(obj, nbytes):
+    '''Whether obj is a str or buffer of `nbytes` at least.'''
+    if isinstance(obj, str):
+        return len(obj) >= nbytes
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return memoryview(obj).nbytes >= nbytes
+    return False
+
+
+def _encode_frame(output, codec, compressor, threshold):
+    '''Returns the output as `_Encoded` with the frame it is sent in, as it
+    is if the codec fails on it.'''
+    output = _encode(codec, output)
+    if type(output) is _Encoded and output.frame is None:
+        parts, flags = output.parts, codec.flags
+        if compressor is not None:
+            parts, flags = protocol.compress(
+                parts, compressor, threshold, flags
+            )
+        output.frame = compressor, parts, flags
+    return output
+
+
+def _write_frame(writer, output):
+    if type(output) is _Encoded:
+        output = output.output
+    try:
+        msg = pickle.dumps(output)
+    except Exception as e:
+        e.traceback = traceback.format_exc()
+        msg = pickle.dumps((None, e))
+    writer.write(len(msg).to_bytes(4, 'big') + msg)
+    return 4 + len(msg)
+
+
+def _write_mux_frame(writer, id_, output, kind=protocol.RESPONSE,
+                     codec=codecmod.PICKLE, compressor=None, threshold=0):
+    frame = output.frame if type(output) is _Encoded else None
+    if frame is not None and frame[0] is compressor:
+        _, parts, flags = frame
+    else:
+        parts, flags = _frame_parts(output, kind, codec, compressor, threshold)
+    nbytes = 0
+    for buf in protocol.pack(id_, kind, parts, flags):
+        writer.write(buf)
+        nbytes += memoryview(buf).nbytes
+    return nbytes
+
+
+def _frame_parts(output, kind, codec, compressor, threshold):
+    try:
+        if type(output) is _Encoded:
+            parts = output.parts
+        else:
+            parts = codec.dumps(output)
+    except Exception as e:
+        if kind != protocol.RESPONSE:
+            raise
+        e.traceback = traceback.format_exc()
+        parts = codec.dumps((None, e))
+    flags = codec.flags
+    if compressor is not None:
+        parts, flags = protocol.compress(parts, compressor, threshold, flags)
+    return parts, flags
@@ -0,0 +1,103 @@
+import threading
+import weakref
+import random
+import time
+import os
+
+
+class Balancer:
+    '''Spreads the calls of a client over the replicas at its addresses.
+
+    `policy` is 'least_outstanding', the address with the fewest calls in
+    progress, or 'p2c', the one with fewer of two picked at random. An
+    address that can't be connected to is ejected until a `connected()`
+    probe of it passes, every `interval` seconds. With all of them ejected,
+    calls go to all of them.
+    '''
+    def __init__(self, addresses, policy='least_outstanding'):
+        if policy not in ('least_outstanding', 'p2c'):
+            raise ValueError('unknown balance policy {!r}'.format(policy))
+        self.addresses = list(addresses)
+        self.policy = policy
+        self._outstanding = {address: 0 for address in self.addresses}
+        self._ejected = set()
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def pick(self, exclude=()):
+        '''Returns the address for a call, not any of `exclude`.'''
+        with self._lock:
+            return self._pick(exclude)
+
+    def acquire(self, exclude=()):
+        '''Returns the address for a call, counted in progress until
+        `release()`.'''
+        with self._lock:
+            address = self._pick(exclude)
+            self._outstanding[address] += 1
+            return address
+
+    def release(self, address):
+        with self._lock:
+            self._outstanding[address] -= 1
+
+    def eject(self, address):
+        with self._lock:
+            self._ejected.add(address)
+
+    def admit(self, address):
+        with self._lock:
+            self._ejected.discard(address)
+
+    def healthy(self):
+        '''Returns the addresses not ejected.'''
+        with self._lock:
+            return [a for a in self.addresses if a not in self._ejected]
+
+    def outstanding(self):
+        '''Returns {address: calls in progress}.'''
+        with self._lock:
+            return dict(self._outstanding)
+
+    def _pick(self, exclude):
+        candidates = [
+            a for a in self.addresses
+            if a not in self._ejected and a not in exclude
+        ] or [a for a in self.addresses if a not in exclude] or self.addresses
+        if len(candidates) == 1:
+            return candidates[0]
+        outstanding = self._outstanding
+        if self.policy == 'p2c':
+            a, b = random.sample(candidates, 2)
+            return a if outstanding[a] <= outstanding[b] else b
+        # rotating the start breaks ties evenly
+        self._next = (self._next+1) % len(candidates)
+        best = None
+        for i in range(len(candidates)):
+            address = candidates[(self._next+i) % len(candidates)]
+            if best is None or outstanding[address] < outstanding[best]:
+                best = address
+        return best
+
+
+def start_probes(client, interval, timeout):
+    '''Probes the addresses of the client with `connected()` every `interval`
+    seconds in a daemon thread, as long as the client is referenced.'''
+    ref = weakref.ref(client)
+    pid = os.getpid()
+    def run():
+        while True:
+            time.sleep(interval)
+            client = ref()
+            if client is None or client._pid != pid:
+                return
+            balancer = client._balancer
+            for address in balancer.addresses:
+                if client._probe(address, timeout):
+                    balancer.admit(address)
+                else:
+                    balancer.eject(address)
+            client = None
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,80 @@
+from concurrent.futures import Future
+
+from .relay import Relay
+
+
+class Batch:
+    '''`with client.batch() as b:` queues the calls made on `b` and sends
+    them in one request when the block ends. Each call returns a
+    `concurrent.futures.Future` of its result, done once the batch is sent.
+
+    The server runs the calls one after another or, with `parallel`, all at
+    once in its worker pool. Each call succeeds or fails on its own, a
+    failure of the whole request (connect, timeout...) is raised by `send()`
+    and set on all the futures. Call keyword arguments go to the methods
+    as they are, special ones (`call_timeout`...) are given to `batch()`.
+    '''
+    def __init__(self, client, parallel=False, **kwargs):
+        self._client = client
+        self._parallel = parallel
+        self._kwargs = kwargs
+        self._calls = []
+
+    def __getattr__(self, method_name):
+        if method_name.startswith('_'):
+            raise AttributeError(method_name)
+        def queue_call(*args, **kwargs):
+            future = Future()
+            self._calls.append(((method_name, args, kwargs), future))
+            return future
+        return queue_call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+        else:
+            for callmsg, future in self._calls:
+                future.cancel()
+            self._calls = []
+
+    def send(self):
+        '''Sends the calls queued so far.'''
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+        relay = Relay(self._client, 'batch')
+        relay._consume_kwargs(dict(self._kwargs))
+        request = {
+            'predicate': 'batch',
+            'calls': [callmsg for callmsg, future in calls],
+            'parallel': self._parallel,
+        }
+        metrics = self._client._metrics
+        if metrics is not None:
+            metrics.begin('batch')
+        try:
+            results, exc = relay._make_balanced_call(request)
+        except Exception as e:
+            results, exc = None, e
+        if metrics is not None:
+            relay._record(metrics, exc)
+        if exc is not None:
+            if not hasattr(exc, 'traceback'):
+                exc.traceback = ''
+            for callmsg, future in calls:
+                future.set_exception(exc)
+            self._client._handle_exception(('batch', (), {}), exc)
+            return
+        for (callmsg, future), (ret, exc) in zip(calls, results):
+            if exc is None:
+                self._client.log_call(callmsg, ret)
+                future.set_result(ret)
+                continue
+            try:
+                self._client._handle_exception(callmsg, exc)
+            except BaseException as e:
+                exc = e
+            future.set_exception(exc)
@@ -0,0 +1,155 @@
+import collections
+import threading
+import time
+
+
+class ResultCache:
+    '''The encoded responses of cached methods by method name, arguments
+    and codec, so a repeated call runs neither the method nor the codec.
+
+    `method_ttl` is {method_name: seconds an entry is used, None - until
+    evicted}. The least recently used entries are evicted beyond
+    `max_entries` entries or `max_bytes` bytes of responses (None - no
+    limit). Arguments are compared by type and value, lists and dicts in
+    them too, calls with other arguments that can't be hashed are not
+    cached. Failed calls
+    are not cached either.
+    '''
+    def __init__(self, method_ttl, max_entries=1024, max_bytes=None):
+        self.method_ttl = method_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, codec, method_name, args, kwargs):
+        '''Returns the key of a call, None if it is not cached.'''
+        if method_name not in self.method_ttl:
+            return None
+        return call_key(method_name, args, kwargs, codec)
+
+    def get(self, key):
+        '''Returns the (ret, parts) of the call, None on a miss.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] is not None and \
+                    entry[3] <= time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, ret, parts):
+        '''Keeps the result of the call and its encoded response.'''
+        nbytes = sum(memoryview(buf).nbytes for buf in parts)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        ttl = self.method_ttl[key[0]]
+        due_time = None if ttl is None else time.time()+ttl
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = ret, parts, nbytes, due_time
+            self.nbytes += nbytes
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.nbytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, method_name=None, args=None, kwargs=None):
+        '''Drops the entries of a call, of all the calls of a method or, with
+        no `method_name`, all of them.'''
+        call = None if args is None else _frozen(args, kwargs or {})
+        with self._lock:
+            for key in list(self._entries):
+                if method_name is None or key[0] == method_name and (
+                    call is None or key[1:3] == call
+                ):
+                    self._drop(key)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+        }
+
+    def _drop(self, key):
+        self.nbytes -= self._entries.pop(key)[2]
+
+
+class Flights:
+    '''Calls in progress by key, so that calls equal to one in progress wait
+    for its outcome instead of running too.'''
+    def __init__(self):
+        self._key_waiters = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._key_waiters)
+
+    def join(self, key, waiter):
+        '''Returns True for the first call of the key, which runs. Otherwise
+        keeps the `waiter` of the call until the first one lands.'''
+        with self._lock:
+            waiters = self._key_waiters.get(key)
+            if waiters is None:
+                self._key_waiters[key] = []
+                return True
+            waiters.append(waiter)
+            return False
+
+    def waiting(self, key):
+        '''Returns how many calls wait for the one of the key.'''
+        with self._lock:
+            return len(self._key_waiters.get(key, ()))
+
+    def land(self, key):
+        '''Returns the waiters of the calls of the key, once it is done.'''
+        with self._lock:
+            return self._key_waiters.pop(key, [])
+
+
+def call_key(method_name, args, kwargs, codec=None):
+    '''Returns a key telling equal calls (and codecs) apart, None if the
+    arguments can't be hashed.'''
+    try:
+        key = (method_name,) + _frozen(args, kwargs) + (
+            None if codec is None else codec.id,
+        )
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _frozen(args, kwargs):
+    '''Returns the args and kwargs of a call as hashable values, raises
+    TypeError if they can't be.'''
+    return tuple(map(_freeze, args)), _freeze(kwargs) if kwargs else ()
+
+
+def _freeze(obj):
+    '''Returns the value with its type: 1, True and 1.0 are equal, the
+    results of calls with them need not be.'''
+    t = type(obj)
+    if t is list or t is tuple:
+        return t, tuple(map(_freeze, obj))
+    if t is dict:
+        return t, frozenset(
+            (_freeze(k), _freeze(v)) for k, v in obj.items()
+        )
+    if t is set or t is frozenset:
+        return t, frozenset(map(_freeze, obj))
+    return t, obj
@@ -1,11 +1,27 @@
+import threading
+import weakref
+import random
 import time
+import os
 
-from .nbrelay import NbRelay
+from .corelay import Corelay
+from .nbrelay import NbRelay, Subscriber
+from .streamrelay import StreamRelay
+from .batch import Batch
 from .relay import Relay
+from .stub import Stub
+from .pool import ConnectionPool
+from .workers import WorkerPool
+from . import mux
+from . import metrics as metricsmod
+from . import logs
+from .balancer import Balancer
+from . import balancer as balancermod
+from .retry import RetryBudget, LatencyWindow
 
 
 class Client:
-    address = None
+    address = None # or a list of the addresses of replicas, see `Balancer`
     call_timeout = None 
     socket_connect_timeout = 10
     socket_send_timeout = 10
@@ -18,29 +34,204 @@ class Client:
     loop = None
     nb_fetch_timeout = 5
     nb_fetch_tick = 1
+    nb_fetch_wait = 10 # max seconds the server holds a get until the job is
+                       # done, 0 - poll every nb_fetch_tick
+    nb_subscribe = False # nb_ calls share one waiting get per server process
+    pool_size = 8 # max idle connections kept per address, 0 - no reuse
+    pool_idle_timeout = 30
+    protocol = 8 # highest protocol version to negotiate, 1 - legacy only
+    shm_threshold = None # bytes of large buffers in a call to send them
+                         # through shared memory on UNIX sockets, None - never
+    stream_window = 16 # items a stream_ call lets the server send ahead
+    codec = 'pickle' # of calls over protocol 4, see `pyrpc.codec`
+    method_codecs = None # {method_name: codec name}, overrides `codec`
+    compression = None # compressor of calls over protocol 5 and of their
+                       # results, e.g. 'zlib', None - off
+    compress_threshold = 2**16 # bytes of a frame worth compressing
+    metrics = False # count and time calls, see `call_stats()`
+    log_sample = 1 # fraction of the calls logged, failed calls all are
+    log_async = True # format and write log records on a background thread
+    balance = 'least_outstanding' # or 'p2c', how calls pick an address
+    health_interval = 1 # seconds between connected() probes of addresses
+    health_timeout = 1 # of a probe
+    idempotent_methods = None # names of methods safe to run more than once,
+                              # their failed calls are retried
+    retries = 2 # max retries of a call, see `pyrpc.retry`
+    method_retries = None # {method_name: retries}, overrides `retries`
+    retry_backoff = 0.05 # max seconds before the first retry, doubling
+    retry_backoff_max = 2
+    retry_budget = 0.2 # retries per call made, beyond 10 saved up
+    hedge = False # make calls of idempotent methods once more at another
+                  # address when slower than most
+    hedge_quantile = 0.95 # of the recent latencies of a method, the delay
+                          # of its hedges
+    priority = None # class of workers running the calls on the server over
+                    # protocol 7, see `Server.priority_classes`
 
     def __init__(self, address=None, **kwargs):
         self.address = address or self.address
         for k, v in kwargs.items():
             setattr(self, k, v)
+        self._stubs = set() # names of the methods with a Stub
+        self._pool = ConnectionPool(self.pool_size, self.pool_idle_timeout)
+        self._mux_lock = threading.Lock()
+        self._address_lock = {} # held while connecting to the address
+        self._address_mux = {}
+        self._legacy_addresses = set()
+        self._loop_costate = weakref.WeakKeyDictionary()
+        self._subscriber = None
+        self._pid = os.getpid()
+        self._metrics = metricsmod.Metrics() if self.metrics else None
+        self._retry_budget = RetryBudget(self.retry_budget)
+        self._latency_windows = {}
+        self._workers = None
+        self._balancer = None
+        if isinstance(self.address, list):
+            self._balancer = Balancer(self.address, self.balance)
+            self._start_probes()
 
     def __getattr__(self, method_name):
         if method_name.startswith('co_'):
-            return Corelay(self, method_name[3:], self.loop)
+            stub = Stub(Corelay, self, method_name[3:], self.loop)
         elif method_name.startswith('nb_'):
             return NbRelay(self, method_name[3:])
-        else:
+        elif method_name.startswith('stream_'):
+            return StreamRelay(self, method_name[7:])
+        elif method_name.startswith('_'):
             return Relay(self, method_name)
+        else:
+            stub = Stub(Relay, self, method_name)
+        # found without __getattr__ from now on
+        self.__dict__[method_name] = stub
+        self._stubs.add(method_name)
+        return stub
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name[:1] != '_' and self.__dict__.get('_stubs'):
+            # their config is worked out from the options
+            for method_name in self._stubs:
+                self.__dict__.pop(method_name, None)
+            self._stubs = set()
+
+    def _get_mux(self, address, connect_timeout, send_timeout):
+        '''Returns the shared protocol 2 connection to the address or None if
+        the server speaks only the legacy protocol.'''
+        if self.protocol < 2:
+            return None
+        with self._mux_lock:
+            self._check_pid()
+            known, conn = self._known_mux(address)
+            if known:
+                return conn
+            lock = self._address_lock.setdefault(address, threading.Lock())
+        # connecting holds up the calls to that address only
+        with lock:
+            with self._mux_lock:
+                known, conn = self._known_mux(address)
+            if known:
+                return conn
+            conn = mux.connect(
+                address, connect_timeout, send_timeout,
+                self.protocol, self.shm_threshold,
+            )
+            with self._mux_lock:
+                if conn is None:
+                    self._legacy_addresses.add(address)
+                    self._address_mux.pop(address, None)
+                else:
+                    self._address_mux[address] = conn
+            return conn
+
+    def _known_mux(self, address):
+        '''Returns (True, the connection to the address or None if the
+        server speaks only the legacy protocol), or (False, None) if a
+        connection must be made. Called holding `_mux_lock`.'''
+        if address in self._legacy_addresses:
+            return True, None
+        conn = self._address_mux.get(address)
+        if conn is not None:
+            idle = time.time()-conn.last_used > self.pool_idle_timeout
+            if not conn.closed and not (idle and not conn.inflight):
+                return True, conn
+            conn.close()
+            del self._address_mux[address]
+        return False, None
+
+    def _get_subscriber(self):
+        with self._mux_lock:
+            self._check_pid()
+            if self._subscriber is None:
+                self._subscriber = Subscriber(self)
+            return self._subscriber
+
+    def _check_pid(self):
+        # threads and connections of the parent process are not ours
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._address_lock = {}
+            self._address_mux = {}
+            self._loop_costate = weakref.WeakKeyDictionary()
+            self._subscriber = None
+            self._workers = None
+            if self._balancer is not None:
+                self._start_probes()
+
+    def _latency_window(self, method_name):
+        window = self._latency_windows.get(method_name)
+        if window is None:
+            window = self._latency_windows.setdefault(
+                method_name, LatencyWindow()
+            )
+        return window
+
+    def _get_workers(self):
+        '''Returns the threads making the hedged calls.'''
+        with self._mux_lock:
+            self._check_pid()
+            if self._workers is None:
+                self._workers = WorkerPool()
+            return self._workers
+
+    def _start_probes(self):
+        balancermod.start_probes(
+            self, self.health_interval, self.health_timeout
+        )
+
+    def _probe(self, address, timeout):
+        relay = Relay(self, 'connected', address)
+        relay._consume_kwargs({'call_timeout': timeout})
+        try:
+            relay._make_balanced_call(('connected', (), {}))
+        except Exception:
+            return False
+        return True
+
+    def _close_connections(self):
+        self._pool.clear()
+        with self._mux_lock:
+            address_mux, self._address_mux = self._address_mux, {}
+            self._legacy_addresses = set()
+        for conn in address_mux.values():
+            conn.close()
+        loop_costate, self._loop_costate = (
+            self._loop_costate, weakref.WeakKeyDictionary()
+        )
+        for loop, state in loop_costate.items():
+            for conn in state.address_conn.values():
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(conn.close)
 
     def _handle_exception(self, callmsg, exc):
         method_name, args, kwargs, *_ = callmsg
         if isinstance(exc, KeyboardInterrupt):
             return 
         if  exc.traceback and method_name != 'connected':
-            h = '{}: {}(args={!r}, kwargs={!r})'.format(
-                type(self).__name__, method_name, args, kwargs
+            h = '{}: {}(args={}, kwargs={})'.format(
+                type(self).__name__, method_name,
+                logs.short_repr(args), logs.short_repr(kwargs),
             )[:60] + '\n'
-            msg = h + exc.traceback
+            msg = h + logs.short_lines(exc.traceback)
             self.log_exception(msg)
         raise exc
 
@@ -48,7 +239,10 @@ class Client:
         log = self.get_exception_logging_func()
         if not log:
             return 
-        log(msg)
+        if self.log_async:
+            logs.submit(log, str, msg)
+        else:
+            log(msg)
 
     def log_call(self, callmsg, result):
         log = self.get_call_logging_func()
@@ -59,8 +253,12 @@ class Client:
             return
         if method_name == 'connected':
             return 
-        msg = '    %s -> %s' % (method_name, repr(result)[:60])
-        log(msg)
+        if self.log_sample < 1 and random.random() >= self.log_sample:
+            return
+        if self.log_async:
+            logs.submit(log, _call_msg, method_name, result)
+        else:
+            log(_call_msg(method_name, result))
 
     def get_exception_logging_func(self):
         return None
@@ -68,6 +266,21 @@ class Client:
     def get_call_logging_func(self):
         return None
 
+    def batch(self, parallel=False, **kwargs):
+        '''Returns a `Batch` sending many calls in one request.'''
+        return Batch(self, parallel, **kwargs)
+
+    def call_stats(self, format=None):
+        '''Returns the metrics of the calls made by this client with
+        `metrics`: {method_name: {...}} as in `Server.stats()`, the phases
+        being connect, send (encode included) and wait, or with
+        format='prometheus' the text exposition format of them. Streamed
+        calls are not counted, a batch is counted as `batch`.'''
+        methods = {} if self._metrics is None else self._metrics.snapshot()
+        if format == 'prometheus':
+            return metricsmod.prometheus('pyrpc_client', methods)
+        return methods
+
     def connected(self, timeout=0.1):
         try:
             Relay(self, 'connected')(call_timeout=timeout)
@@ -76,6 +289,16 @@ class Client:
         return True
 
     def shutdown(self, **kwargs):
-        Relay(self, 'shutdown')(**kwargs)
+        '''Shuts the server down, all of them with many addresses.'''
+        if self._balancer is None:
+            Relay(self, 'shutdown')(**kwargs)
+        else:
+            for address in self._balancer.addresses:
+                Relay(self, 'shutdown', address)(**kwargs)
         # to ensure server shutdown upon return
         time.sleep(0.2) 
+        self._close_connections()
+
+
+def _call_msg(method_name, result):
+    return '    %s -> %s' % (method_name, logs.short_repr(result)[:60])
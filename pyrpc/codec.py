@@ -0,0 +1,201 @@
+'''Codecs of protocol 4 frames.
+
+A client picks the codec of each call (`Client.codec`, `Client.method_codecs`)
+and the server answers with the same one. Its id travels in the frame flags,
+so both sides must have it registered under the same id. Servers decode only
+the codecs named in `Server.codecs`. Legacy and protocol 2 connections always
+use pickle.
+
+pickle: any picklable object, large buffers out of band.
+marshal: builtin types only, much cheaper than pickle for small calls made of
+    primitives. Not safe against malicious data.
+json: JSON types only, tuples arrive as lists. Safe to decode from any peer.
+
+Codecs other than pickle send exceptions as their class name, args and
+traceback. They are rebuilt as the builtin or `pyrpc` exception of that name,
+or as an `Exception` with a `className` attribute.
+'''
+import builtins
+import marshal
+import pickle
+import json
+
+from . import protocol
+from . import ut
+
+
+class Codec:
+    '''`dumps()` returns the parts of a frame body, see `protocol.dumps()`,
+    `loads()` takes them back.'''
+    name = None
+    id = None # 0-15, ids 8-15 are left for codecs of users
+
+    def __init__(self, name=None, id_=None):
+        self.name = name or self.name
+        self.id = self.id if id_ is None else id_
+
+    @property
+    def flags(self):
+        return self.id << protocol.CODEC_SHIFT
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, parts):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    name = 'pickle'
+    id = 0
+
+    def __init__(self, name=None, id_=None, protocol=5):
+        super().__init__(name, id_)
+        self.protocol = protocol
+
+    def dumps(self, obj):
+        if self.protocol == 5:
+            return protocol.dumps(obj)
+        return [pickle.dumps(obj, self.protocol)]
+
+    def loads(self, parts):
+        return protocol.loads(parts)
+
+
+class MarshalCodec(Codec):
+    '''The body is a byte telling whether exceptions were turned into dicts,
+    then the marshal data.'''
+    name = 'marshal'
+    id = 1
+
+    def dumps(self, obj):
+        try:
+            return [b'\x00' + marshal.dumps(obj)]
+        except ValueError:
+            pass
+        try:
+            return [b'\x01' + marshal.dumps(_encode_exceptions(obj))]
+        except ValueError as e:
+            raise TypeError('marshal: {}'.format(e))
+
+    def loads(self, parts):
+        body = b''.join(parts) if len(parts) > 1 else parts[0]
+        obj = marshal.loads(memoryview(body)[1:])
+        if body[0]:
+            obj = _decode_exceptions(obj)
+        return obj
+
+
+class JsonCodec(Codec):
+    name = 'json'
+    id = 2
+
+    def dumps(self, obj):
+        return [json.dumps(
+            obj, default=_json_default, separators=(',', ':')
+        ).encode()]
+
+    def loads(self, parts):
+        body = b''.join(parts) if len(parts) > 1 else parts[0]
+        obj = json.loads(bytes(body), object_hook=_json_object)
+        # calls and responses are tuples
+        return tuple(obj) if type(obj) is list else obj
+
+
+def register(codec):
+    '''Makes the codec usable by name, replacing the one with its id.'''
+    if not 0 <= codec.id < 16:
+        raise ValueError('codec ids are 0-15')
+    old = _id_codec.get(codec.id)
+    if old is not None:
+        _name_codec.pop(old.name, None)
+    _id_codec[codec.id] = codec
+    _name_codec[codec.name] = codec
+
+
+def get(codec):
+    '''Returns the codec of a name, a codec as it is.'''
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return _name_codec[codec]
+    except KeyError:
+        raise ValueError('unknown codec {!r}'.format(codec))
+
+
+def from_flags(flags):
+    try:
+        return _id_codec[flags >> protocol.CODEC_SHIFT]
+    except KeyError:
+        raise ut.ProtocolError(
+            'unknown codec id {}'.format(flags >> protocol.CODEC_SHIFT)
+        )
+
+
+def _encode_exceptions(obj):
+    t = type(obj)
+    if isinstance(obj, BaseException):
+        return _exception_dict(obj)
+    if t is tuple or t is list:
+        return t(_encode_exceptions(v) for v in obj)
+    if t is dict:
+        return {k: _encode_exceptions(v) for k, v in obj.items()}
+    return obj
+
+
+def _decode_exceptions(obj):
+    t = type(obj)
+    if t is tuple or t is list:
+        return t(_decode_exceptions(v) for v in obj)
+    if t is dict:
+        if _EXCEPTION in obj:
+            return _exception(obj)
+        return {k: _decode_exceptions(v) for k, v in obj.items()}
+    return obj
+
+
+def _json_default(obj):
+    if isinstance(obj, BaseException):
+        return _exception_dict(obj)
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _json_object(d):
+    return _exception(d) if _EXCEPTION in d else d
+
+
+def _exception_dict(e):
+    return {
+        _EXCEPTION: getattr(e, 'className', None) or type(e).__name__,
+        'args': [
+            v if type(v) in (str, int, float, bool, type(None)) else repr(v)
+            for v in e.args
+        ],
+        'traceback': getattr(e, 'traceback', ''),
+    }
+
+
+def _exception(d):
+    name = d[_EXCEPTION]
+    cls = getattr(ut, name, None) or getattr(builtins, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        cls = None
+    try:
+        e = (cls or Exception)(*d['args'])
+    except Exception:
+        cls = None
+        e = Exception(*d['args'])
+    if cls is None:
+        e.className = name
+    e.traceback = d['traceback']
+    return e
+
+
+_EXCEPTION = '__exception__'
+_id_codec = {}
+_name_codec = {}
+
+PICKLE = PickleCodec()
+register(PICKLE)
+register(MarshalCodec())
+register(JsonCodec())
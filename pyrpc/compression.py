@@ -0,0 +1,147 @@
+'''Compressors of protocol 5 frames.
+
+A frame with the COMPRESSED flag names its compressor by id in the first
+byte of the body, see `protocol.compress()`, so both sides must have it
+registered under the same id. The answer to a compressed request is
+compressed with the same compressor.
+
+zlib: fast, a fair ratio (level 1 by default).
+lzma: much slower, the best ratio (preset 0 by default).
+bz2: slow, a good ratio on text (level 9 by default).
+'''
+import zlib
+import lzma
+import bz2
+
+from . import ut
+
+
+class Compressor:
+    '''`compress()` takes a list of buffers and returns the bytes of their
+    concatenation compressed, `decompress()` takes them back, raising
+    `ut.ProtocolError` rather than returning more than `max_length` bytes
+    (None - no limit).'''
+    name = None
+    id = None # 1-127, ids 64-127 are left for compressors of users
+
+    def __init__(self, name=None, id_=None):
+        self.name = name or self.name
+        self.id = self.id if id_ is None else id_
+
+    def compress(self, buffers):
+        raise NotImplementedError
+
+    def decompress(self, data, max_length=None):
+        raise NotImplementedError
+
+
+class _StreamCompressor(Compressor):
+    '''Compresses the buffers one after another, never joining them, and
+    decompresses no more than the limit.'''
+    _unlimited = -1 # max_length of _decompressor().decompress() for none
+
+    def compress(self, buffers):
+        compressor = self._compressor()
+        chunks = [compressor.compress(buf) for buf in buffers]
+        chunks.append(compressor.flush())
+        return b''.join(chunks)
+
+    def decompress(self, data, max_length=None):
+        decompressor = self._decompressor()
+        try:
+            data = decompressor.decompress(
+                data, self._unlimited if max_length is None else max_length+1
+            )
+        except Exception as e:
+            raise ut.ProtocolError('{} data: {}'.format(self.name, e))
+        if max_length is not None and len(data) > max_length:
+            raise ut.ProtocolError('{} data over {} bytes'.format(
+                self.name, max_length
+            ))
+        if not decompressor.eof:
+            raise ut.ProtocolError('{} data truncated'.format(self.name))
+        return data
+
+
+class ZlibCompressor(_StreamCompressor):
+    name = 'zlib'
+    id = 1
+
+    def __init__(self, name=None, id_=None, level=1):
+        super().__init__(name, id_)
+        self.level = level
+
+    _unlimited = 0
+
+    def _compressor(self):
+        return zlib.compressobj(self.level)
+
+    def _decompressor(self):
+        return zlib.decompressobj()
+
+
+class LzmaCompressor(_StreamCompressor):
+    name = 'lzma'
+    id = 2
+
+    def __init__(self, name=None, id_=None, preset=0):
+        super().__init__(name, id_)
+        self.preset = preset
+
+    def _compressor(self):
+        return lzma.LZMACompressor(preset=self.preset)
+
+    def _decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class Bz2Compressor(_StreamCompressor):
+    name = 'bz2'
+    id = 3
+
+    def __init__(self, name=None, id_=None, level=9):
+        super().__init__(name, id_)
+        self.level = level
+
+    def _compressor(self):
+        return bz2.BZ2Compressor(self.level)
+
+    def _decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+def register(compressor):
+    '''Makes the compressor usable by name, replacing the one with its id.'''
+    if not 0 < compressor.id < 128:
+        raise ValueError('compressor ids are 1-127')
+    old = _id_compressor.get(compressor.id)
+    if old is not None:
+        _name_compressor.pop(old.name, None)
+    _id_compressor[compressor.id] = compressor
+    _name_compressor[compressor.name] = compressor
+
+
+def get(compressor):
+    '''Returns the compressor of a name, a compressor as it is, None for
+    None.'''
+    if compressor is None or isinstance(compressor, Compressor):
+        return compressor
+    try:
+        return _name_compressor[compressor]
+    except KeyError:
+        raise ValueError('unknown compressor {!r}'.format(compressor))
+
+
+def from_id(id_):
+    try:
+        return _id_compressor[id_]
+    except KeyError:
+        raise ut.ProtocolError('unknown compressor id {}'.format(id_))
+
+
+_id_compressor = {}
+_name_compressor = {}
+
+register(ZlibCompressor())
+register(LzmaCompressor())
+register(Bz2Compressor())
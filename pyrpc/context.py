@@ -0,0 +1,68 @@
+import contextvars
+import time
+
+from . import ut
+
+
+class CallContext:
+    '''The call a server method is running for.
+
+    `deadline` is the `time.monotonic()` after which the client no longer
+    waits for the response, None if the client sent none (clients of older
+    versions, non-blocking and streamed calls). `job` is the request of a
+    nonblocking call, which the client may cancel and read the progress of.
+    '''
+    def __init__(self, deadline=None, job=None):
+        self.deadline = deadline
+        self._job = job
+
+    def remaining(self):
+        '''Returns the seconds left until the deadline, None without one.'''
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline-time.monotonic())
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def cancelled(self):
+        '''Returns whether the job was cancelled: by the client, which gave
+        up on it, or because its due time passed.'''
+        return self._job is not None and self._job.get('cancelled', False)
+
+    def check(self):
+        '''Raises `pyrpc.Expired` once the deadline has passed and
+        `pyrpc.Cancelled` once the job is cancelled, so a long method can
+        give up on a call nobody waits for.'''
+        if self.expired():
+            raise ut.Expired('deadline passed')
+        if self.cancelled():
+            raise ut.Cancelled('job cancelled')
+
+    def report(self, progress):
+        '''Sets the progress of the job, returned to the gets of the client
+        until it is done. A small picklable value, e.g. a fraction done.
+        Nothing for other calls.'''
+        if self._job is not None:
+            self._job['progress'] = progress
+
+
+_NONE = CallContext()
+_current = contextvars.ContextVar('pyrpc_call', default=_NONE)
+
+
+def current_call():
+    '''Returns the `CallContext` of the call the calling server method runs
+    for.'''
+    return _current.get()
+
+
+def enter(deadline, job=None):
+    '''Makes the call with the deadline (or the job) current, returns the
+    token to pass to `leave()`.'''
+    return _current.set(CallContext(deadline, job))
+
+
+def leave(token):
+    _current.reset(token)
+
@@ -0,0 +1,359 @@
+import collections
+import traceback
+import itertools
+import asyncio
+import pickle
+import copy
+import time
+
+from .relay import Relay
+from . import protocol
+from . import retry
+from . import ut
+
+
+class Corelay:
+    '''Asyncio counterpart of `Relay`: `await client.co_method(...)`.
+
+    Calls made from one event loop share a protocol 2 connection per address.
+    Servers speaking only the legacy protocol get a connection per call.
+    '''
+    _consume_kwargs = Relay._consume_kwargs
+    _encode = Relay._encode
+    _sends_deadline = True
+    _error_msg = Relay._error_msg
+    _record = Relay._record
+    _limit_timeout = Relay._limit_timeout
+
+    def __init__(self, client, method_name, loop=None):
+        self._client = client
+        self._method_name = method_name
+        self._loop = loop
+
+    async def __call__(self, *args, **kwargs):
+        return await self._call(args, self._consume_kwargs(kwargs))
+
+    async def _call(self, args, kwargs):
+        callmsg = self._method_name, args, kwargs
+        metrics = self._client._metrics
+        if metrics is not None:
+            metrics.begin(self._method_name)
+        try:
+            ret, exc = await self._make_retried_call(callmsg)
+        except Exception as e:
+            ret = None
+            exc = e
+        if metrics is not None:
+            self._record(metrics, exc)
+        if exc is not None:
+            self._client._handle_exception(callmsg, exc)
+        else:
+            self._client.log_call(callmsg, ret)
+            return ret
+
+    async def _make_retried_call(self, indata):
+        '''See `Relay._make_retried_call()`.'''
+        client = self._client
+        if self._method_name not in (client.idempotent_methods or ()):
+            return await self._make_balanced_call(indata)
+        client._retry_budget.deposit()
+        retries = (client.method_retries or {}).get(
+            self._method_name, client.retries
+        )
+        due_time = time.monotonic() + self._timeout
+        for n in itertools.count():
+            try:
+                output = await self._make_hedged_call(indata)
+            except retry.RETRYABLE as e:
+                output = e
+            error = retry.failure(output)
+            if error is None:
+                return output
+            delay = retry.backoff(
+                n, client.retry_backoff, client.retry_backoff_max
+            )
+            if n >= retries or time.monotonic()+delay >= due_time or \
+                    not client._retry_budget.withdraw():
+                if output is error:
+                    raise error
+                return output
+            await asyncio.sleep(delay)
+            self._limit_timeout(due_time-time.monotonic())
+
+    async def _make_hedged_call(self, indata):
+        '''See `Relay._make_hedged_call()`.'''
+        client = self._client
+        if not client.hedge:
+            return await self._make_balanced_call(indata)
+        window = client._latency_window(self._method_name)
+        delay = window.quantile(client.hedge_quantile)
+        start = time.perf_counter()
+        if delay is None:
+            output = await self._make_balanced_call(indata)
+        else:
+            output = await self._race(indata, delay)
+        window.add(time.perf_counter()-start)
+        return output
+
+    async def _race(self, indata, delay):
+        '''Returns the first output of the call and of its hedge, made if
+        the call is not done in `delay` seconds. The other one is
+        cancelled.'''
+        first = copy.copy(self)
+        tasks = [asyncio.ensure_future(first._make_balanced_call(indata))]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                second = copy.copy(self)
+                tasks.append(asyncio.ensure_future(second._make_balanced_call(
+                    indata, (getattr(first, '_address', None),)
+                )))
+            error = None
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _make_balanced_call(self, indata, exclude=()):
+        '''See `Relay._make_balanced_call()`.'''
+        balancer = self._client._balancer
+        if balancer is None:
+            self._address = self._client.address
+            return await self._make_call(indata)
+        tried = set(exclude)
+        while True:
+            self._address = balancer.acquire(tried)
+            try:
+                return await self._make_call(indata)
+            except ut.NoSocket:
+                balancer.eject(self._address)
+                tried.add(self._address)
+                if tried.issuperset(balancer.addresses):
+                    raise
+            finally:
+                balancer.release(self._address)
+
+    async def _make_call(self, indata):
+        try:
+            conn = await self._get_connection()
+            laps = self._laps
+            if laps is not None:
+                laps.lap('connect')
+            if conn is not None:
+                codec, parts, flags = self._encode(conn, indata)
+                parts = await conn.call(parts, self._timeout, flags, laps)
+                if laps is not None:
+                    laps.lap('wait')
+                return codec.loads(parts)
+            body = await self._make_legacy_call(pickle.dumps(indata))
+            if laps is not None:
+                laps.lap('wait')
+            return pickle.loads(body)
+        except Exception as e:
+            if isinstance(e, (ut.Timeout, ut.NoSocket, ut.ProtocolError)):
+                e.traceback = ''
+            else:
+                e.traceback = traceback.format_exc()
+            raise e
+
+    async def _get_connection(self):
+        loop = self._loop or asyncio.get_running_loop()
+        state = self._client._loop_costate.get(loop)
+        if state is None:
+            state = self._client._loop_costate[loop] = _LoopState()
+        address = self._address
+        if address in state.legacy_addresses:
+            return None
+        # connecting holds up the calls to that address only
+        async with state.address_lock[address]:
+            conn = state.address_conn.get(address)
+            if conn is not None:
+                idle = time.time()-conn.last_used > self._client.pool_idle_timeout
+                if not conn.closed and not (idle and not conn.inflight):
+                    return conn
+                conn.close()
+            conn = None
+            if self._client.protocol >= 2:
+                conn = await self._connect_mux()
+            if conn is None:
+                state.legacy_addresses.add(address)
+                state.address_conn.pop(address, None)
+            else:
+                state.address_conn[address] = conn
+            return conn
+
+    async def _connect_mux(self):
+        reader, writer = await self._open_connection()
+        version = min(self._client.protocol, protocol.VERSION)
+        if version == 3:
+            # asyncio streams can't receive file descriptors
+            version = 2
+        writer.write(protocol.HANDSHAKE + bytes([version]))
+        methods = {}
+        try:
+            reply = await asyncio.wait_for(
+                reader.readexactly(len(protocol.HANDSHAKE)+1),
+                self._socket_connect_timeout,
+            )
+            ours = reply[:len(protocol.HANDSHAKE)] == protocol.HANDSHAKE
+            if reply[-1] >= 4:
+                await asyncio.wait_for(
+                    reader.readexactly(1), self._socket_connect_timeout
+                )
+            if ours and reply[-1] >= 8:
+                methods = protocol.unpack_methods(await asyncio.wait_for(
+                    self._read_methods(reader), self._socket_connect_timeout
+                ))
+            if reply[-1] >= 4:
+                writer.write(bytes([0]))
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            reply = None
+        except asyncio.TimeoutError:
+            # the call was not sent, it can go to another address
+            writer.close()
+            raise ut.NoSocket(self._error_msg('handshake'))
+        if reply is None or reply[:len(protocol.HANDSHAKE)] != protocol.HANDSHAKE \
+                or reply[-1] < 2:
+            writer.close()
+            return None
+        return CoConnection(reader, writer, reply[-1], methods)
+
+    async def _read_methods(self, reader):
+        nbytes = int.from_bytes(await reader.readexactly(4), 'big')
+        return await reader.readexactly(nbytes)
+
+    async def _make_legacy_call(self, body):
+        due_time = time.time() + self._timeout
+        reader, writer = await self._open_connection()
+        if self._laps is not None:
+            self._laps.lap('connect')
+        try:
+            writer.write(len(body).to_bytes(4, 'big') + body)
+            try:
+                await asyncio.wait_for(writer.drain(), self._socket_send_timeout)
+            except Exception:
+                raise ut.Timeout('send')
+            if self._laps is not None:
+                self._laps.lap('send')
+            try:
+                header = await asyncio.wait_for(
+                    reader.readexactly(4), due_time-time.time()
+                )
+                nbytes = int.from_bytes(header, 'big')
+                if nbytes == 0:
+                    raise ut.ProtocolError(self._error_msg('read_header'))
+                return await asyncio.wait_for(
+                    reader.readexactly(nbytes), due_time-time.time()
+                )
+            except asyncio.TimeoutError:
+                raise ut.Timeout(self._error_msg('read'))
+            except (asyncio.IncompleteReadError, ConnectionResetError):
+                raise ut.ProtocolError(self._error_msg('read'))
+        finally:
+            writer.close()
+
+    async def _open_connection(self):
+        address = self._address
+        try:
+            if isinstance(address, str):
+                connecting = asyncio.open_unix_connection(address)
+            else:
+                host, port = address
+                connecting = asyncio.open_connection(host or '127.0.0.1', port)
+            return await asyncio.wait_for(
+                connecting, self._socket_connect_timeout
+            )
+        except Exception:
+            raise ut.NoSocket(self._error_msg('connect'))
+
+
+class CoConnection:
+    '''A protocol 2 connection shared by the coroutines of one event loop.'''
+    def __init__(self, reader, writer, version=2, methods=None):
+        self._reader = reader
+        self._writer = writer
+        self.version = version
+        self.methods = methods or {} # {method_name: id} over protocol 8
+        self._id_future = {}
+        self._ids = itertools.count(1)
+        self.closed = False
+        self.last_used = time.time()
+        self._task = asyncio.ensure_future(self._read_loop())
+
+    @property
+    def inflight(self):
+        return len(self._id_future)
+
+    async def call(self, parts, timeout, flags=0, laps=None):
+        '''Returns the response parts, see `protocol.dumps()`. Marks the
+        send of the call in `laps`, see `metrics.Laps`.'''
+        if self.closed:
+            raise ut.ProtocolError('closed')
+        id_ = next(self._ids) & 0xffffffff
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._id_future[id_] = future
+        # cheaper than wait_for(), which wraps the future in a task
+        timer = loop.call_later(timeout, _expire, future)
+        try:
+            for buf in protocol.pack(id_, protocol.REQUEST, parts, flags):
+                self._writer.write(buf)
+            if self._writer.transport.get_write_buffer_size():
+                try:
+                    await asyncio.wait_for(self._writer.drain(), timeout)
+                except Exception:
+                    self.close()
+                    raise ut.Timeout('send')
+            if laps is not None:
+                laps.lap('send')
+            return await future
+        finally:
+            timer.cancel()
+            self._id_future.pop(id_, None)
+            self.last_used = time.time()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        futures = list(self._id_future.values())
+        self._id_future.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(ut.ProtocolError('connection closed'))
+        self._writer.close()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(protocol.HEADER.size)
+                id_, kind, flags, nbytes = protocol.HEADER.unpack(header)
+                parts = await protocol.read_body_async(
+                    self._reader, flags, nbytes
+                )
+                if flags & protocol.COMPRESSED:
+                    parts = protocol.decompress(parts, flags)[1]
+                future = self._id_future.get(id_)
+                if future is not None and not future.done():
+                    future.set_result(parts)
+        except Exception:
+            pass
+        finally:
+            self.close()
+
+
+def _expire(future):
+    if not future.done():
+        future.set_exception(ut.Timeout('wait'))
+
+
+class _LoopState:
+    def __init__(self):
+        self.address_lock = collections.defaultdict(asyncio.Lock)
+        self.address_conn = {}
+        self.legacy_addresses = set()
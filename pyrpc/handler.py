@@ -1,170 +1,1020 @@
 from socketserver import BaseRequestHandler
 import traceback
 import threading
+import types
+import os
+import select
+import socket
 import pickle
+import time
+
+from . import protocol
+from . import codec as codecmod
+from . import cache as cachemod
+from . import compression
+from . import context as contextmod
+from . import jobs
+from . import ut
 
 
 class Handler(BaseRequestHandler):
     '''Server protocol:
     req: len(4) + pickled callmsg
     resp: len(4) + pickled (ret, exc)
-    
+
+    The connection stays open for further requests until the client closes
+    it or stays idle for `Server.keepalive_timeout`. Synchronous servers
+    serve one request per connection.
+
+    A connection starting with the protocol 2 handshake is served as
+    described in `protocol`: requests run concurrently and responses are sent
+    as they are ready. Synchronous servers decline protocol 2.
+
+    A streamed call (protocol 2 only) sends the items of the result as the
+    client grants credit, taking the next item only then. It keeps its
+    worker until the iteration ends.
+
+    From protocol 4 on, each request is decoded with the codec of its frame
+    and answered with it, see `codec`. From protocol 5 on, the response to
+    a compressed request is compressed with its compressor, other ones with
+    `Server.compression`.
+
     If used with a sync server, the method should never stall.
     Otherwise the server will become unresponsive.
     '''
     def handle(self):
-        ret, exc = None, None
+        self._poller = select.poll()
+        self._poller.register(self.request, select.POLLIN)
+        while True:
+            try:
+                if not self._wait_readable():
+                    return
+                header = self._read(4)
+                if header == protocol.HANDSHAKE:
+                    self._handle_mux()
+                    return
+                body = self._read(int.from_bytes(header, 'big'))
+            except Exception:
+                return
+            if not self._dispatch([body], self._send_output):
+                return
+            if self.server.parent.synchronous:
+                return
+
+    def _dispatch(self, body, send, stream=None, codec=codecmod.PICKLE):
+        parent = self.server.parent
+        start = time.perf_counter()
         try:
-            nbytes = int.from_bytes(self._read(4), 'big')
-            body = self._read(nbytes)
-            method_name, args, kwargs = pickle.loads(body)
+            data = _decode(parent, codec, body)
+            calls = _batch_calls(data)
+            if calls is None:
+                method_name, args, kwargs, *_ = data
+            deadline = _deadline(data)
+            priority = _priority(data)
+        except ut.ProtocolError as e:
+            e.traceback = ''
+            send((None, e))
+            return False
         except Exception:
-            return 
+            send((None, Exception('read_error')))
+            return False
+        if parent._metrics is not None:
+            send = _measured(parent, data, body, start, send)
+        if calls is not None:
+            _serve_batch(
+                parent, calls, data.get('parallel'), send, deadline,
+                priority, self,
+            )
+        else:
+            _serve(
+                parent, method_name, args, kwargs, send, stream, codec,
+                deadline, priority, self,
+            )
+        return True
+
+    def _send_output(self, output):
+        if type(output) is _Encoded:
+            output = output.output
         try:
-            method = getattr(self.server.parent.callee, method_name)
-            ret = method(*args, **kwargs)
+            msg = pickle.dumps(output)
         except Exception as e:
-            if self.server.parent.retype_exceptions:
-                e2 = Exception(*e.args)
-                e2.className = type(e).__name__
-                e = e2
             e.traceback = traceback.format_exc()
-            exc = e
-        msg = pickle.dumps((ret, exc))
+            msg = pickle.dumps((None, e))
         try:
-            msg = len(msg).to_bytes(4, 'big') + msg
-            self.request.sendall(msg)
-        except BrokenPipeError:
+            protocol.sendall(self.request, [len(msg).to_bytes(4, 'big'), msg])
+        except OSError:
             pass
-        if exc is not None:
-            self.server.parent.log_exception(exc, method_name, args, kwargs)
+        return 4 + len(msg)
+
+    def _handle_mux(self):
+        version = self._read(1)[0]
+        if self.server.parent.synchronous:
+            version = 1
+        version = min(version, protocol.VERSION)
+        reply = protocol.HANDSHAKE + bytes([version])
+        if version >= 4:
+            reply += bytes([protocol.features(self.request)])
+        if version >= 8:
+            reply += protocol.pack_methods(
+                _method_names(self.server.parent)
+            )
+        self.request.sendall(reply)
+        if version < 2:
+            return
+        self._version = version
+        self._compressor = None
+        if version >= 5:
+            self._compressor = compression.get(self.server.parent.compression)
+        if version >= 4:
+            features = self._read(1)[0]
+            self._peer_shm = bool(features & protocol.RECV_FDS)
         else:
-            self.server.parent.log_call(ret, method_name, args, kwargs)
+            self._peer_shm = (
+                version == 3 and self.request.family == socket.AF_UNIX
+            )
+        protocol.nodelay(self.request)
+        self._send_lock = threading.Lock()
+        self._inflight_lock = threading.Lock()
+        self._inflight = 0
+        self._id_stream = {}
+        self._closed = threading.Event()
+        self._read_request()
+        self._closed.wait()
 
-    def _read(self, n):
-        received = 0
-        chunks = []
-        while received < n:
+    def _read_request(self):
+        '''Reads the next request, hands reading over to a worker and serves
+        the request in the current thread.'''
+        try:
+            while True:
+                # never drop a connection with calls still running on it
+                while not self._wait_readable():
+                    if not self._inflight:
+                        raise EOFError()
+                id_, kind, flags, body = protocol.read_frame(self.request)
+                if kind == protocol.REQUEST:
+                    codec = codecmod.PICKLE
+                    if self._version >= 4:
+                        codec = codecmod.from_flags(flags)
+                    compressor = self._compressor
+                    if flags & protocol.COMPRESSED:
+                        try:
+                            compressor, body = protocol.decompress(
+                                body, flags,
+                                self.server.parent.max_decompressed,
+                            )
+                        except ut.ProtocolError as e:
+                            e.traceback = ''
+                            self._send_frame(id_, (None, e), codec=codec)
+                            continue
+                    break
+                stream = self._id_stream.get(id_)
+                if kind == protocol.CREDIT:
+                    if stream is not None:
+                        stream.grant(int.from_bytes(body[0], 'big'))
+                elif kind == protocol.CANCEL:
+                    if stream is not None:
+                        stream.cancel()
+                else:
+                    raise EOFError()
+        except Exception:
+            for stream in list(self._id_stream.values()):
+                stream.cancel()
+            self._closed.set()
+            return
+        with self._inflight_lock:
+            self._inflight += 1
+        stream = None
+        if flags & protocol.STREAM:
+            # before reading on, the credit follows the request
+            stream = self._id_stream[id_] = _Stream(
+                lambda item: self._send_frame(
+                    id_, item, protocol.ITEM, codec, compressor
+                ),
+                self.server.parent.keepalive_timeout,
+            )
+        self.server.parent._workers.spawn(self._read_request)
+        self._serve_request(id_, body, stream, codec, compressor)
+
+    def _serve_request(self, id_, body, stream=None, codec=codecmod.PICKLE,
+                       compressor=None):
+        sent = []
+        def send(output):
+            sent.append(True)
+            self._id_stream.pop(id_, None)
             try:
-                chunk = self.request.recv(n-received)
-            except InterruptedError:
-                continue
-            if not chunk:
-                break
-            chunks.append(chunk)
-            received += len(chunk)
-        data = b''.join(chunks)
-        if len(data) != n:
-            raise Exception()
-        return data
+                return self._send_frame(
+                    id_, output, codec=codec, compressor=compressor
+                )
+            finally:
+                with self._inflight_lock:
+                    self._inflight -= 1
+        try:
+            self._dispatch(body, send, stream, codec)
+        except Exception as e:
+            # the client waits for exactly one response per request
+            if sent:
+                raise
+            e.traceback = traceback.format_exc()
+            send((None, e))
 
+    def _send_frame(self, id_, output, kind=protocol.RESPONSE,
+                    codec=codecmod.PICKLE, compressor=None):
+        try:
+            if type(output) is _Encoded:
+                parts = output.parts
+            else:
+                parts = codec.dumps(output)
+        except Exception as e:
+            if kind != protocol.RESPONSE:
+                raise
+            e.traceback = traceback.format_exc()
+            parts = codec.dumps((None, e))
+        parent = self.server.parent
+        fd = None
+        if protocol.use_shm(self._peer_shm, parts, parent.shm_threshold):
+            frame, fd = protocol.pack_shm(id_, kind, parts, codec.flags)
+        elif compressor is not None:
+            frame = protocol.pack(id_, kind, *protocol.compress(
+                parts, compressor, parent.compress_threshold, codec.flags
+            ))
+        else:
+            frame = protocol.pack(id_, kind, parts, codec.flags)
+        with self._send_lock:
+            try:
+                protocol.sendall(self.request, frame, fd)
+            except OSError:
+                pass
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        return sum(memoryview(buf).nbytes for buf in frame)
+
+    def _wait_readable(self):
+        timeout = self.server.parent.keepalive_timeout
+        if timeout is None:
+            return True
+        return bool(self._poller.poll(timeout*1000))
 
+    def _read(self, n):
+        return protocol.read_exactly(self.request, n)
 
 
 class NbHandler(BaseRequestHandler):
+    handle = Handler.handle
+    _send_output = Handler._send_output
+    _handle_mux = Handler._handle_mux
+    _read_request = Handler._read_request
+    _serve_request = Handler._serve_request
+    _send_frame = Handler._send_frame
+    _wait_readable = Handler._wait_readable
     _read = Handler._read
 
-    def handle(self):
+    def _dispatch(self, body, send, stream=None, codec=codecmod.PICKLE):
+        start = time.perf_counter()
         try:
-            nbytes = int.from_bytes(self._read(4), 'big')
-            body = self._read(nbytes)
-            data = pickle.loads(body)
+            data = _decode(self.server.parent, codec, body)
+            calls = _batch_calls(data)
+        except ut.ProtocolError as e:
+            e.traceback = ''
+            send((None, e))
+            return False
         except Exception as exc:
-            self._send_output((None, Exception('read_error')))
-            return 
+            send((None, Exception('read_error')))
+            return False
+        if self.server.parent._metrics is not None:
+            send = _measured(self.server.parent, data, body, start, send)
 
-        if isinstance(data, tuple):
-            self._make_blocking_call(data)
-            return 
+        if calls is not None:
+            _serve_batch(
+                self.server.parent, calls, data.get('parallel'), send,
+                _deadline(data), _priority(data), self,
+            )
+        elif isinstance(data, tuple):
+            self._make_blocking_call(data, send, stream, codec)
         elif isinstance(data, dict):
-            self._make_nonblocking_call(data)
+            self._make_nonblocking_call(data, send)
         else:
-            self._send_output((None, Exception('protocol_error')))
+            send((None, Exception('protocol_error')))
+            return False
+        return True
 
-    def _make_blocking_call(self, data):
-        method_name, args, kwargs = data
-        ret, exc = None, None
+    def _make_blocking_call(self, data, send, stream=None,
+                            codec=codecmod.PICKLE):
+        method_name, args, kwargs, *_ = data
+        _serve(
+            self.server.parent, method_name, args, kwargs, send, stream, codec,
+            _deadline(data), _priority(data), self,
+        )
+
+    def _make_nonblocking_call(self, data, send):
+        parent = self.server.parent
+        if data['predicate'] == 'cancel':
+            output = _cancel(parent, data)
+        elif data['predicate'] == 'put':
+            request = data
+            _store(parent, request)
+            try:
+                if not _join_job(parent, request):
+                    parent._workers.submit(
+                        _run_nonblocking, parent, request,
+                        key=request['method_name'],
+                        priority=_priority(request), flow=self,
+                    )
+                output = _put_reply(parent)
+            except ut.Overloaded as e:
+                e.traceback = ''
+                _complete(parent, request, None, e)
+                output = None, e
+        else: # get
+            wait = _wait_time(parent, data)
+            if wait:
+                event = threading.Event()
+                if _when_ready(parent, data, event.set):
+                    event.wait(wait)
+                    _forget_callback(parent, data, event.set)
+            output = _fetch_result(parent, data)
+
+        send(output)
+
+
+class _Stream:
+    '''The server side of a streamed call. A client that takes no item for
+    `timeout` seconds is given up on, the worker freed.'''
+    def __init__(self, send_item, timeout=None):
+        self._send_item = send_item
+        self._timeout = timeout
+        self._cond = threading.Condition()
+        self._credit = 0
+        self._cancelled = False
+
+    def grant(self, n):
+        with self._cond:
+            self._credit += n
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify()
+
+    def run(self, parent, result):
+        '''Sends the items of the result, returns (None, exc) to respond
+        with.'''
+        items = None
         try:
-            method = getattr(self.server.parent.callee, method_name)
-            ret = method(*args, **kwargs)
+            items = iter(result)
+            while self._acquire():
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                self._send_item(item)
         except Exception as e:
-            if self.server.parent.retype_exceptions:
-                e2 = Exception(*e.args)
-                e2.className = type(e).__name__
-                e = e2
-            e.traceback = traceback.format_exc()
-            exc = e
+            return None, _exception(parent, e)
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+        return None, None
+
+    def _acquire(self):
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._credit or self._cancelled, self._timeout
+            ):
+                raise ut.Timeout(
+                    'no item taken for {} s'.format(self._timeout)
+                )
+            self._credit -= 1
+            return not self._cancelled
+
+
+def _run_nonblocking(parent, request):
+    ret, exc = _call(
+        parent,
+        request['method_name'],
+        request['args'],
+        request['kwargs'],
+        job=request,
+    )
+    _complete(parent, request, ret, exc)
+
+
+def _store(parent, request):
+    parent._jobs.add(request)
+    if request.get('subscriber') is not None:
+        with _done_lock:
+            subscription = parent._subscriptions.setdefault(
+                request['subscriber'], _Subscription()
+            )
+            subscription.pending.add(request['id'])
+
+
+def _put_reply(parent):
+    '''Tells the client where the job is and that gets may wait for it.'''
+    return {
+        'worker': _worker_index(parent),
+        'wait': True,
+    }
+
+
+def _complete(parent, request, ret, exc):
+    '''Stores the outcome of a nonblocking job and wakes up the gets
+    waiting for it. So do the jobs that joined it.'''
+    flight = request.pop('flight', None)
+    if flight is not None:
+        for waiter in parent._flights.land(flight):
+            _complete(parent, waiter, ret, exc)
+    ret = parent._jobs.keep(request, ret)
+    with _done_lock:
+        request['ret'] = ret
+        request['exc'] = exc
+        request['status'] = 1
+        callbacks = request.pop('callbacks', [])
+        subscription = parent._subscriptions.get(request.get('subscriber'))
+        if subscription is not None and request['id'] in subscription.pending:
+            subscription.pending.discard(request['id'])
+            subscription.done.append(request['id'])
+            callbacks += subscription.callbacks
+            subscription.callbacks = []
+    for callback in callbacks:
+        callback()
+
+
+def _join_job(parent, request):
+    '''For a job of a coalesced method equal to one in progress: makes it
+    complete with that one and returns True.'''
+    method_name = request['method_name']
+    if parent._flights is None or method_name not in parent.coalesced_methods:
+        return False
+    key = cachemod.call_key(method_name, request['args'], request['kwargs'])
+    if key is None:
+        return False
+    if parent._flights.join(key, request):
+        request['flight'] = key
+        return False
+    return True
+
+
+def _wait_time(parent, data):
+    '''How long a get may wait here for a result, 0 if it is for a job
+    in another worker.'''
+    if 'subscriber' in data:
+        if data.get('worker') not in (None, _worker_index(parent)):
+            return 0
+    elif data['id'] not in parent._jobs:
+        return 0
+    return min(data.get('wait') or 0, parent.nb_max_wait)
+
+
+def _when_ready(parent, data, callback):
+    '''Arranges for callback() to be called once the get has a result to
+    return. Returns False instead if it has one already.'''
+    with _done_lock:
+        if 'subscriber' in data:
+            waitable = parent._subscriptions.setdefault(
+                data['subscriber'], _Subscription()
+            )
+            if waitable.done:
+                return False
+            waitable.callbacks.append(callback)
+            return True
+        request = parent._jobs.get(data['id'])
+        if request is None or request['status'] == 1:
+            return False
+        request.setdefault('callbacks', []).append(callback)
+        return True
+
+
+def _forget_callback(parent, data, callback):
+    with _done_lock:
+        if 'subscriber' in data:
+            callbacks = getattr(
+                parent._subscriptions.get(data['subscriber']), 'callbacks', []
+            )
+        else:
+            callbacks = parent._jobs.get(data['id'], {}).get(
+                'callbacks', []
+            )
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+
+class _Subscription:
+    '''The nonblocking jobs put with a `subscriber`, a get with it returns
+    the outcomes of those done.'''
+    def __init__(self):
+        self.pending = set()
+        self.done = []
+        self.callbacks = []
+
+
+def _forget_jobs(parent, ids):
+    '''Drops expired jobs from the subscriptions.'''
+    ids = set(ids)
+    with _done_lock:
+        for token, subscription in list(parent._subscriptions.items()):
+            subscription.pending.difference_update(ids)
+            subscription.done = [
+                id_ for id_ in subscription.done if id_ not in ids
+            ]
+            if not (subscription.pending or subscription.done or
+                    subscription.callbacks):
+                del parent._subscriptions[token]
+
+
+def _worker_index(parent):
+    return parent._prefork and parent._prefork.index
+
+
+_done_lock = threading.Lock()
 
-        self._send_output((ret, exc))
 
+def _serve(parent, method_name, args, kwargs, send, stream=None,
+           codec=codecmod.PICKLE, deadline=None, priority=None, flow=None):
+    '''Runs the call once a worker is free, then sends and logs (ret, exc).
+    Past the `deadline`, the call is not run and its result not encoded.
+    `priority` and `flow` (the connection) schedule it, see `WorkerPool`.'''
+    if stream is None:
+        send = _cached(parent, codec, method_name, args, kwargs, send)
+        if send is not None:
+            send = _coalesced(parent, codec, method_name, args, kwargs, send)
+        if send is None:
+            return
+    if parent.synchronous:
+        _serve_call(parent, method_name, args, kwargs, send, stream, deadline)
+        return
+    try:
+        parent._workers.submit(
+            _serve_call, parent, method_name, args, kwargs, send, stream,
+            deadline, key=method_name, inline=True, priority=priority,
+            flow=flow,
+        )
+    except ut.Overloaded as e:
+        e.traceback = ''
+        try:
+            send((None, e))
+        finally:
+            parent.log_exception(e, method_name, args, kwargs)
+
+
+def _serve_call(parent, method_name, args, kwargs, send, stream=None,
+                deadline=None):
+    ret, exc = _call(
+        parent, method_name, args, kwargs, stream is None, deadline
+    )
+    if stream is not None and exc is None:
+        ret, exc = stream.run(parent, ret)
+    elif exc is None and _expired(deadline):
+        # nobody reads the result, it is not worth encoding
+        ret, exc = _expired_output('deadline passed while the call ran')
+    try:
+        send((ret, exc))
+    finally:
         if exc is not None:
-            self.server.parent.log_exception(exc, method_name, args, kwargs)
+            parent.log_exception(exc, method_name, args, kwargs)
         else:
-            self.server.parent.log_call(ret, method_name, args, kwargs)
+            parent.log_call(ret, method_name, args, kwargs)
 
-    def _make_nonblocking_call(self, data):
-        if data['predicate'] == 'put':
-            request = data
-            self.server.parent._id_request[request['id']] = request
-            _NbCall(self.server.parent, request).start()
-            output = None
-        else: # get
-            request = self.server.parent._id_request[data['id']]
-            if request['status'] == 1:
-                ret = request['ret']
-                exc = request['exc']
-                output = ret, exc
-                if exc is not None:
-                    self.server.parent.log_exception(
-                        exc, 
-                        request['method_name'], 
-                        request['args'], 
-                        request['kwargs'],
-                    )
-                else:
-                    self.server.parent.log_call(
-                        ret, 
-                        request['method_name'], 
-                        request['args'], 
-                        request['kwargs'],
-                    )
+
+def _cached(parent, codec, method_name, args, kwargs, send):
+    '''Answers a call of a cached method from the cache and returns None, or
+    returns the send() of the call, caching the response.'''
+    cache = parent._cache
+    key = None if cache is None else cache.key(
+        codec, method_name, args, kwargs
+    )
+    if key is None:
+        return send
+    hit = cache.get(key)
+    if hit is not None:
+        ret, parts = hit
+        try:
+            send(_Encoded((ret, None), parts))
+        finally:
+            parent.log_call(ret, method_name, args, kwargs)
+        return None
+    def send_caching(output):
+        ret, exc = output.output if type(output) is _Encoded else output
+        if exc is None:
+            output = _encode(codec, output)
+            if type(output) is _Encoded:
+                cache.put(key, ret, output.parts)
+        send(output)
+    return send_caching
+
+
+def _coalesced(parent, codec, method_name, args, kwargs, send):
+    '''For a call of a coalesced method equal to one in progress: leaves
+    the response to that one and returns None. Otherwise returns the send()
+    of the call, which also answers the equal calls made meanwhile.'''
+    if parent._flights is None or method_name not in parent.coalesced_methods:
+        return send
+    key = cachemod.call_key(method_name, args, kwargs, codec)
+    if key is None:
+        return send
+    if not parent._flights.join(key, send):
+        return None
+    def send_all(output):
+        waiters = parent._flights.land(key)
+        if waiters:
+            # encoded once for all
+            output = _encode(codec, output)
+        try:
+            send(output)
+        finally:
+            for waiter in waiters:
+                _send_logged(
+                    parent, waiter, output, method_name, args, kwargs
+                )
+    return send_all
+
+
+def _send_logged(parent, send, output, method_name, args, kwargs):
+    try:
+        send(output)
+    finally:
+        ret, exc = output.output if type(output) is _Encoded else output
+        if exc is not None:
+            parent.log_exception(exc, method_name, args, kwargs)
+        else:
+            parent.log_call(ret, method_name, args, kwargs)
+
+
+def _encode(codec, output):
+    '''Returns the output as `_Encoded`, as it is if the codec fails on it
+    (it fails again when sent).'''
+    if type(output) is _Encoded:
+        return output
+    try:
+        return _Encoded(output, codec.dumps(output))
+    except Exception:
+        return output
+
+
+class _Encoded:
+    '''An output with its parts encoded already, see `codec`. `frame` is
+    (compressor, parts, flags) of the frame they are sent in, if made.'''
+    __slots__ = ('output', 'parts', 'frame')
+
+    def __init__(self, output, parts, frame=None):
+        self.output = output
+        self.parts = parts
+        self.frame = frame
+
+
+def _decode(parent, codec, body):
+    '''Returns the request, raises `ut.ProtocolError` if the server doesn't
+    take its codec. A method id in a call is replaced by its name.'''
+    if parent.codecs is not None and codec.name not in parent.codecs:
+        raise ut.ProtocolError('codec {} not accepted'.format(codec.name))
+    data = codec.loads(body)
+    if type(data) is tuple and data and type(data[0]) is int:
+        names = _method_names(parent)
+        if not 0 <= data[0] < len(names):
+            raise ut.ProtocolError('no method id {}'.format(data[0]))
+        data = (names[data[0]],) + data[1:]
+    return data
+
+
+def _batch_calls(data):
+    '''Returns the calls of a batch request, None for other requests.'''
+    if not isinstance(data, dict) or data.get('predicate') != 'batch':
+        return None
+    return [
+        (method_name, args, kwargs)
+        for method_name, args, kwargs in data['calls']
+    ]
+
+
+def _serve_batch(parent, calls, parallel, send, deadline=None, priority=None,
+                 flow=None):
+    '''Runs the calls of a batch one after another in a worker or, with
+    `parallel`, each in a worker of its own. Then sends the list of their
+    (ret, exc) and logs each call. Calls not started by the `deadline` are
+    not run. The batch is scheduled like a call, see `_serve()`.'''
+    if parallel and calls and not parent.synchronous:
+        results = [None] * len(calls)
+        left = [len(calls)]
+        lock = threading.Lock()
+        def done(i, output):
+            results[i] = output
+            with lock:
+                left[0] -= 1
+                if left[0]:
+                    return
+            _send_batch(parent, calls, results, send)
+        def run(i, method_name, args, kwargs):
+            done(i, _call(parent, method_name, args, kwargs, True, deadline))
+        for i, (method_name, args, kwargs) in enumerate(calls):
+            try:
+                parent._workers.submit(
+                    run, i, method_name, args, kwargs,
+                    key=method_name, inline=i == len(calls)-1,
+                    priority=priority, flow=flow,
+                )
+            except ut.Overloaded as e:
+                e.traceback = ''
+                done(i, (None, e))
+        return
+    def run():
+        results = [
+            _call_counted(parent, *call, deadline=deadline) for call in calls
+        ]
+        _send_batch(parent, calls, results, send)
+    if parent.synchronous:
+        run()
+        return
+    if priority is None and calls:
+        # in the class of its first call
+        priority = (parent.method_priorities or {}).get(calls[0][0])
+    try:
+        parent._workers.submit(
+            run, inline=True, priority=priority, flow=flow
+        )
+    except ut.Overloaded as e:
+        e.traceback = ''
+        send((None, e))
+
+
+def _send_batch(parent, calls, results, send):
+    try:
+        send((results, None))
+    finally:
+        for (method_name, args, kwargs), (ret, exc) in zip(calls, results):
+            if exc is not None:
+                parent.log_exception(exc, method_name, args, kwargs)
             else:
-                output = None
+                parent.log_call(ret, method_name, args, kwargs)
 
-        self._send_output(output)
 
-    def _send_output(self, output):
+def _call_counted(parent, method_name, args, kwargs, deadline=None):
+    '''_call() counted against `Server.method_limits`, for a call run in a
+    worker taken by another job.'''
+    try:
+        parent._workers.enter(method_name)
+    except ut.Overloaded as e:
+        e.traceback = ''
+        return None, e
+    try:
+        return _call(parent, method_name, args, kwargs, True, deadline)
+    finally:
+        parent._workers.leave(method_name)
+
+
+def _call(parent, method_name, args, kwargs, materialize=True,
+          deadline=None, job=None):
+    '''With `materialize`, a generator returned is turned into a list. A
+    call with a `deadline` passed already or of a `job` cancelled is not
+    run, the method sees it as `pyrpc.current_call()` otherwise.'''
+    token = None
+    if deadline is not None or job is not None:
+        if _expired(deadline):
+            return _expired_output('deadline passed before the call ran')
+        if job is not None and job.get('cancelled'):
+            return _cancelled_output()
+        token = contextmod.enter(deadline, job)
+    ret, exc = None, None
+    start = time.perf_counter()
+    try:
+        method = _method(parent, method_name)
+        ret = method(*args, **kwargs)
+        if materialize and isinstance(ret, types.GeneratorType):
+            ret = list(ret)
+    except Exception as e:
+        ret, exc = None, _exception(parent, e)
+    finally:
+        if token is not None:
+            contextmod.leave(token)
+    if parent._metrics is not None:
+        parent._metrics.add(
+            method_name, 'execute', time.perf_counter()-start, exc is not None
+        )
+    return ret, exc
+
+
+def _method(parent, method_name):
+    '''The method of the callee or, if it has none, a method every server
+    answers. Only those of `Server.exposed_methods` if it is set.'''
+    exposed = parent._exposed
+    if exposed is not None and method_name not in exposed:
+        raise AttributeError('method {} is not exposed'.format(method_name))
+    try:
+        return getattr(parent.callee, method_name)
+    except AttributeError:
+        if method_name in _SERVER_METHODS:
+            return getattr(parent, method_name)
+        raise
+
+
+_SERVER_METHODS = ('connected', 'stats')
+
+
+def _method_names(parent):
+    '''Returns the names of the methods clients may call by id, the id of
+    each being its index. Listed on the first connection of the process, a
+    method added later is called by name. Calls by id look the method up
+    by name too, so a method replaced on the callee is the one called.'''
+    names = parent._method_names
+    if names is None:
+        with _table_lock:
+            if parent._method_names is None:
+                parent._method_names = _list_methods(parent)
+            names = parent._method_names
+    return names
+
+
+_table_lock = threading.Lock()
+
+
+def _list_methods(parent):
+    if parent.exposed_methods is not None:
+        names = list(parent.exposed_methods)
+    else:
+        names = [name for name in dir(parent.callee) if name[:1] != '_']
+    names += [name for name in _SERVER_METHODS if name not in names]
+    methods = []
+    for name in names:
         try:
-            msg = pickle.dumps(output)
-            msg = len(msg).to_bytes(4, 'big') + msg
-            self.request.sendall(msg)
-        except BrokenPipeError:
+            if callable(_method(parent, name)):
+                methods.append(name)
+        except Exception:
             pass
+    return methods
+
+
+def _deadline(data):
+    '''Returns the deadline (time.monotonic()) of a call or a batch
+    received now, None if the client sent none.'''
+    if isinstance(data, dict):
+        timeout = data.get('timeout') if data.get('predicate') == 'batch' \
+            else None
+    else:
+        timeout = data[3] if len(data) > 3 else None
+    if type(timeout) not in (int, float):
+        return None
+    return time.monotonic() + timeout
+
+
+def _priority(data):
+    '''Returns the priority class a call, batch or nonblocking job names,
+    None if it names none.'''
+    if isinstance(data, dict):
+        priority = data.get('priority')
+    else:
+        priority = data[4] if len(data) > 4 else None
+    return priority if type(priority) is str else None
+
+
+def _expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
 
 
-class _NbCall(threading.Thread):
-    daemon = True
-    
-    def __init__(self, parent, request):
-        self._parent = parent
-        self._request = request
-        super().__init__()
+def _expired_output(msg):
+    e = ut.Expired(msg)
+    e.traceback = ''
+    return None, e
 
-    def run(self):
-        ret, exc = None, None
+
+def _cancelled_output():
+    e = ut.Cancelled('job cancelled before it ran')
+    e.traceback = ''
+    return None, e
+
+
+def _measured(parent, data, body, start, send):
+    '''Returns the send() of a request recording it in the metrics of the
+    server once sent.'''
+    decoded = time.perf_counter()
+    name = _request_name(data)
+    nbytes_in = sum(memoryview(buf).nbytes for buf in body)
+    parent._metrics.begin(name)
+    def send_measured(output):
+        sending = time.perf_counter()
+        nbytes = 0
         try:
-            method_name = self._request['method_name']
-            args = self._request['args']
-            kwargs = self._request['kwargs']
-            method = getattr(self._parent.callee, method_name)
-            ret = method(*args, **kwargs)
-        except Exception as e:
-            if self._parent.retype_exceptions:
-                e2 = Exception(*e.args)
-                e2.className = type(e).__name__
-                e = e2
-            e.traceback = traceback.format_exc()
-            exc = e
-        self._request['ret'] = ret
-        self._request['exc'] = exc
-        self._request['status'] = 1
+            nbytes = send(output)
+            return nbytes
+        finally:
+            end = time.perf_counter()
+            if type(output) is _Encoded:
+                output = output.output
+            parent._metrics.record(
+                name, end-start,
+                isinstance(output, tuple) and output[1] is not None,
+                (('decode', decoded-start), ('send', end-sending)),
+                nbytes_in, nbytes or 0,
+            )
+    return send_measured
+
+
+def _request_name(data):
+    '''The name of a request in the metrics: the method, batch, nb_method
+    for a nonblocking put, nb_get.'''
+    if isinstance(data, tuple):
+        return str(data[0])
+    if not isinstance(data, dict):
+        return 'unknown'
+    if data.get('predicate') == 'put':
+        return 'nb_' + str(data.get('method_name'))
+    if data.get('predicate') == 'get':
+        return 'nb_get'
+    return str(data.get('predicate'))
+
+
+def _exception(parent, e):
+    '''Prepares an exception raised by a method to be sent to the client.'''
+    if parent.retype_exceptions:
+        e2 = Exception(*e.args)
+        e2.className = type(e).__name__
+        e = e2
+    e.traceback = traceback.format_exc()
+    return e
+
+
+def _fetch_result(parent, data):
+    if 'subscriber' in data:
+        return _fetch_subscribed(parent, data)
+    request = parent._jobs.get(data['id'])
+    if request is None and parent._prefork is not None:
+        if data.get('forwarded'):
+            return {'unknown': True}
+        output = parent._prefork.forward_get(data)
+        if output is not None:
+            return output
+    if request is not None and request['status'] != 1:
+        if 'progress' in request:
+            return {'progress': request['progress']}
+        return None
+    # fetched once
+    if request is None or parent._jobs.pop(data['id']) is None:
+        exc = ut.UnknownJob(
+            'no job {}, expired or fetched already'.format(data['id'])
+        )
+        exc.traceback = ''
+        return None, exc
+    return _output(parent, request)
+
+
+def _cancel(parent, data):
+    '''Cancels the job and drops it, its result is not kept. A job that
+    other equal ones joined still runs for them.'''
+    request = parent._jobs.get(data['id'])
+    if request is None:
+        if parent._prefork is not None and not data.get('forwarded'):
+            output = parent._prefork.forward_get(data)
+            if output is not None:
+                return output
+        return {'unknown': True} if data.get('forwarded') else \
+            {'cancelled': False}
+    flight = request.get('flight')
+    if flight is None or not parent._flights.waiting(flight):
+        request['cancelled'] = True
+    if parent._jobs.pop(data['id']) is not None:
+        _forget_jobs(parent, [data['id']])
+    return {'cancelled': True}
+
+
+def _fetch_subscribed(parent, data):
+    '''Returns {id: (ret, exc)} of the jobs of the subscriber done since
+    the previous get.'''
+    if data.get('worker') not in (None, _worker_index(parent)):
+        if data.get('forwarded'):
+            return {}
+        # None if the worker is gone, its jobs with it
+        return parent._prefork.forward_get(data) or {}
+    with _done_lock:
+        subscription = parent._subscriptions.get(data['subscriber'])
+        if subscription is None:
+            return {}
+        ids, subscription.done = subscription.done, []
+        if not subscription.pending and not subscription.callbacks:
+            del parent._subscriptions[data['subscriber']]
+    outputs = {}
+    for id_ in ids:
+        request = parent._jobs.pop(id_)
+        if request is not None:
+            outputs[id_] = _output(parent, request)
+    return outputs
+
+
+def _output(parent, request):
+    try:
+        ret = jobs.result(request)
+    except Exception as e:
+        return None, _exception(parent, e)
+    exc = request['exc']
+    if exc is not None:
+        parent.log_exception(
+            exc,
+            request['method_name'],
+            request['args'],
+            request['kwargs'],
+        )
+    else:
+        parent.log_call(
+            ret,
+            request['method_name'],
+            request['args'],
+            request['kwargs'],
+        )
+    return ret, exc
@@ -0,0 +1,121 @@
+import threading
+import itertools
+import tempfile
+import heapq
+import mmap
+import time
+
+from . import protocol
+
+
+class JobStore:
+    '''The nonblocking jobs of a server by id, until their result is fetched
+    or their `due_time` passes.
+
+    Jobs are also kept in a heap ordered by due time, so the expired ones are
+    found without looking at the others. Results are held as they are up to
+    `max_bytes` (the size of their pickles, None - no limit), beyond that
+    they are pickled into temporary files mapped in memory, which the OS can
+    write out and drop.
+    '''
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0 # of the results held as they are
+        self._id_request = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._id_request)
+
+    def __contains__(self, id_):
+        return id_ in self._id_request
+
+    def get(self, id_, default=None):
+        return self._id_request.get(id_, default)
+
+    def add(self, request):
+        with self._cond:
+            self._id_request[request['id']] = request
+            entry = request['due_time'], next(self._seq), request['id']
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+
+    def keep(self, request, ret):
+        '''Returns the result of the job to store in the request.'''
+        if self.max_bytes is None or ret is None:
+            return ret
+        try:
+            parts = protocol.dumps(ret)
+        except Exception:
+            return ret # fails again when sent
+        nbytes = sum(memoryview(buf).nbytes for buf in parts)
+        with self._cond:
+            if self._id_request.get(request['id']) is not request:
+                return ret # expired meanwhile
+            if self.nbytes+nbytes <= self.max_bytes:
+                self.nbytes += nbytes
+                request['nbytes'] = nbytes
+                return ret
+        return _Spilled(parts)
+
+    def pop(self, id_):
+        with self._cond:
+            request = self._id_request.pop(id_, None)
+            if request is not None:
+                self.nbytes -= request.pop('nbytes', 0)
+        return request
+
+    def expire(self, timeout):
+        '''Drops the jobs past their due time, cancelled, waiting up to
+        `timeout` seconds for the first one. Returns their ids.'''
+        ids = []
+        with self._cond:
+            if not self._heap or self._heap[0][0] > time.time():
+                due = self._heap[0][0] if self._heap else float('inf')
+                self._cond.wait(max(0, min(timeout, due-time.time())))
+            t = time.time()
+            while self._heap and self._heap[0][0] <= t:
+                due_time, _, id_ = heapq.heappop(self._heap)
+                request = self._id_request.get(id_)
+                # gone or put again with another due time
+                if request is None or request['due_time'] != due_time:
+                    continue
+                del self._id_request[id_]
+                self.nbytes -= request.pop('nbytes', 0)
+                # a method still running sees nobody waits for it
+                request['cancelled'] = True
+                ids.append(id_)
+        return ids
+
+
+def result(request):
+    '''The result of a done job.'''
+    ret = request['ret']
+    if isinstance(ret, _Spilled):
+        return ret.load()
+    return ret
+
+
+class _Spilled:
+    '''A result pickled into a temporary file, mapped in memory.'''
+    def __init__(self, parts):
+        self._sizes = [memoryview(buf).nbytes for buf in parts]
+        with tempfile.TemporaryFile() as f:
+            for buf in parts:
+                f.write(buf)
+            f.flush()
+            self._map = mmap.mmap(
+                f.fileno(), sum(self._sizes), access=mmap.ACCESS_READ
+            )
+
+    def load(self):
+        view = memoryview(self._map)
+        parts = []
+        offset = 0
+        for size in self._sizes:
+            parts.append(view[offset:offset+size])
+            offset += size
+        return protocol.loads(parts)
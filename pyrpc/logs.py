@@ -0,0 +1,145 @@
+'''Bounded reprs and a background writer of log records.
+
+A record is a logging function and the format function and arguments of its
+message. `submit()` queues it, a daemon thread formats and writes it, so the
+calls never wait for either. Records beyond `MAX_QUEUED` waiting are dropped
+and counted in the next message written.
+'''
+import threading
+import reprlib
+import atexit
+import queue
+import os
+
+MAX_QUEUED = 10000
+
+
+class _Repr(reprlib.Repr):
+    '''Slices sequences of bytes before taking their reprs, `reprlib` would
+    take the full repr of them first.'''
+    def __init__(self, limit):
+        super().__init__()
+        self.maxstring = self.maxother = limit
+        self.maxlist = self.maxtuple = self.maxdict = self.maxset = 8
+        self.maxlevel = 4
+
+    def repr1(self, obj, level):
+        if isinstance(obj, BaseException):
+            # the repr of an exception is that of all its args
+            return '{}({})'.format(type(obj).__name__, ', '.join(
+                self.repr1(arg, level-1) for arg in obj.args[:self.maxtuple]
+            ))
+        return super().repr1(obj, level)
+
+    def repr_bytes(self, obj, level):
+        return self._sliced(obj, repr(bytes(obj[:self.maxstring])))
+
+    def repr_bytearray(self, obj, level):
+        return self._sliced(obj, repr(obj[:self.maxstring]))
+
+    def repr_memoryview(self, obj, level):
+        return '<memoryview of {} bytes>'.format(obj.nbytes)
+
+    def _sliced(self, obj, s):
+        if len(obj) <= self.maxstring:
+            return s
+        return s[:self.maxstring] + '...'
+
+
+_repr = _Repr(60)
+
+
+def short_repr(obj):
+    '''Returns the repr of the object, at most a few hundred characters long
+    whatever its size.'''
+    return _repr.repr(obj)
+
+
+def short_lines(text, limit=200):
+    '''Returns the text with lines cut to `limit` characters.'''
+    return '\n'.join(
+        line if len(line) <= limit else line[:limit] + '...'
+        for line in text.split('\n')
+    )
+
+
+def call_msg(method_name, args, kwargs, outcome):
+    '''Returns `method(args=..., kwargs=...) -> outcome`, 120 characters at
+    most.'''
+    prefix = '{}(args={}, kwargs={})'.format(
+        method_name, short_repr(args), short_repr(kwargs)
+    )
+    if len(prefix) > 60:
+        prefix = prefix[:60] + '...)'
+    return prefix + ' -> {}'.format(short_repr(outcome))[:120-len(prefix)]
+
+
+def submit(log, format_, *args):
+    '''Has `log(format_(*args))` called on the writer thread.'''
+    writer = _writer
+    if writer is None or writer.pid != os.getpid():
+        writer = _start()
+    writer.submit(log, format_, args)
+
+
+def flush(timeout=None):
+    '''Waits for the records submitted so far to be written.'''
+    writer = _writer
+    if writer is not None and writer.pid == os.getpid():
+        writer.flush(timeout)
+
+
+class _Writer:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.dropped = 0
+        self._queue = queue.Queue(MAX_QUEUED)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, log, format_, args):
+        try:
+            self._queue.put_nowait((log, format_, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        try:
+            self._queue.put((done.set, None, ()), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            log, format_, args = self._queue.get()
+            try:
+                if format_ is None:
+                    log()
+                    continue
+                msg = format_(*args)
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    msg = '({} log records dropped) {}'.format(dropped, msg)
+                log(msg)
+            except Exception:
+                pass
+            finally:
+                # not holding results until the next record
+                log = args = None
+
+
+_writer = None
+_lock = threading.Lock()
+
+
+def _start():
+    global _writer
+    with _lock:
+        if _writer is None or _writer.pid != os.getpid():
+            # forked: the thread of the parent is gone
+            _writer = _Writer()
+        return _writer
+
+
+atexit.register(flush, 1)
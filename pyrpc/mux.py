@@ -0,0 +1,271 @@
+import itertools
+import threading
+import select
+import queue
+import socket
+import time
+import os
+
+from . import protocol
+from . import ut
+
+
+class MuxConnection:
+    '''A protocol 2 connection shared by concurrent calls.
+
+    Requests are tagged with ids; a reader thread hands each response to
+    the caller waiting for that id. A call that times out only stops waiting,
+    the connection stays usable. A call found unsent when the connection
+    is closed (by the server while idle, for instance) raises `Unsent`: the
+    server did not get it whole, it can be made again on a new connection.
+    '''
+    def __init__(self, sock, version=2, shm_threshold=None, peer_shm=False,
+                 methods=None):
+        self._sock = sock
+        self.version = version
+        self.methods = methods or {} # {method_name: id} over protocol 8
+        self._shm_threshold = shm_threshold
+        self._peer_shm = peer_shm
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._id_waiter = {}
+        self._ids = itertools.count(1)
+        self.closed = False
+        self.last_used = time.time()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    @property
+    def inflight(self):
+        return len(self._id_waiter)
+
+    def call(self, parts, timeout, flags=0, laps=None, race=None):
+        '''Returns the response parts, see `protocol.dumps()`. Marks the
+        send of the call in `laps`, see `metrics.Laps`. The wait ends once
+        the `retry.Race` the call is in ends.'''
+        waiter = _Waiter()
+        if race is not None:
+            race.add(waiter)
+        with self._lock:
+            if self.closed:
+                raise Unsent('closed')
+            idle = not self._id_waiter
+            id_ = next(self._ids) & 0xffffffff
+            self._id_waiter[id_] = waiter
+        try:
+            if idle:
+                self._check_peer()
+            self._send_parts(id_, protocol.REQUEST, parts, timeout, flags)
+            if laps is not None:
+                laps.lap('send')
+            if not waiter.event.wait(timeout):
+                raise ut.Timeout('wait')
+        finally:
+            with self._lock:
+                self._id_waiter.pop(id_, None)
+                self.last_used = time.time()
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.parts
+
+    def open_stream(self, parts, window, timeout, flags=0):
+        '''Sends a streamed call granting `window` items. Returns its id and
+        a queue getting (kind, parts) of the frames received for it, or
+        (None, exception) if the connection is lost.'''
+        waiter = _StreamWaiter()
+        with self._lock:
+            if self.closed:
+                raise Unsent('closed')
+            idle = not self._id_waiter
+            id_ = next(self._ids) & 0xffffffff
+            self._id_waiter[id_] = waiter
+        try:
+            if idle:
+                self._check_peer()
+            self._send(
+                protocol.pack(
+                    id_, protocol.REQUEST, parts, protocol.STREAM | flags
+                ) +
+                _credit_frame(id_, window),
+                timeout,
+            )
+        except Exception:
+            self.close_stream(id_)
+            raise
+        return id_, waiter.queue
+
+    def grant(self, id_, n, timeout):
+        self._send(_credit_frame(id_, n), timeout)
+
+    def close_stream(self, id_, cancel=False):
+        with self._lock:
+            self._id_waiter.pop(id_, None)
+            self.last_used = time.time()
+        if cancel and not self.closed:
+            try:
+                self._send(
+                    protocol.pack(id_, protocol.CANCEL, [b'']),
+                    self._sock.gettimeout(),
+                )
+            except Exception:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            waiters = list(self._id_waiter.values())
+            self._id_waiter.clear()
+        for waiter in waiters:
+            waiter.fail(ut.ProtocolError('connection closed'))
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    def _send_parts(self, id_, kind, parts, timeout, flags=0):
+        if not protocol.use_shm(self._peer_shm, parts, self._shm_threshold):
+            self._send(protocol.pack(id_, kind, parts, flags), timeout)
+            return
+        frame, fd = protocol.pack_shm(id_, kind, parts, flags)
+        try:
+            self._send(frame, timeout, fd)
+        finally:
+            os.close(fd)
+
+    def _send(self, frame, timeout, fd=None):
+        if not self._send_lock.acquire(timeout=timeout):
+            raise ut.Timeout('send')
+        try:
+            protocol.sendall(self._sock, frame, fd)
+        except ConnectionError:
+            # closed by the peer, the frame did not reach it whole
+            self.close()
+            raise Unsent('send')
+        except Exception:
+            # a partially sent frame leaves the stream unusable
+            self.close()
+            raise ut.Timeout('send')
+        finally:
+            self._send_lock.release()
+
+    def _check_peer(self):
+        '''Raises `Unsent` if the peer closed the connection, its end of file
+        not read yet. Only meaningful while no response is expected.'''
+        try:
+            # recv() of a socket with a timeout would wait for data
+            if not select.select([self._sock], [], [], 0)[0]:
+                return
+            eof = self._sock.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            eof = True
+        if eof:
+            self.close()
+            raise Unsent('closed')
+
+    def _read_loop(self):
+        fds = [] if self._sock.family == socket.AF_UNIX else None
+        try:
+            while True:
+                id_, kind, flags, nbytes = protocol.HEADER.unpack(
+                    self._recv(protocol.HEADER.size, fds)
+                )
+                parts = protocol.read_body(self._recv, flags, nbytes, fds)
+                if flags & protocol.COMPRESSED:
+                    parts = protocol.decompress(parts, flags)[1]
+                with self._lock:
+                    waiter = self._id_waiter.get(id_)
+                if waiter is not None:
+                    waiter.put(kind, parts)
+        except Exception:
+            pass
+        finally:
+            self.close()
+
+    def _recv(self, n, fds=None):
+        # the socket timeout is there for sends, the reader just waits on
+        buf = bytearray(n)
+        view = memoryview(buf)
+        received = 0
+        while received < n:
+            try:
+                if fds is None:
+                    nread = self._sock.recv_into(view[received:])
+                else:
+                    nread = protocol.recv_fds(self._sock, view[received:], fds)
+            except socket.timeout:
+                if self.closed:
+                    raise
+                continue
+            if not nread:
+                raise ut.ProtocolError('eof')
+            received += nread
+        return buf
+
+
+class Unsent(ut.ProtocolError):
+    '''The call was not sent, the connection being closed.'''
+
+
+class _Waiter:
+    __slots__ = ('event', 'parts', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.parts = None
+        self.error = None
+
+    def put(self, kind, parts):
+        self.parts = parts
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+
+class _StreamWaiter:
+    __slots__ = ('queue',)
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+
+    def put(self, kind, parts):
+        self.queue.put((kind, parts))
+
+    def fail(self, error):
+        self.queue.put((None, error))
+
+
+def _credit_frame(id_, n):
+    return protocol.pack(id_, protocol.CREDIT, [n.to_bytes(8, 'big')])
+
+
+def connect(address, connect_timeout, send_timeout, version=protocol.VERSION,
+            shm_threshold=None):
+    '''Returns a MuxConnection or None if the server speaks only the legacy
+    protocol.'''
+    sock = ut.stream_socket(address)
+    try:
+        sock.settimeout(connect_timeout)
+        try:
+            sock.connect(address)
+        except Exception:
+            raise ut.NoSocket('connect {!r}'.format(address))
+        try:
+            version, peer_shm, methods = protocol.handshake(
+                sock, version, protocol.features(sock)
+            )
+        except Exception:
+            # the call was not sent, it can go to another address
+            raise ut.NoSocket('handshake {!r}'.format(address))
+        if version < 2:
+            sock.close()
+            return None
+    except Exception:
+        sock.close()
+        raise
+    protocol.nodelay(sock)
+    sock.settimeout(send_timeout)
+    return MuxConnection(sock, version, shm_threshold, peer_shm, methods)
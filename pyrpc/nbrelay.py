@@ -1,3 +1,6 @@
+from concurrent.futures import Future
+import concurrent.futures
+import threading
 import time
 import uuid
 
@@ -6,22 +9,49 @@ from . import ut
 
 
 class NbRelay:
+    '''Puts the call as a job on the server, then gets its result.
+
+    A get waits on the server until the job is done, for `nb_fetch_wait`
+    seconds at most. With `nb_subscribe`, the results of the nb_ calls of
+    the client come through the gets of `Subscriber`s instead, one at a time
+    per server process. Servers not waiting for jobs are polled every
+    `nb_fetch_tick` seconds.
+
+    A call given up on (timed out) cancels its job on the server. With
+    `nb_progress=func`, the job is polled every `nb_fetch_tick` seconds
+    at least and func is called with each new progress it reports, see
+    `CallContext.report()`.
+    '''
+    _make_balanced_call = Relay._make_balanced_call
     _make_call = Relay._make_call
+    _get_mux = Relay._get_mux
+    _call_mux = Relay._call_mux
+    _encode = Relay._encode
+    _sends_deadline = False # jobs run until their due time
+    _hedge_race = None
+    _request = Relay._request
     _connect = Relay._connect
+    _release = Relay._release
     _read_header = Relay._read_header
+    _check_stale = Relay._check_stale
     _read = Relay._read
     _error_msg = Relay._error_msg
+    _record = Relay._record
 
     def __init__(self, client, method_name):
         self._client = client
         self._method_name = method_name
+        self._pinned = None
 
     def __call__(self, *args, **kwargs):
         kwargs = self._consume_kwargs(kwargs)
         callmsg = self._method_name, args, kwargs
+        start_time = time.time()
+        if self._client._metrics is not None:
+            self._client._metrics.begin(self._method_name)
 
         request = {
-            'id':uuid.uuid4(),
+            'id':uuid.uuid4().hex,
             'due_time':time.time()+self._general_timeout+max(10, 2*self._nb_fetch_tick),
             'predicate':'put',
             'status':0,
@@ -31,41 +61,109 @@ class NbRelay:
             'ret':None,
             'exc':None
         }
+        subscriber = None
+        if self._client.nb_subscribe and self._progress is None:
+            # results may come before the put returns
+            subscriber = self._client._get_subscriber()
+            request['subscriber'] = subscriber.token
+            future = subscriber.expect(request['id'])
         try:
-            self._make_call(request)
+            # the gets go where the job is
+            output = self._make_balanced_call(request)
         except Exception as exc:
-            self._client._handle_exception(callmsg, exc)
-            return 
+            if subscriber is not None:
+                subscriber.forget(request['id'])
+            return self._finish(callmsg, None, exc)
+        if isinstance(output, tuple) and output[1] is not None:
+            # rejected by the server
+            if subscriber is not None:
+                subscriber.forget(request['id'])
+            return self._finish(callmsg, None, output[1])
 
         request2 = {
             'id':request['id'],
             'predicate':'get',
         }
+        wait = False
+        if isinstance(output, dict):
+            # the prefork worker holding the job
+            request2['worker'] = output.get('worker')
+            wait = output.get('wait') and bool(self._nb_fetch_wait)
         ret, exc = None, None
         output = None
-        start_time = time.time()
-        while time.time()-start_time < self._general_timeout:
+        if subscriber is not None and wait:
+            subscriber.watch(
+                request['id'], self._address, request2['worker']
+            )
             try:
-                output = self._make_call(request2)
-                if isinstance(output, tuple) and len(output) == 2:
-                    break
+                output = future.result(
+                    max(0, self._general_timeout-(time.time()-start_time))
+                )
+            except concurrent.futures.TimeoutError:
+                subscriber.forget(request['id'])
             except Exception:
-                pass
-            finally:
-                time.sleep(self._nb_fetch_tick)
+                # the subscriber gave up on the worker
+                output = self._poll(request2, wait, start_time)
+        else:
+            if subscriber is not None:
+                subscriber.forget(request['id'])
+            output = self._poll(request2, wait, start_time)
 
         if output:
             ret, exc = output
         else:
+            self._cancel(request2)
             exc = ut.Timeout('nb')
             exc.traceback = ''
+        return self._finish(callmsg, ret, exc)
 
+    def _finish(self, callmsg, ret, exc):
+        metrics = self._client._metrics
+        if metrics is not None:
+            self._record(metrics, exc)
         if exc is not None:
             self._client._handle_exception(callmsg, exc)
         else:
             self._client.log_call(callmsg, ret)
             return ret
 
+    def _poll(self, request2, wait, start_time):
+        fetch_wait = self._nb_fetch_wait
+        if self._progress is not None:
+            fetch_wait = min(fetch_wait, self._nb_fetch_tick)
+        progress = None
+        while True:
+            left = self._general_timeout-(time.time()-start_time)
+            if left <= 0:
+                return None
+            if wait:
+                request2['wait'] = min(fetch_wait, left)
+                self._timeout = self._nb_fetch_timeout+request2['wait']
+            try:
+                output = self._make_call(request2)
+            except Exception:
+                time.sleep(self._nb_fetch_tick)
+                continue
+            if isinstance(output, tuple) and len(output) == 2:
+                return output
+            if isinstance(output, dict) and self._progress is not None and \
+                    output.get('progress') != progress:
+                progress = output['progress']
+                self._progress(progress)
+            if not wait:
+                time.sleep(self._nb_fetch_tick)
+
+    def _cancel(self, request2):
+        '''Tells the server the job is not waited for anymore, so that its
+        method may stop and its result is not kept.'''
+        data = dict(request2, predicate='cancel')
+        data.pop('wait', None)
+        self._timeout = self._nb_fetch_timeout
+        try:
+            self._make_call(data)
+        except Exception:
+            pass
+
     def _consume_kwargs(self, kwargs):
         kwargs = Relay._consume_kwargs(self, kwargs)
         self._nb_fetch_tick = (
@@ -76,6 +174,99 @@ class NbRelay:
             kwargs.pop('nb_fetch_timeout', None) or
             self._client.nb_fetch_timeout
         )
+        self._nb_fetch_wait = (
+            kwargs.pop('nb_fetch_wait', None) or
+            self._client.nb_fetch_wait
+        )
+        self._progress = kwargs.pop('nb_progress', None)
         self._general_timeout = self._timeout
         self._timeout = self._nb_fetch_timeout
         return kwargs
+
+
+class Subscriber:
+    '''Gets the results of the nb_ calls a client makes with `nb_subscribe`.
+
+    The jobs are put with the token of the subscriber. For each server
+    process holding some, a thread keeps a get with the token waiting there,
+    it returns the results of all the jobs done meanwhile.
+    '''
+    def __init__(self, client):
+        self._client = client
+        self.token = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._id_future = {}
+        self._worker_ids = {}
+
+    def expect(self, id_):
+        '''Returns a future of the output of the job `id_`.'''
+        future = Future()
+        with self._lock:
+            self._id_future[id_] = future
+        return future
+
+    def watch(self, id_, address, worker):
+        '''Gets the output of the job, put to the server process `worker` at
+        the address.'''
+        with self._lock:
+            if id_ not in self._id_future:
+                return
+            ids = self._worker_ids.get((address, worker))
+            if ids is None:
+                ids = self._worker_ids[address, worker] = set()
+                threading.Thread(
+                    target=self._run, args=(address, worker), daemon=True
+                ).start()
+            ids.add(id_)
+
+    def forget(self, id_):
+        with self._lock:
+            self._id_future.pop(id_, None)
+            for ids in self._worker_ids.values():
+                ids.discard(id_)
+
+    def _run(self, address, worker):
+        relay = Relay(self._client, 'nb_subscription', address)
+        client = self._client
+        try:
+            while True:
+                with self._lock:
+                    if not self._worker_ids[address, worker]:
+                        return
+                data = {
+                    'predicate': 'get',
+                    'subscriber': self.token,
+                    'worker': worker,
+                    'wait': client.nb_fetch_wait,
+                }
+                relay._consume_kwargs({
+                    'call_timeout':
+                        client.nb_fetch_timeout+client.nb_fetch_wait,
+                })
+                start = time.time()
+                try:
+                    outputs = relay._make_balanced_call(data)
+                except Exception:
+                    outputs = None
+                if not isinstance(outputs, dict):
+                    # failed, or rejected by the server
+                    time.sleep(client.nb_fetch_tick)
+                    continue
+                for id_, output in outputs.items():
+                    with self._lock:
+                        future = self._id_future.pop(id_, None)
+                        self._worker_ids[address, worker].discard(id_)
+                    if future is not None:
+                        future.set_result(output)
+                if not outputs and time.time()-start < client.nb_fetch_tick:
+                    # not waited on, by a worker started anew for instance
+                    time.sleep(client.nb_fetch_tick)
+        finally:
+            # watch() starts another thread for the worker from now on, the
+            # jobs still expected are polled by their calls
+            with self._lock:
+                ids = self._worker_ids.pop((address, worker), ())
+                futures = [self._id_future.pop(id_, None) for id_ in ids]
+            for future in futures:
+                if future is not None:
+                    future.set_exception(ut.ProtocolError('subscription'))
@@ -0,0 +1,73 @@
+import threading
+import socket
+import time
+import os
+
+
+class ConnectionPool:
+    '''Idle connected sockets kept for reuse, per address.
+
+    Sockets are handed out most recently used first. Sockets idle for longer
+    than `idle_timeout` and sockets closed (or written to) by the peer while
+    idle are dropped on checkout.
+    '''
+    def __init__(self, maxsize=8, idle_timeout=30):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._address_idle = {}
+
+    def get(self, address):
+        while True:
+            with self._lock:
+                self._check_pid()
+                idle = self._address_idle.get(address)
+                if not idle:
+                    return None
+                sock, last_used = idle.pop()
+            if time.time()-last_used > self.idle_timeout or not _alive(sock):
+                sock.close()
+                continue
+            return sock
+
+    def put(self, address, sock):
+        with self._lock:
+            self._check_pid()
+            idle = self._address_idle.setdefault(address, [])
+            t = time.time()
+            while idle and t-idle[0][1] > self.idle_timeout:
+                idle.pop(0)[0].close()
+            if len(idle) < self.maxsize:
+                idle.append((sock, t))
+                return
+        sock.close()
+
+    def clear(self):
+        with self._lock:
+            address_idle, self._address_idle = self._address_idle, {}
+        for idle in address_idle.values():
+            for sock, _ in idle:
+                sock.close()
+
+    def _check_pid(self):
+        # sockets inherited through fork() are shared with the parent
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._address_idle = {}
+
+
+def _alive(sock):
+    '''An idle connection must have nothing to read: readable means either
+    EOF or bytes nobody asked for.'''
+    try:
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        finally:
+            sock.setblocking(True)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return False
@@ -0,0 +1,166 @@
+import traceback
+import threading
+import tempfile
+import signal
+import shutil
+import select
+import pickle
+import socket
+import time
+import os
+
+from . import ut
+
+
+class Prefork:
+    '''Runs `Server.processes` worker processes and restarts the ones that
+    die.
+
+    The workers are forked from the supervisor after the listening socket is
+    bound, so they all accept connections on it, and each builds its own
+    callee (with `Server.callee_type`) and worker pool.
+
+    A connection is served by the worker that accepted it, so the calls of
+    one `Client`, multiplexed over one connection per address, all run in
+    one worker. Load spreads over the workers with the connections of many
+    clients (or processes).
+
+    Nonblocking jobs live in the worker that accepted their `put`. Every
+    worker also listens on a UNIX socket of its own (`peer_address()`), in
+    a directory only the user of the server can access, and a `get`
+    reaching another worker is forwarded there: to the worker named in the
+    `put` reply, or to each worker in turn for clients that don't send it.
+    '''
+    restart_interval = 1 # min seconds between restarts of one worker
+
+    def __init__(self, parent, serve):
+        self.parent = parent
+        self.index = None # of the worker, None in the supervisor
+        self._serve = serve
+        self._supervisor_pid = os.getpid()
+        self._peer_dir = None # of the peer sockets, while running
+        self._pid_index = {}
+        self._index_started = {}
+        self._dead = set()
+        self._control_r, self._control_w = os.pipe()
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+    def run(self):
+        '''Supervises workers until stop() is called.'''
+        self._stopped.clear()
+        if self.parent.nonblocking:
+            self._peer_dir = tempfile.mkdtemp(prefix='pyrpc-')
+        for index in range(self.parent.processes):
+            self._spawn(index)
+        try:
+            while not select.select([self._control_r], [], [], 0.2)[0]:
+                self._restart_dead()
+        finally:
+            self._stop_workers()
+            if self._peer_dir is not None:
+                shutil.rmtree(self._peer_dir, ignore_errors=True)
+                self._peer_dir = None
+            os.read(self._control_r, 4096)
+            self._stopped.set()
+
+    def stop(self, wait=False):
+        '''Can be called from the supervisor or any worker, `wait` for the
+        workers to exit only works in the supervisor.'''
+        os.write(self._control_w, b'\x00')
+        if wait and self.index is None:
+            self._stopped.wait()
+
+    def peer_address(self, index):
+        return os.path.join(self._peer_dir, str(index))
+
+    def forward_get(self, data):
+        '''Returns the output of the worker knowing the job, None if none
+        does.'''
+        data = dict(data, forwarded=True)
+        if data.get('worker') is not None:
+            indexes = [data['worker']] if data['worker'] != self.index else []
+        else:
+            indexes = [
+                i for i in range(self.parent.processes) if i != self.index
+            ]
+        for index in indexes:
+            try:
+                output = _send(self.peer_address(index), data)
+            except Exception:
+                continue
+            if not (isinstance(output, dict) and output.get('unknown')):
+                return output
+        return None
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.index = index
+                threading.Thread(
+                    target=self._watch_supervisor, daemon=True
+                ).start()
+                self.parent._init_worker()
+                self._serve()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self._pid_index[pid] = index
+        self._index_started[index] = time.time()
+
+    def _watch_supervisor(self):
+        # workers don't outlive a supervisor that was killed
+        while os.getppid() == self._supervisor_pid:
+            time.sleep(1)
+        os._exit(1)
+
+    def _restart_dead(self):
+        for pid, index in list(self._pid_index.items()):
+            try:
+                if not os.waitpid(pid, os.WNOHANG)[0]:
+                    continue
+            except ChildProcessError:
+                pass
+            del self._pid_index[pid]
+            self._dead.add(index)
+        t = time.time()
+        for index in list(self._dead):
+            if t-self._index_started[index] >= self.restart_interval:
+                self._dead.discard(index)
+                self._spawn(index)
+
+    def _stop_workers(self):
+        for pid in self._pid_index:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self._pid_index:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._pid_index = {}
+        self._dead = set()
+
+
+def _send(address, data):
+    '''A legacy protocol call with a raw message.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # a get may wait for the job that long
+    sock.settimeout(5 + (data.get('wait') or 0))
+    try:
+        sock.connect(address)
+        msg = pickle.dumps(data)
+        sock.sendall(len(msg).to_bytes(4, 'big') + msg)
+        nbytes = int.from_bytes(ut.readSocket(sock, 4), 'big')
+        body = ut.readSocket(sock, nbytes)
+        if not nbytes or len(body) != nbytes:
+            raise ut.ProtocolError('forward')
+        return pickle.loads(body)
+    finally:
+        sock.close()
@@ -0,0 +1,465 @@
+'''Wire protocol 2: many requests in flight over one connection.
+Protocol 3 adds shared memory frames on UNIX sockets, protocol 4 codecs,
+protocol 5 compression, protocol 6 deadlines, protocol 7 priorities,
+protocol 8 method ids.
+
+handshake: the client sends 4 zero bytes (a legacy frame length is never
+zero) followed by the highest protocol version it speaks (1 byte). The server
+replies with 4 zero bytes and the version to use. If that is 1, the server
+closes the connection and the client falls back to the legacy framing.
+From protocol 4 on, the server then sends a byte of features, and the client
+one of its own: RECV_FDS if the side takes shared memory frames.
+
+frame: header + body
+header: request id(4) + kind(1) + flags(1) + len(body)(8)
+
+A response frame carries the id of its request. Responses are sent as
+methods finish, so they may come in any order.
+
+body: a protocol 5 pickle. With the OOB flag, large buffers the pickle refers
+to (bytes, bytearray, memoryview, numpy arrays...) follow it out of band:
+count(4) + len(buffer)(8) * count + pickle + buffers
+They are sent straight from the objects and received into buffers of their
+own, without copies of the whole message.
+
+streams: a request with the STREAM flag asks for the items of the result.
+The server sends them as ITEM frames while the client grants credit with
+CREDIT frames (body: the number of further items, 8 bytes), then the usual
+response, (None, exc) if the iteration failed. A CANCEL frame makes the
+server stop iterating and respond.
+
+shared memory (protocol 3, UNIX sockets): with the SHM flag, the buffers
+are not in the stream but in a file passed with the frame (SCM_RIGHTS),
+each at an offset aligned to 64 bytes. The body is count(4) +
+len(buffer)(8) * count + pickle. The receiver maps the file, so a buffer
+costs one copy into it. The file has no name, it is gone when the last
+side holding it closes it, crashed or not. On protocol 3 both sides take
+them on UNIX sockets.
+
+codecs (protocol 4): the upper 4 bits of the flags are the id of the codec
+of the body (see `codec`), 0 is the pickle described above. A response is
+encoded with the codec of its request.
+
+compression (protocol 5): with the COMPRESSED flag, the body is the id of
+a compressor (1, see `compression`) followed by the body the frame would
+have without the flag, compressed by it. A request may name its compressor
+with the STORED bit of the id set and the body left as it is, so that its
+response is compressed. The other flags keep their meaning.
+
+deadlines (protocol 6): a call is (method_name, args, kwargs, timeout) and a
+batch has a 'timeout', the seconds the client waits for the response. The
+server counts them from the receipt of the request (so clocks need not
+agree), drops the calls still waiting for a worker past it and doesn't
+encode their results.
+
+priorities (protocol 7): a call may be (method_name, args, kwargs, timeout,
+priority), a batch or a nonblocking put may have a 'priority', the name of
+the class of workers that runs it on the server, see `WorkerPool`.
+
+method ids (protocol 8): the server follows its handshake reply with its
+method table, its length (4 bytes) and the names of the methods clients may
+call joined by newlines. The table holds for the connection. A call may
+name its method by its index in the table (an int) instead.
+'''
+import tempfile
+import pickle
+import socket
+import struct
+import array
+import mmap
+import io
+import os
+
+from . import compression
+from . import ut
+
+VERSION = 8
+HANDSHAKE = b'\x00\x00\x00\x00'
+HEADER = struct.Struct('!IBBQ')
+
+# frame kinds
+REQUEST = 1
+RESPONSE = 2
+ITEM = 3
+CREDIT = 4
+CANCEL = 5
+
+# frame flags
+OOB = 1
+STREAM = 2
+SHM = 4
+COMPRESSED = 8
+CODEC_SHIFT = 4
+
+# compressor id bit
+STORED = 0x80
+
+# features
+RECV_FDS = 1
+
+OOB_THRESHOLD = 2**16 # smaller buffers stay in the pickle
+
+
+def handshake(sock, version=VERSION, features=0):
+    '''Returns the protocol version accepted by the server, whether it
+    takes shared memory frames and {method_name: id} of its methods.'''
+    sock.sendall(HANDSHAKE + bytes([version]))
+    try:
+        reply = read_exactly(sock, len(HANDSHAKE)+1, eof_ok=True)
+    except ConnectionResetError:
+        reply = None
+    if reply is None or reply[:len(HANDSHAKE)] != HANDSHAKE:
+        # legacy server: dropped the connection or answered with a frame
+        return 1, False, {}
+    version = reply[-1]
+    if version < 4:
+        return version, version == 3 and sock.family == socket.AF_UNIX, {}
+    server_features = read_exactly(sock, 1)[0]
+    methods = {}
+    if version >= 8:
+        nbytes = int.from_bytes(read_exactly(sock, 4), 'big')
+        methods = unpack_methods(read_exactly(sock, nbytes))
+    sock.sendall(bytes([features]))
+    return version, bool(server_features & RECV_FDS), methods
+
+
+def pack_methods(names):
+    '''Returns the method table of a handshake.'''
+    body = '\n'.join(names).encode()
+    return len(body).to_bytes(4, 'big') + body
+
+
+def unpack_methods(body):
+    '''Returns {method_name: id} of the body of a method table.'''
+    if not body:
+        return {}
+    return {name: i for i, name in enumerate(bytes(body).decode().split('\n'))}
+
+
+def features(sock):
+    '''The features byte of the handshake for a threaded side.'''
+    return RECV_FDS if sock.family == socket.AF_UNIX else 0
+
+
+def nodelay(sock):
+    '''Small frames of concurrent calls must not wait for each other's acks.'''
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def pack(id_, kind, parts, flags=0):
+    '''Returns the frame as a list of buffers, `parts` are from dumps().'''
+    if len(parts) == 1 and len(parts[0]) < OOB_THRESHOLD:
+        # one write, a small frame must not go out in pieces
+        return [HEADER.pack(id_, kind, flags, len(parts[0])) + parts[0]]
+    flags, parts = _body(parts, flags)
+    nbytes = sum(memoryview(buf).nbytes for buf in parts)
+    return [HEADER.pack(id_, kind, flags, nbytes)] + parts
+
+
+def _body(parts, flags):
+    if len(parts) > 1:
+        flags |= OOB
+        sizes = [memoryview(buf).nbytes for buf in parts[1:]]
+        parts = [
+            len(sizes).to_bytes(4, 'big'),
+            struct.pack('!{}Q'.format(len(sizes)), *sizes),
+        ] + parts
+    return flags, parts
+
+
+def compress(parts, compressor, threshold, flags=0, stored=False):
+    '''Returns the parts and flags of a COMPRESSED frame, pack() takes them.
+    Parts of less than `threshold` bytes are returned as they are or, with
+    `stored`, uncompressed after the id of the compressor.'''
+    body_flags, body = _body(parts, flags)
+    nbytes = sum(memoryview(buf).nbytes for buf in body)
+    if nbytes < threshold:
+        if not stored:
+            return parts, flags
+        data = b''.join([bytes([compressor.id | STORED])] + body)
+    else:
+        data = bytes([compressor.id]) + compressor.compress(body)
+    return [data], body_flags | COMPRESSED
+
+
+def decompress(parts, flags, max_length=None):
+    '''Takes the parts of a COMPRESSED frame back to those of dumps().
+    Returns the compressor and them. Raises `ut.ProtocolError` for a body
+    of more than `max_length` bytes decompressed (None - no limit).'''
+    body = parts[0]
+    compressor = compression.from_id(body[0] & ~STORED)
+    data = memoryview(body)[1:]
+    if not body[0] & STORED:
+        data = memoryview(compressor.decompress(data, max_length))
+    offset = 0
+    def read(n):
+        nonlocal offset
+        # writable buffers, as read from the socket
+        buf = bytearray(data[offset:offset+n])
+        offset += n
+        return buf
+    if not flags & OOB:
+        return compressor, [data]
+    return compressor, read_body(read, flags & ~COMPRESSED, data.nbytes)
+
+
+def dumps(obj):
+    '''Returns the pickle followed by the out-of-band buffers.'''
+    buffers = []
+    def buffer_callback(buf):
+        # false means out of band
+        return buf.raw().nbytes < OOB_THRESHOLD or buffers.append(buf.raw())
+    obj = _wrap_buffers(obj, 3)
+    try:
+        # a pickler of our own costs more than a small pickle
+        return [pickle.dumps(obj, 5, buffer_callback=buffer_callback)] + buffers
+    except TypeError:
+        # memoryviews deeper down
+        buffers = []
+    f = io.BytesIO()
+    _Pickler(f, protocol=5, buffer_callback=buffer_callback).dump(obj)
+    return [f.getbuffer()] + buffers
+
+
+def loads(parts):
+    return pickle.loads(parts[0], buffers=parts[1:])
+
+
+def sendall(sock, buffers, fd=None):
+    '''sendall() for a list of buffers, without joining them. The file
+    descriptor `fd` is passed along.'''
+    if len(buffers) == 1 and fd is None:
+        return sock.sendall(buffers[0])
+    views = [memoryview(buf).cast('B') for buf in buffers]
+    views = [view for view in views if view.nbytes]
+    ancdata = []
+    if fd is not None:
+        fds = array.array('i', [fd])
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)]
+    while views:
+        sent = sock.sendmsg(views[:_IOV_MAX], ancdata)
+        ancdata = []
+        while sent:
+            if sent < views[0].nbytes:
+                views[0] = views[0][sent:]
+                break
+            sent -= views.pop(0).nbytes
+
+
+def read_frame(sock):
+    '''Returns (id, kind, flags, parts).'''
+    fds = [] if sock.family == socket.AF_UNIX else None
+    id_, kind, flags, nbytes = HEADER.unpack(
+        read_exactly(sock, HEADER.size, fds=fds)
+    )
+    return id_, kind, flags, read_body(
+        lambda n: read_exactly(sock, n), flags, nbytes, fds
+    )
+
+
+def read_body(read, flags, nbytes, fds=None):
+    '''Returns the parts for loads(), `read(n)` returns n bytes. `fds` are
+    the file descriptors received with the header.'''
+    fd = fds.pop() if fds else None
+    try:
+        if not flags & OOB or flags & COMPRESSED:
+            return [read(nbytes)]
+        count = int.from_bytes(read(4), 'big')
+        sizes = struct.unpack('!{}Q'.format(count), read(8*count))
+        if flags & SHM:
+            if fd is None:
+                raise ut.ProtocolError('no shared memory file')
+            return [read(nbytes-4-8*count)] + _map_shm(fd, sizes)
+        parts = [read(nbytes-4-8*count-sum(sizes))]
+        for size in sizes:
+            parts.append(read(size))
+        return parts
+    finally:
+        for fd in [fd] + (fds or []):
+            if fd is not None:
+                os.close(fd)
+
+
+def use_shm(peer_shm, parts, threshold):
+    '''Whether to send the parts as a shared memory frame.'''
+    return (
+        threshold is not None and peer_shm and len(parts) > 1 and
+        sum(memoryview(buf).nbytes for buf in parts[1:]) >= threshold
+    )
+
+
+def pack_shm(id_, kind, parts, flags=0):
+    '''pack() for a shared memory frame. Returns the frame and the file
+    descriptor to pass with it, the caller closes it once sent.'''
+    sizes = [memoryview(buf).nbytes for buf in parts[1:]]
+    fd = _shm_file(sum(_aligned(size) for size in sizes))
+    try:
+        with mmap.mmap(fd, sum(_aligned(size) for size in sizes)) as m:
+            offset = 0
+            for buf, size in zip(parts[1:], sizes):
+                m[offset:offset+size] = memoryview(buf).cast('B')
+                offset += _aligned(size)
+    except Exception:
+        os.close(fd)
+        raise
+    frame = [
+        len(sizes).to_bytes(4, 'big'),
+        struct.pack('!{}Q'.format(len(sizes)), *sizes),
+        parts[0],
+    ]
+    nbytes = sum(memoryview(buf).nbytes for buf in frame)
+    header = HEADER.pack(id_, kind, flags | OOB | SHM, nbytes)
+    return [header] + frame, fd
+
+
+async def read_body_async(reader, flags, nbytes):
+    '''read_body() for an asyncio stream.'''
+    if not flags & OOB or flags & COMPRESSED:
+        return [await reader.readexactly(nbytes)]
+    count = int.from_bytes(await reader.readexactly(4), 'big')
+    sizes = struct.unpack(
+        '!{}Q'.format(count), await reader.readexactly(8*count)
+    )
+    parts = [await reader.readexactly(nbytes-4-8*count-sum(sizes))]
+    for size in sizes:
+        # into a writable buffer of its own, numpy arrays stay writable
+        buf = bytearray(size)
+        received = 0
+        while received < size:
+            chunk = await reader.read(size-received)
+            if not chunk:
+                raise ut.ProtocolError('eof')
+            buf[received:received+len(chunk)] = chunk
+            received += len(chunk)
+        parts.append(buf)
+    return parts
+
+
+def read_exactly(sock, n, eof_ok=False, fds=None):
+    '''File descriptors passed along are appended to `fds`.'''
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        if fds is None:
+            nread = sock.recv_into(view[received:])
+        else:
+            nread = recv_fds(sock, view[received:], fds)
+        if not nread:
+            if eof_ok and received == 0:
+                return None
+            raise ut.ProtocolError('eof')
+        received += nread
+    return buf
+
+
+def recv_fds(sock, view, fds):
+    '''recv_into() appending file descriptors passed along to `fds`.'''
+    nread, ancdata, flags, address = sock.recvmsg_into(
+        [view], socket.CMSG_SPACE(_FD_SIZE), _MSG_CMSG_CLOEXEC
+    )
+    for level, type_, data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            data = data[:len(data)-len(data)%_FD_SIZE]
+            fds.extend(array.array('i', data))
+    return nread
+
+
+class _Buffer:
+    '''Wraps large bytes or a bytearray, the pickler copies them into the
+    pickle without looking them up in the dispatch table, or a memoryview.'''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce__(self):
+        return _reduce_buffer(self)
+
+
+def _wrap_buffers(obj, depth):
+    '''Wraps large buffers in the top levels of small containers, where a
+    call and its result keep them.'''
+    t = type(obj)
+    if t in _BUFFERS:
+        return _Buffer(obj) if len(obj) >= OOB_THRESHOLD else obj
+    if t is memoryview:
+        return _Buffer(obj)
+    if not depth or t not in _CONTAINERS or not obj or len(obj) > 64:
+        return obj
+    values = obj.values() if t is dict else obj
+    for v in values:
+        tv = type(v)
+        if tv in _SCALARS:
+            continue
+        if tv in _BUFFERS:
+            if len(v) >= OOB_THRESHOLD:
+                break
+        elif tv is memoryview:
+            break
+        elif tv in _CONTAINERS and _wrap_buffers(v, depth-1) is not v:
+            break
+    else:
+        return obj
+    wrapped = [_wrap_buffers(v, depth-1) for v in values]
+    return dict(zip(obj, wrapped)) if t is dict else t(wrapped)
+
+
+def _reduce_buffer(obj):
+    if type(obj.data) is memoryview:
+        return _reduce_memoryview(obj.data)
+    if type(obj.data) is bytes:
+        return bytes, (pickle.PickleBuffer(obj.data),)
+    return _unwrap, (pickle.PickleBuffer(obj.data),)
+
+
+def _reduce_memoryview(obj):
+    return memoryview, (pickle.PickleBuffer(obj),)
+
+
+def _shm_file(size):
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('pyrpc', os.MFD_CLOEXEC)
+    else:
+        with tempfile.TemporaryFile() as f:
+            fd = os.dup(f.fileno())
+    os.ftruncate(fd, size)
+    return fd
+
+
+def _map_shm(fd, sizes):
+    # private, so that writes to the objects stay local
+    m = mmap.mmap(fd, sum(_aligned(size) for size in sizes),
+                  access=mmap.ACCESS_COPY)
+    view = memoryview(m)
+    buffers = []
+    offset = 0
+    for size in sizes:
+        buffers.append(view[offset:offset+size])
+        offset += _aligned(size)
+    return buffers
+
+
+def _aligned(size):
+    return (size+63) & ~63
+
+
+def _unwrap(buf):
+    # an out-of-band buffer arrives as the bytearray it was received into
+    return buf if type(buf) is bytearray else bytearray(buf)
+
+
+class _Pickler(pickle.Pickler):
+    dispatch_table = {
+        _Buffer: _reduce_buffer,
+        memoryview: _reduce_memoryview,
+    }
+
+
+_BUFFERS = (bytes, bytearray)
+_SCALARS = frozenset((str, int, float, bool, type(None)))
+_CONTAINERS = (tuple, list, dict)
+_IOV_MAX = 1024
+_FD_SIZE = array.array('i').itemsize
+_MSG_CMSG_CLOEXEC = getattr(socket, 'MSG_CMSG_CLOEXEC', 0)
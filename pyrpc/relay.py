@@ -1,52 +1,180 @@
+import concurrent.futures
 import traceback
+import itertools
 import pickle
 import socket
+import copy
 import time
 
+from . import protocol
+from . import codec as codecmod
+from . import compression
+from . import metrics as metricsmod
+from . import mux
+from . import retry
 from . import ut
 
+# keyword arguments of a call taken out by Relay._consume_kwargs()
+CALL_KWARGS = frozenset((
+    'call_timeout', 'socket_connect_timeout', 'socket_send_timeout',
+    'socket_recv_timeout', 'nolog', 'call_priority', 'compress',
+))
+
 
 class Relay:
-    def __init__(self, client, method_name):
+    _sends_deadline = True
+    _hedge_race = None # retry.Race of the attempts of a hedged call
+
+    def __init__(self, client, method_name, address=None):
         self._client = client
         self._method_name = method_name
+        self._pinned = address # called there, not where the balancer says
 
     def __call__(self, *args, **kwargs):
-        kwargs = self._consume_kwargs(kwargs)
+        return self._call(args, self._consume_kwargs(kwargs))
+
+    def _call(self, args, kwargs):
         callmsg = self._method_name, args, kwargs
         indata = callmsg
+        metrics = self._client._metrics
+        if metrics is not None:
+            metrics.begin(self._method_name)
         try:
-            output = self._make_call(indata)
+            output = self._make_retried_call(indata)
             ret, exc = output
         except Exception as e:
             ret = None
             exc = e
+        if metrics is not None:
+            self._record(metrics, exc)
         if exc is not None:
             self._client._handle_exception(callmsg, exc)
         else:
             self._client.log_call(callmsg, ret)
             return ret
 
+    def _make_retried_call(self, indata):
+        '''Makes the call, again after a back-off while it fails if the
+        method is idempotent, see `pyrpc.retry`.'''
+        client = self._client
+        if self._method_name not in (client.idempotent_methods or ()):
+            return self._make_balanced_call(indata)
+        client._retry_budget.deposit()
+        retries = (client.method_retries or {}).get(
+            self._method_name, client.retries
+        )
+        # call_timeout bounds the call, retries and back-offs included
+        due_time = time.monotonic() + self._timeout
+        for n in itertools.count():
+            try:
+                output = self._make_hedged_call(indata)
+            except retry.RETRYABLE as e:
+                output = e
+            error = retry.failure(output)
+            if error is None:
+                return output
+            delay = retry.backoff(
+                n, client.retry_backoff, client.retry_backoff_max
+            )
+            if n >= retries or time.monotonic()+delay >= due_time or \
+                    not client._retry_budget.withdraw():
+                if output is error:
+                    raise error
+                return output
+            time.sleep(delay)
+            self._limit_timeout(due_time-time.monotonic())
+
+    def _make_hedged_call(self, indata):
+        '''Makes the call, once more at another address if it takes longer
+        than the `hedge_quantile` of the latencies of the method.'''
+        client = self._client
+        if not client.hedge:
+            return self._make_balanced_call(indata)
+        window = client._latency_window(self._method_name)
+        delay = window.quantile(client.hedge_quantile)
+        start = time.perf_counter()
+        if delay is None:
+            output = self._make_balanced_call(indata)
+        else:
+            output = self._race(indata, delay)
+        window.add(time.perf_counter()-start)
+        return output
+
+    def _race(self, indata, delay):
+        '''Returns the first output of the call and of its hedge, made if
+        the call is not done in `delay` seconds. The other one stops
+        waiting, over protocol 2, its method still runs on the server until
+        it is done or its deadline passes.'''
+        workers = self._client._get_workers()
+        race = retry.Race()
+        # each attempt keeps its own connection state
+        first = copy.copy(self)
+        first._hedge_race = race
+        futures = [_spawn(workers, first._make_balanced_call, indata)]
+        try:
+            done, pending = concurrent.futures.wait(futures, delay)
+            if not done:
+                second = copy.copy(first)
+                futures.append(_spawn(
+                    workers, second._make_balanced_call, indata,
+                    (getattr(first, '_address', None),),
+                ))
+            error = None
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            race.end()
+
+    def _make_balanced_call(self, indata, exclude=()):
+        '''Makes the call at the address picked by the balancer of the
+        client (not one of `exclude`), at the next one if it can't be
+        connected to.'''
+        balancer = self._client._balancer
+        if balancer is None or self._pinned is not None:
+            self._address = self._pinned or self._client.address
+            return self._make_call(indata)
+        tried = set(exclude)
+        while True:
+            self._address = balancer.acquire(tried)
+            try:
+                return self._make_call(indata)
+            except ut.NoSocket:
+                balancer.eject(self._address)
+                tried.add(self._address)
+                if tried.issuperset(balancer.addresses):
+                    raise
+            finally:
+                balancer.release(self._address)
+
     def _make_call(self, indata):
+        self._sock = None
         try:
+            conn = self._get_mux()
+            laps = self._laps
+            if laps is not None:
+                laps.lap('connect')
+            if conn is not None:
+                codec, parts = self._call_mux(conn, indata)
+                if laps is not None:
+                    laps.lap('wait')
+                return codec.loads(parts)
             due_time = time.time() + self._timeout
             indata = pickle.dumps(indata)
-            indata = (len(indata)).to_bytes(4, 'big') + indata
-            self._connect()
-            self._sock.settimeout(self._socket_send_timeout)
-            try:
-                self._sock.sendall(indata)
-            except Exception:
-                raise ut.Timeout('send')
-            self._sock.settimeout(self._socket_recv_timeout)
-            nbytes = self._read_header()
+            nbytes = self._request([len(indata).to_bytes(4, 'big'), indata])
             timeout = max(due_time-time.time(), self._socket_recv_timeout)
             self._sock.settimeout(timeout)
             try:
                 body = self._read(nbytes)
             except Exception:
                 raise ut.Timeout('read_body')
+            if laps is not None:
+                laps.lap('wait')
             output = pickle.loads(body)
+            self._release()
             return output
         except Exception as e:
             if isinstance(e, (ut.Timeout, ut.NoSocket, ut.ProtocolError)):
@@ -58,7 +186,92 @@ class Relay:
             if self._sock:
                 self._sock.close()
 
+    def _get_mux(self):
+        return self._client._get_mux(
+            self._address,
+            self._socket_connect_timeout,
+            self._socket_send_timeout,
+        )
+
+    def _call_mux(self, conn, indata):
+        '''Returns the codec and response parts of the call. A call found
+        unsent over a connection closed by the server (while idle) is made
+        once more, over a new connection.'''
+        for fresh in (False, True):
+            codec, parts, flags = self._encode(conn, indata)
+            try:
+                return codec, conn.call(
+                    parts, self._timeout, flags, self._laps, self._hedge_race
+                )
+            except mux.Unsent:
+                if fresh:
+                    raise
+            # the closed connection is dropped by _get_mux()
+            conn = self._get_mux()
+            if conn is None:
+                raise ut.ProtocolError(self._error_msg('closed'))
+
+    def _encode(self, conn, indata):
+        '''Returns the codec, parts and flags of a call over the connection,
+        the method named by its id if the server sent one.'''
+        version = conn.version
+        if version >= 6:
+            # the server drops the call once the client gives up on it
+            timeout = self._timeout if self._sends_deadline else None
+            priority = self._priority if version >= 7 else None
+            if type(indata) is tuple:
+                method_id = conn.methods.get(indata[0])
+                if method_id is not None:
+                    indata = (method_id,) + indata[1:]
+                indata += (timeout,) if priority is None else \
+                    (timeout, priority)
+            elif indata.get('predicate') == 'batch':
+                indata = dict(indata, timeout=timeout, priority=priority)
+            elif indata.get('predicate') == 'put' and priority is not None:
+                indata = dict(indata, priority=priority)
+        codec = self._codec if version >= 4 else codecmod.PICKLE
+        parts, flags = codec.dumps(indata), codec.flags
+        if self._compressor is not None and version >= 5:
+            # named even if small, the response is compressed with it
+            parts, flags = protocol.compress(
+                parts, self._compressor, self._client.compress_threshold,
+                flags, stored=True,
+            )
+        return codec, parts, flags
+
+    def _request(self, indata):
+        '''Sends the frame and waits for the response header.
+
+        A pooled connection may have been closed by the server while idle;
+        that shows up before any response bytes arrive, and the frame is then
+        sent once more over a fresh connection.
+        '''
+        fresh = False
+        while True:
+            self._connect(fresh)
+            if self._laps is not None:
+                self._laps.lap('connect')
+            try:
+                self._sock.settimeout(self._socket_send_timeout)
+                try:
+                    protocol.sendall(self._sock, indata)
+                except (BrokenPipeError, ConnectionResetError):
+                    if self._reused:
+                        raise _Stale()
+                    raise ut.Timeout('send')
+                except Exception:
+                    raise ut.Timeout('send')
+                if self._laps is not None:
+                    self._laps.lap('send')
+                self._sock.settimeout(self._socket_recv_timeout)
+                return self._read_header()
+            except _Stale:
+                self._sock.close()
+                self._sock = None
+                fresh = True
+
     def _consume_kwargs(self, kwargs):
+        # the keyword arguments taken out here are those of CALL_KWARGS
         to = self._timeout = (
             kwargs.pop('call_timeout', None) or 
             self._client.call_timeout or 
@@ -77,24 +290,69 @@ class Relay:
             self._client.socket_recv_timeout
         ))
         self._nolog = kwargs.pop('nolog', None)
+        self._priority = (
+            kwargs.pop('call_priority', None) or self._client.priority
+        )
+        method_codecs = self._client.method_codecs or {}
+        self._codec = codecmod.get(
+            method_codecs.get(self._method_name) or self._client.codec
+        )
+        compress = kwargs.pop('compress', None)
+        if compress is True:
+            compress = self._client.compression or 'zlib'
+        elif compress is None:
+            compress = self._client.compression
+        self._compressor = compression.get(compress or None)
+        self._laps = None
+        if self._client._metrics is not None:
+            self._laps = metricsmod.Laps()
         return kwargs
 
-    def _connect(self):
-        if isinstance(self._client.address, str):
+    def _limit_timeout(self, timeout):
+        '''Leaves the call `timeout` seconds at most, those left before the
+        deadline of a retried call.'''
+        to = self._timeout = max(0, min(self._timeout, timeout))
+        self._socket_connect_timeout = min(to, self._socket_connect_timeout)
+        self._socket_send_timeout = min(to, self._socket_send_timeout)
+        self._socket_recv_timeout = min(to, self._socket_recv_timeout)
+
+    def _record(self, metrics, exc):
+        '''Counts the call done, see `Client.call_stats()`.'''
+        laps = self._laps
+        metrics.record(
+            self._method_name, laps.elapsed(), exc is not None,
+            laps.phases.items(),
+        )
+
+    def _connect(self, fresh=False):
+        address = self._address
+        if not fresh:
+            self._sock = self._client._pool.get(address)
+        self._reused = self._sock is not None
+        if self._reused:
+            return 
+        if isinstance(address, str):
             family = socket.AF_UNIX
         else:
             family = socket.AF_INET
         self._sock = socket.socket(family, socket.SOCK_STREAM)
         self._sock.settimeout(self._socket_connect_timeout)
         try:
-            self._sock.connect(self._client.address)
+            self._sock.connect(address)
         except Exception:
             raise ut.NoSocket(self._error_msg('connect'))
 
+    def _release(self):
+        self._client._pool.put(self._address, self._sock)
+        self._sock = None
+
     def _read_header(self):
         if self._timeout <= self._socket_recv_timeout:
             try:
                 header = self._read(4)
+            except (ut.ProtocolError, ConnectionResetError):
+                self._check_stale()
+                raise ut.ProtocolError(self._error_msg('read_header'))
             except Exception:
                 raise ut.Timeout(self._error_msg('read_header'))
         else:
@@ -105,6 +363,9 @@ class Relay:
                     header = self._read(4)
                     hasRead = True
                     break
+                except (ut.ProtocolError, ConnectionResetError):
+                    self._check_stale()
+                    raise ut.ProtocolError(self._error_msg('read_header'))
                 except Exception:
                     time.sleep(self._client.read_header_tick)
             if not hasRead:
@@ -114,24 +375,33 @@ class Relay:
             raise ut.ProtocolError(self._error_msg('read_header'))
         return nbytes
 
+    def _check_stale(self):
+        if self._reused:
+            raise _Stale()
+
     def _read(self, n):
-        received = 0
-        chunks = []
-        while received < n:
-            try:
-                chunk = self._sock.recv(n-received)
-            except InterruptedError:
-                continue
-            if not chunk:
-                break
-            chunks.append(chunk)
-            received += len(chunk)
-        data = b''.join(chunks)
-        if len(data) != n:
+        try:
+            return protocol.read_exactly(self._sock, n)
+        except ut.ProtocolError:
             raise ut.ProtocolError(self._error_msg('read'))
-        return data
 
     def _error_msg(self, prefix=''):
         return '{} {}.{}()'.format(
             prefix, self._client.__class__.__name__, self._method_name
         )
+
+
+def _spawn(workers, func, *args):
+    '''Returns a future of func(*args), run by the worker pool.'''
+    future = concurrent.futures.Future()
+    def run():
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    workers.spawn(run)
+    return future
+
+
+class _Stale(Exception):
+    '''A reused connection turned out to be closed by the peer.'''
@@ -0,0 +1,106 @@
+'''Retries and hedges of the calls of idempotent methods.
+
+A failed call is retried after a back-off of up to `retry_backoff * 2**n`
+seconds (full jitter, capped by `retry_backoff_max`) as long as the retry
+budget of the client allows it, so an outage doesn't multiply the calls
+made. A call slower than the `hedge_quantile` of the latencies observed
+lately is hedged: made once more at another address, the first answer wins
+and the other one is dropped.
+'''
+import collections
+import threading
+import random
+
+from . import ut
+
+# exceptions of calls which may succeed if made again
+RETRYABLE = (ut.NoSocket, ut.Timeout, ut.ProtocolError, ut.Overloaded)
+
+
+class RetryBudget:
+    '''Allows `ratio` retries per call made, beyond `max_tokens` retries
+    saved up while calls succeeded.'''
+    def __init__(self, ratio, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        '''Returns whether a retry is allowed and counts it if it is.'''
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class LatencyWindow:
+    '''The latencies of the last `size` calls of a method.'''
+    MIN_SAMPLES = 20
+
+    def __init__(self, size=256):
+        self._latencies = collections.deque(maxlen=size)
+        self._quantiles = {}
+        self._added = 0
+
+    def add(self, seconds):
+        self._latencies.append(seconds)
+        self._added += 1
+        if self._added % 16 == 0:
+            self._quantiles = {}
+
+    def quantile(self, q):
+        '''Returns the latency `q` of the calls are faster than, None until
+        there are enough of them.'''
+        value = self._quantiles.get(q)
+        if value is None:
+            latencies = sorted(self._latencies)
+            if len(latencies) < self.MIN_SAMPLES:
+                return None
+            value = latencies[min(int(q*len(latencies)), len(latencies)-1)]
+            self._quantiles[q] = value
+        return value
+
+
+class Race:
+    '''The waits of the attempts of a hedged call. Those still waiting
+    when it ends, once one of them answered, fail with `pyrpc.Cancelled`.'''
+    def __init__(self):
+        self._waiters = []
+        self._ended = False
+        self._lock = threading.Lock()
+
+    def add(self, waiter):
+        '''Adds the waiter of an attempt, see `mux._Waiter`.'''
+        with self._lock:
+            if not self._ended:
+                self._waiters.append(waiter)
+                return
+        waiter.fail(ut.Cancelled('hedged call answered'))
+
+    def end(self):
+        with self._lock:
+            self._ended = True
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.event.is_set():
+                waiter.fail(ut.Cancelled('hedged call answered'))
+
+
+def backoff(retry, base, cap):
+    '''Returns the seconds to wait before retry number `retry` (from 0).'''
+    return random.uniform(0, min(cap, base * 2**retry))
+
+
+def failure(output):
+    '''Returns the retryable exception of the outcome of a call, raised or
+    returned by the server, or None.'''
+    if isinstance(output, BaseException):
+        return output if isinstance(output, RETRYABLE) else None
+    exc = output[1]
+    return exc if isinstance(exc, ut.Overloaded) else None
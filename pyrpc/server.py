@@ -1,10 +1,20 @@
 from socketserver import TCPServer, UnixStreamServer, ThreadingMixIn
 import threading
+import socket
 import traceback
+import random
 import time
 import os
 
+from .aioserver import AioServer
+from .prefork import Prefork
+from .jobs import JobStore
+from .cache import ResultCache, Flights
+from .metrics import Metrics
+from . import metrics as metricsmod
 from . import handler as handlermod
+from .workers import WorkerPool
+from . import logs
 
 
 class Server:
@@ -14,30 +24,76 @@ class Server:
     callee_type = None
     retype_exceptions = False 
     handler = 'Handler'
+    keepalive_timeout = 300 # idle connections are closed after that
+    engine = 'threading' # or 'asyncio' to serve all connections on one loop
+    max_workers = None # methods running at a time, None - no limit
+    max_queue = None # calls waiting for a worker, beyond that `Overloaded`
+    method_limits = None # {method_name: max calls in progress}
+    priority_classes = None # {class: weight}, the shares of max_workers
+                            # reserved to them, see `WorkerPool`
+    method_priorities = None # {method_name: class}, a call may name its own
+    exposed_methods = None # names of the methods clients may call (besides
+                           # connected and stats), None - all
+    processes = None # number of forked worker processes, None - serve here
+    shm_threshold = None # bytes of large buffers in a result to send them
+                         # through shared memory on UNIX sockets, None - never
+    codecs = None # names of the codecs calls may use, None - all registered
+    compression = None # compressor of all results over protocol 5, results
+                       # of compressed calls use theirs, None - off
+    compress_threshold = 2**16 # bytes of a frame worth compressing
+    max_decompressed = 2**30 # bytes a compressed request may take, beyond
+                             # that it is answered with ProtocolError
+    cached_methods = None # {method_name: seconds a result is reused, None -
+                          # until evicted}, for methods without side effects
+    cache_size = 1024 # max results cached
+    cache_max_bytes = None # of the cached responses, None - no limit
+    coalesced_methods = None # names of methods whose equal calls in progress
+                             # at the same time share one run
+    metrics = False # count and time the calls of each method, see stats()
+    log_sample = 1 # fraction of the calls logged, failed calls all are
+    log_async = True # format and write log records on a background thread
 
     nonblocking = False
-    request_clean_interval = 60
+    request_clean_interval = 60 # max seconds between checks for expired jobs
+    nb_max_bytes = None # results of nonblocking calls held in memory, beyond
+                        # that in temporary files, None - no limit
+    nb_max_wait = 30 # max seconds a get waits for the result of a job
 
     def __init__(self, address=None, **kwargs):
         self.address = address or self.address
         for k, v in kwargs.items():
             setattr(self, k, v)
+        self._own_callee = self.callee is None and self.callee_type is not None
         if self.callee is None: 
             if self.callee_type is not None:
                 self.callee = self.callee_type()
             else:
                 self.callee = self
+        self._workers = self.__make_workers()
+        self._cache = self.__make_cache()
+        self._flights = Flights() if self.coalesced_methods else None
+        self._metrics = Metrics() if self.metrics else None
+        self._exposed = None
+        if self.exposed_methods is not None:
+            self._exposed = frozenset(self.exposed_methods).union(
+                handlermod._SERVER_METHODS
+            )
+        self._method_names = None
         if self.nonblocking:
-            self._id_request = {}
-            threading.Thread(
-                target=self.__clean_timedout_requests, daemon=True
-            ).start()
+            self._jobs = JobStore(self.nb_max_bytes)
+            self._subscriptions = {}
+            if not self.processes:
+                threading.Thread(
+                    target=self.__expire_jobs, daemon=True
+                ).start()
             Handler = handlermod.NbHandler
         else:
             Handler = getattr(handlermod, self.handler)
-        if isinstance(self.address, str):
-            if os.path.exists(self.address):
-                os.remove(self.address)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        if self.engine == 'asyncio':
+            self.__server = AioServer(self, self.address)
+        elif isinstance(self.address, str):
             if self.synchronous:
                 self.__server = _SyncUnixServer(self, self.address, Handler)
             else:
@@ -47,48 +103,83 @@ class Server:
                 self.__server = _SyncTCPServer(self, self.address, Handler)
             else:
                 self.__server = _AsyncTCPServer(self, self.address, Handler)
+        self._prefork = None
+        if self.processes:
+            self._prefork = Prefork(self, self.__server.serve_forever)
+
+    def _init_worker(self):
+        '''Runs in a forked worker process before it starts serving.'''
+        if self._own_callee:
+            self.callee = self.callee_type()
+        self._workers = self.__make_workers()
+        self._cache = self.__make_cache()
+        self._flights = Flights() if self.coalesced_methods else None
+        self._metrics = Metrics() if self.metrics else None
+        self._method_names = None
+        if self.engine != 'asyncio':
+            # the workers race for each connection, the losers must not block
+            self.__server.socket.setblocking(False)
+        if self.nonblocking:
+            self._jobs = JobStore(self.nb_max_bytes)
+            self._subscriptions = {}
+            threading.Thread(
+                target=self.__expire_jobs, daemon=True
+            ).start()
+            address = self._prefork.peer_address(self._prefork.index)
+            if os.path.exists(address): # left by the worker this replaces
+                os.remove(address)
+            peer_server = _AsyncUnixServer(self, address, handlermod.NbHandler)
+            threading.Thread(
+                target=peer_server.serve_forever, daemon=True
+            ).start()
+
+    def __make_workers(self):
+        return WorkerPool(
+            self.max_workers, self.max_queue, self.method_limits,
+            shares=self.priority_classes, key_classes=self.method_priorities,
+        )
+
+    def __make_cache(self):
+        if not self.cached_methods:
+            return None
+        return ResultCache(
+            self.cached_methods, self.cache_size, self.cache_max_bytes
+        )
 
-    def __clean_timedout_requests(self):
+    def __expire_jobs(self):
         while True:
             try:
-                t = time.time()
-                todel = []
-                for id_, data in self._id_request.items():
-                    if t>data['due_time']:
-                        todel.append(id_)
-                for id_ in todel:
-                    try:
-                        del self._id_request[id_]
-                    except KeyError:
-                        pass
+                ids = self._jobs.expire(self.request_clean_interval)
+                if ids:
+                    handlermod._forget_jobs(self, ids)
             except Exception:
                 traceback.print_exc()
-            finally:
                 time.sleep(self.request_clean_interval)
 
     def log_exception(self, exc, methodName, args, kwargs):
         log = self.get_exception_logging_func()
         if not log:
             return 
-        prefix = '{}(args={!r}, kwargs={!r})'.format(
-            methodName, args, kwargs
-        )
-        if len(prefix) > 60:
-            prefix = prefix[:60] + '...)'
-        suffix = ' -> {!r}'.format(exc)[:120-len(prefix)]
-        log(prefix+suffix)
+        self.__log(log, exc, methodName, args, kwargs)
 
     def log_call(self, ret, methodName, args, kwargs):
         log = self.get_call_logging_func()
         if not log:
             return 
-        prefix = '{}(args={!r}, kwargs={!r})'.format(
-            methodName, args, kwargs
-        )
-        if len(prefix) > 60:
-            prefix = prefix[:60] + '...)'
-        suffix = ' -> {!r}'.format(ret)[:120-len(prefix)]
-        log(prefix+suffix)
+        if self.log_sample < 1 and random.random() >= self.log_sample:
+            return
+        self.__log(log, ret, methodName, args, kwargs)
+
+    def __log(self, log, outcome, method_name, args, kwargs):
+        '''Reprs are bounded and, with `log_async`, taken on the writer
+        thread, so a result changed right after the call may be logged as
+        changed.'''
+        if self.log_async:
+            logs.submit(
+                log, logs.call_msg, method_name, args, kwargs, outcome
+            )
+        else:
+            log(logs.call_msg(method_name, args, kwargs, outcome))
 
     def get_exception_logging_func(self):
         return None
@@ -100,26 +191,90 @@ class Server:
         threading.Thread(target=self.start, daemon=True).start()
 
     def start(self):
-        self.__server.serve_forever()
+        if self._prefork is None:
+            self.__server.serve_forever()
+            return
+        try:
+            self._prefork.run()
+        finally:
+            self.__server.socket.close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.remove(self.address)
 
     def shutdown(self, delay=0.1):
         def func():
             time.sleep(delay)
+            if self._prefork is not None:
+                self._prefork.stop()
+                return
             self.__server.shutdown()
             self.__server.socket.close()
+            self.__server.close_connections()
             if isinstance(self.address, str) and os.path.exists(self.address):
                 os.remove(self.address)
         threading.Thread(target=func, daemon=True).start()
 
     def shutdown_sync(self):
+        if self._prefork is not None:
+            self._prefork.stop(wait=True)
+            return
         self.__server.shutdown()
         self.__server.socket.close()
+        self.__server.close_connections()
         if isinstance(self.address, str) and os.path.exists(self.address):
             os.remove(self.address)
 
     def connected(self):
         return True
 
+    def invalidate_cache(self, method_name=None, args=None, kwargs=None):
+        '''Drops the cached results of a call, of all the calls of a method
+        or all of them. With `processes`, only those of the calling one.'''
+        if self._cache is not None:
+            self._cache.invalidate(method_name, args, kwargs)
+
+    def cache_stats(self):
+        '''Returns the hits, misses, entries and nbytes of the result cache
+        (of this process with `processes`), None if there is none.'''
+        if self._cache is not None:
+            return self._cache.stats()
+
+    def stats(self, format=None):
+        '''Returns the metrics of the calls served (by this process with
+        `processes`): {'methods': {method_name: {...}}, 'workers_running',
+        'queue_depth', 'jobs', 'cache', 'classes'}, or with
+        format='prometheus' the text exposition format of them. Answered
+        even if the callee has no `stats` method, with `metrics` off the
+        methods are left empty. 'classes' are the priority classes of the
+        workers, see `WorkerPool.classes()`.
+
+        Per method: calls, errors, in_progress, latency_sum and the p50,
+        p99 and p999 latencies (seconds from decoding the request to
+        sending the response), the seconds spent in the decode, execute and
+        send (encode included) phases, execute_count, run_errors, bytes_in
+        and bytes_out. Requests are named by method, batch, nb_method for
+        the put of a nonblocking call and nb_get.
+        '''
+        methods = {} if self._metrics is None else self._metrics.snapshot()
+        gauges = {
+            'workers_running': self._workers.running,
+            'queue_depth': self._workers.queued,
+            'jobs': len(self._jobs) if self.nonblocking else None,
+        }
+        if format == 'prometheus':
+            cache = self.cache_stats() or {}
+            counters = {
+                'cache_hits_total': cache.get('hits'),
+                'cache_misses_total': cache.get('misses'),
+            }
+            gauges['cache_entries'] = cache.get('entries')
+            gauges['cache_bytes'] = cache.get('nbytes')
+            return metricsmod.prometheus('pyrpc', methods, gauges, counters)
+        return dict(
+            gauges, methods=methods, cache=self.cache_stats(),
+            classes=self._workers.classes(),
+        )
+
 
 class _ServerMixin:
     allow_reuse_address = True
@@ -128,8 +283,24 @@ class _ServerMixin:
 
     def __init__(self, parent, address, Handler):
         self.parent = parent
+        self.connections = set()
         super().__init__(address, Handler)
 
+    def finish_request(self, request, client_address):
+        self.connections.add(request)
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            self.connections.discard(request)
+
+    def close_connections(self):
+        '''Wakes up handlers waiting on kept-alive connections.'''
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
 
 class _SyncUnixServer(_ServerMixin, UnixStreamServer):pass
 class _AsyncUnixServer(_ServerMixin, ThreadingMixIn, UnixStreamServer):pass
@@ -0,0 +1,118 @@
+import queue
+
+from .relay import Relay
+from . import protocol
+from . import mux
+from . import ut
+
+
+class StreamRelay:
+    '''`for item in client.stream_method(...)`: iterates over the items of
+    the result as the server sends them.
+
+    The server is granted `stream_window` items ahead of the consumer, it
+    waits for the consumer beyond that. `call_timeout` applies to each item.
+    The call is made on the first `next()`. Closing the iterator before the
+    end (or dropping it) stops the server side iteration. Servers speaking
+    only the legacy protocol return the whole result in one piece.
+    '''
+    _sends_deadline = False # items have a timeout each, the stream has none
+    _hedge_race = None
+    _make_call = Relay._make_call
+    _get_mux = Relay._get_mux
+    _call_mux = Relay._call_mux
+    _encode = Relay._encode
+    _request = Relay._request
+    _connect = Relay._connect
+    _release = Relay._release
+    _read_header = Relay._read_header
+    _check_stale = Relay._check_stale
+    _read = Relay._read
+    _error_msg = Relay._error_msg
+
+    def __init__(self, client, method_name):
+        self._client = client
+        self._method_name = method_name
+
+    def __call__(self, *args, **kwargs):
+        kwargs = self._consume_kwargs(kwargs)
+        return self._stream((self._method_name, args, kwargs))
+
+    def _stream(self, callmsg):
+        # opened on the first next(): an iterator dropped before it must not
+        # leave the server waiting for credit
+        balancer = self._client._balancer
+        # not counted in progress, nor moved to another address on failure
+        self._address = self._client.address if balancer is None \
+            else balancer.pick()
+        try:
+            conn = self._get_mux()
+            if conn is None:
+                ret, exc = self._make_call(callmsg)
+            else:
+                try:
+                    codec, id_, frames = self._open(conn, callmsg)
+                except mux.Unsent:
+                    # closed while idle, once more on a new connection
+                    conn = self._get_mux()
+                    if conn is None:
+                        raise
+                    codec, id_, frames = self._open(conn, callmsg)
+        except Exception as e:
+            if not hasattr(e, 'traceback'):
+                e.traceback = ''
+            conn, ret, exc = None, None, e
+        if conn is not None:
+            yield from self._iterate(callmsg, conn, id_, frames, codec)
+            return
+        if exc is not None:
+            self._client._handle_exception(callmsg, exc)
+        self._client.log_call(callmsg, ret)
+        # a list, or a generator as from a streamed call
+        yield from ret
+
+    def _open(self, conn, callmsg):
+        codec, parts, flags = self._encode(conn, callmsg)
+        id_, frames = conn.open_stream(
+            parts, self._window, self._timeout, flags
+        )
+        return codec, id_, frames
+
+    def _iterate(self, callmsg, conn, id_, frames, codec):
+        done = False
+        consumed = 0
+        try:
+            while True:
+                try:
+                    kind, parts = frames.get(timeout=self._timeout)
+                except queue.Empty:
+                    exc = ut.Timeout(self._error_msg('stream'))
+                    exc.traceback = ''
+                    break
+                if kind is None:
+                    exc = parts
+                    exc.traceback = ''
+                    break
+                if kind == protocol.RESPONSE:
+                    done = True
+                    ret, exc = codec.loads(parts)
+                    break
+                yield codec.loads(parts)
+                consumed += 1
+                if consumed >= max(1, self._window//2):
+                    conn.grant(id_, consumed, self._socket_send_timeout)
+                    consumed = 0
+        finally:
+            conn.close_stream(id_, cancel=not done)
+        if exc is not None:
+            self._client._handle_exception(callmsg, exc)
+        else:
+            self._client.log_call(callmsg, ret)
+
+    def _consume_kwargs(self, kwargs):
+        kwargs = Relay._consume_kwargs(self, kwargs)
+        self._window = (
+            kwargs.pop('stream_window', None) or
+            self._client.stream_window
+        )
+        return kwargs
@@ -0,0 +1,32 @@
+from .relay import CALL_KWARGS
+from . import metrics as metricsmod
+
+
+class Stub:
+    '''The calls of one method made through a client, kept by the client.
+
+    The config of a call worked out from the options of the client
+    (timeouts, codec, compressor...) is worked out once: a call without any
+    of `CALL_KWARGS` copies it into a fresh relay, which holds the state of
+    that call only. The client drops its stubs when one of its options is
+    set.
+    '''
+    __slots__ = ('_relay_type', '_client', '_args', '_config')
+
+    def __init__(self, relay_type, client, *args):
+        self._relay_type = relay_type
+        self._client = client
+        self._args = args # of the relay after the client
+        relay = relay_type(client, *args)
+        relay._consume_kwargs({})
+        self._config = relay.__dict__
+
+    def __call__(self, *args, **kwargs):
+        relay_type = self._relay_type
+        if kwargs and not CALL_KWARGS.isdisjoint(kwargs):
+            return relay_type(self._client, *self._args)(*args, **kwargs)
+        relay = relay_type.__new__(relay_type)
+        relay.__dict__.update(self._config)
+        if relay._laps is not None:
+            relay._laps = metricsmod.Laps()
+        return relay._call(args, kwargs)
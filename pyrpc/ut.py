@@ -43,3 +43,7 @@ def readSocket(sock, n):
 class NoSocket(Exception):pass
 class ProtocolError(Exception):pass
 class Timeout(socket.timeout):pass
+class Overloaded(Exception):pass # call rejected without running, retryable
+class UnknownJob(KeyError):pass # nonblocking job expired or fetched already
+class Expired(Timeout):pass # the deadline of the call passed on the server
+class Cancelled(Exception):pass # the nonblocking job was cancelled
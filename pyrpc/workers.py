@@ -0,0 +1,237 @@
+import collections
+import traceback
+import threading
+import queue
+
+from . import ut
+
+DEFAULT = 'default' # the priority class of jobs of no other one
+
+
+class WorkerPool:
+    '''Runs jobs on reusable daemon threads.
+
+    At most `max_workers` jobs run at a time, at most `max_queue` more wait
+    for a free worker and jobs of one `key` (a method name) in progress are
+    limited by `key_limits`. A job beyond these limits is rejected with
+    `ut.Overloaded`. None means no limit.
+
+    Jobs belong to priority classes, {class: weight} in `shares`: the one
+    given to `submit()`, else that of their key in `key_classes`, else
+    `DEFAULT`. Each class has `max_workers * weight / total weight` workers
+    (at least one) reserved to it, the others never take them, so a class
+    of short calls gets workers even while a class of long ones has all of
+    its own busy. `DEFAULT` weighs 1 unless named in `shares`. Waiting
+    jobs get the workers freed in proportion to the weights of their
+    classes and, in a class, in turns of the `flow`s (connections) they
+    come from. Without `max_workers`, jobs never wait and classes don't
+    matter.
+
+    `spawn()` runs a job on a thread right away, it is not counted against
+    the limits.
+    '''
+    def __init__(self, max_workers=None, max_queue=None, key_limits=None,
+                 idle_timeout=60, shares=None, key_classes=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.key_limits = key_limits or {}
+        self.idle_timeout = idle_timeout
+        self.key_classes = key_classes or {}
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queued = 0
+        self._classes = _classes(shares, max_workers)
+        self._pass = 0
+        self._key_count = {}
+        self._jobs = queue.SimpleQueue()
+        self._idle = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def submit(self, func, *args, key=None, inline=False, priority=None,
+               flow=None):
+        '''Runs func(*args) once a worker is free: on a pool thread or, with
+        `inline`, right in the calling thread if a worker is free now.
+        `priority` names the class of the job, unknown ones are ignored.'''
+        with self._lock:
+            self._enter(key)
+            cls = self._class(priority, key)
+            if not cls.flows and self._may_start(cls):
+                self._running += 1
+                cls.running += 1
+            elif self.max_queue is None or self._queued < self.max_queue:
+                if not cls.flows:
+                    # an idle class doesn't get the turns it didn't take
+                    cls.pass_ = max(cls.pass_, self._pass)
+                cls.flows.setdefault(flow, collections.deque()).append(
+                    (func, args, key)
+                )
+                self._queued += 1
+                return
+            else:
+                self._leave(key)
+                raise ut.Overloaded('queue is full')
+        if inline:
+            self._run(func, args, key, cls)
+        else:
+            self.spawn(self._run, func, args, key, cls)
+
+    def classes(self):
+        '''Returns {class: {'running', 'queued', 'reserved'}}.'''
+        with self._lock:
+            return {
+                name: {
+                    'running': cls.running,
+                    'queued': sum(len(jobs) for jobs in cls.flows.values()),
+                    'reserved': cls.reserved,
+                }
+                for name, cls in self._classes.items()
+            }
+
+    def enter(self, key):
+        '''Counts a job of `key` run outside of the pool.'''
+        with self._lock:
+            self._enter(key)
+
+    def leave(self, key):
+        with self._lock:
+            self._leave(key)
+
+    def spawn(self, func, *args):
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+                self._jobs.put((func, args))
+                return
+        threading.Thread(
+            target=self._work, args=(func, args), daemon=True
+        ).start()
+
+    def _enter(self, key):
+        limit = self.key_limits.get(key)
+        if limit is None:
+            return
+        count = self._key_count.get(key, 0)
+        if count >= limit:
+            raise ut.Overloaded('{} calls of {} in progress'.format(count, key))
+        self._key_count[key] = count + 1
+
+    def _leave(self, key):
+        if key not in self._key_count:
+            return
+        self._key_count[key] -= 1
+        if not self._key_count[key]:
+            del self._key_count[key]
+
+    def _class(self, priority, key):
+        classes = self._classes
+        return (
+            classes.get(priority) or
+            classes.get(self.key_classes.get(key)) or
+            classes[DEFAULT]
+        )
+
+    def _may_start(self, cls):
+        if self.max_workers is None:
+            return True
+        free = self.max_workers - self._running
+        if free <= 0:
+            return False
+        if cls.running < cls.reserved:
+            return True
+        # a worker beyond the share of the class, if others keep theirs
+        return free > sum(
+            other.reserved - other.running
+            for other in self._classes.values()
+            if other is not cls and other.running < other.reserved
+        )
+
+    def _take(self):
+        '''Returns the jobs waiting (func, args, key, cls) that may start
+        now, counted as running.'''
+        jobs = []
+        while self._queued:
+            best = None
+            for cls in self._classes.values():
+                if cls.flows and (best is None or cls.pass_ < best.pass_) \
+                        and self._may_start(cls):
+                    best = cls
+            if best is None:
+                break
+            self._pass = best.pass_
+            best.pass_ += best.stride
+            flow, queued = next(iter(best.flows.items()))
+            func, args, key = queued.popleft()
+            if queued:
+                best.flows.move_to_end(flow)
+            else:
+                del best.flows[flow]
+            self._queued -= 1
+            self._running += 1
+            best.running += 1
+            jobs.append((func, args, key, best))
+        return jobs
+
+    def _run(self, func, args, key, cls):
+        # the worker keeps its slot while there are jobs waiting for one
+        while True:
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            func = args = None
+            with self._lock:
+                self._leave(key)
+                self._running -= 1
+                cls.running -= 1
+                # the slot freed may let a job of another class start too
+                jobs = self._take()
+            if not jobs:
+                return
+            for job in jobs[1:]:
+                self.spawn(self._run, *job)
+            func, args, key, cls = jobs[0]
+
+    def _work(self, func, args):
+        while True:
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            func = args = None
+            with self._lock:
+                self._idle += 1
+            try:
+                func, args = self._jobs.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # a job may have been queued for this thread meanwhile
+                    if self._jobs.empty():
+                        self._idle -= 1
+                        return
+                    func, args = self._jobs.get()
+
+
+class _Class:
+    def __init__(self, weight, reserved):
+        self.stride = 1 / weight
+        self.reserved = reserved
+        self.running = 0
+        self.pass_ = 0
+        self.flows = collections.OrderedDict() # {flow: deque of jobs}
+
+
+def _classes(shares, max_workers):
+    shares = dict(shares or {})
+    shares.setdefault(DEFAULT, 1)
+    total = sum(shares.values())
+    return {
+        name: _Class(weight, max(1, (max_workers or 0) * weight // total))
+        for name, weight in shares.items()
+    }
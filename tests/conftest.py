@@ -0,0 +1,99 @@
+from socketserver import BaseRequestHandler, ThreadingUnixStreamServer
+import itertools
+import threading
+import tempfile
+import shutil
+import pickle
+import time
+import sys
+import os
+
+import pytest
+
+sys.path.append(os.path.abspath(__file__+'/../..'))
+
+from pyrpc import Client
+
+
+@pytest.fixture
+def serve():
+    '''`serve(ServerType, **kwargs)` starts a server in a thread, on a UNIX
+    socket unless an address is given, and returns it once it answers. The
+    servers are shut down after the test.'''
+    tmpdir = tempfile.mkdtemp(prefix='pyrpc_test_')
+    names = itertools.count()
+    servers = []
+    def serve(server_type, **kwargs):
+        kwargs.setdefault('address', os.path.join(tmpdir, str(next(names))))
+        server = server_type(**kwargs)
+        server.start_in_thread()
+        servers.append(server)
+        wait_connected(server.address)
+        return server
+    yield serve
+    for server in servers:
+        try:
+            server.shutdown_sync()
+        except Exception:
+            pass
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def wait_connected(address, timeout=5):
+    client = Client(address=address, protocol=1)
+    due_time = time.time() + timeout
+    while time.time() < due_time:
+        if client.connected(timeout=1):
+            return
+        time.sleep(0.02)
+    raise RuntimeError('no server at {}'.format(address))
+
+
+def wait_for(predicate, timeout=5):
+    '''Returns once predicate() is true, False if it is not in `timeout`
+    seconds.'''
+    due_time = time.time() + timeout
+    while not predicate():
+        if time.time() >= due_time:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class OldHandler(BaseRequestHandler):
+    '''The handler of servers before the multiplexed protocol: one call per
+    connection, nothing else understood.'''
+    def handle(self):
+        nbytes = int.from_bytes(self._read(4), 'big')
+        try:
+            method_name, args, kwargs = pickle.loads(self._read(nbytes))
+        except Exception:
+            return
+        msg = pickle.dumps((getattr(self.server, method_name)(*args), None))
+        self.request.sendall(len(msg).to_bytes(4, 'big') + msg)
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n-len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+
+class OldServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def echo(self, x):
+        return x
+
+
+@pytest.fixture
+def old_server(tmp_path):
+    '''A server of a release before protocol 2, with an echo method.'''
+    server = OldServer(str(tmp_path / 'old'), OldHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
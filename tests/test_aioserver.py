@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc import aioserver
+
+from conftest import wait_for
+
+
+class AioTestServer(Server):
+    engine = 'asyncio'
+
+    def unpicklable(self):
+        return lambda: None
+
+    def big(self, n):
+        return b'x' * n
+
+    async def abig(self, n):
+        return b'x' * n
+
+    async def loop_thread(self):
+        return threading.get_ident()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def count(self, n):
+        return iter(range(n))
+
+
+def test_unpicklable_result_legacy(serve):
+    server = serve(AioTestServer)
+    client = Client(address=server.address, protocol=1)
+    with pytest.raises(AttributeError, match="Can't pickle"):
+        client.unpicklable()
+    assert client.big(3) == b'xxx'
+
+
+@pytest.fixture
+def encoding_threads(monkeypatch):
+    threads = []
+    encode_frame = aioserver._encode_frame
+    def spy(*args):
+        threads.append(threading.get_ident())
+        return encode_frame(*args)
+    monkeypatch.setattr(aioserver, '_encode_frame', spy)
+    return threads
+
+
+@pytest.mark.parametrize('method', ['big', 'abig'])
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_encoded_off_loop(serve, encoding_threads, method, compression):
+    server = serve(AioTestServer, compress_threshold=2**10)
+    client = Client(address=server.address, compression=compression)
+    loop_thread = client.loop_thread()
+    assert getattr(client, method)(2**16) == b'x' * 2**16
+    assert encoding_threads and loop_thread not in encoding_threads
+
+
+def test_stream_items_encoded_off_loop(serve, encoding_threads):
+    server = serve(AioTestServer)
+    client = Client(address=server.address)
+    loop_thread = client.loop_thread()
+    assert list(client.stream_count(10, stream_window=3)) == list(range(10))
+    assert len(encoding_threads) == 10
+    assert loop_thread not in encoding_threads
+
+
+def test_shutdown_with_call_running(serve, capfd):
+    server = serve(AioTestServer)
+    client = Client(address=server.address)
+    def call():
+        try:
+            client.sleep(0.5)
+        except Exception:
+            pass # the connection is closed on shutdown
+    threading.Thread(target=call, daemon=True).start()
+    assert wait_for(lambda: server._workers.running == 1)
+    server.shutdown_sync()
+    time.sleep(0.7)
+    assert 'Event loop is closed' not in capfd.readouterr().err
+
+
+def test_prefork_nb(serve):
+    server = serve(
+        AioTestServer, processes=2, nonblocking=True,
+    )
+    client = Client(address=server.address, protocol=1)
+    for i in range(10):
+        assert client.nb_big(i, nb_fetch_wait=5) == b'x' * i
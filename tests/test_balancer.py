@@ -0,0 +1,83 @@
+import asyncio
+import socket
+import time
+import os
+
+import pytest
+
+from pyrpc import Client, Server
+
+from conftest import wait_for
+
+
+class ReplicaServer(Server):
+    def where(self):
+        return self.address
+
+
+@pytest.fixture
+def hung(tmp_path):
+    '''The address of a replica accepting connections, never answering.'''
+    address = os.path.join(str(tmp_path), 'hung')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+    sock.listen(100)
+    yield address
+    sock.close()
+
+
+def test_spread(serve):
+    replicas = [serve(ReplicaServer) for i in range(3)]
+    client = Client(address=[r.address for r in replicas])
+    seen = {client.where() for i in range(30)}
+    assert seen == {r.address for r in replicas}
+
+
+def test_dead_replica_ejected(serve, tmp_path):
+    good = serve(ReplicaServer)
+    dead = os.path.join(str(tmp_path), 'dead')
+    client = Client(address=[dead, good.address], health_interval=0.05)
+    for i in range(10):
+        assert client.where() == good.address
+    assert wait_for(lambda: client._balancer.healthy() == [good.address])
+
+
+def test_hung_replica_fails_over(serve, hung):
+    good = serve(ReplicaServer)
+    client = Client(
+        address=[hung, good.address], socket_connect_timeout=0.3,
+        health_interval=100,
+    )
+    for i in range(4):
+        start = time.monotonic()
+        assert client.where() == good.address
+        assert time.monotonic()-start < 1
+
+
+def test_hung_replica_fails_over_co(serve, hung):
+    good = serve(ReplicaServer)
+    client = Client(
+        address=[hung, good.address], socket_connect_timeout=0.3,
+        health_interval=100,
+    )
+    async def main():
+        return [await client.co_where() for i in range(4)]
+    start = time.monotonic()
+    assert asyncio.run(main()) == [good.address] * 4
+    assert time.monotonic()-start < 2
+
+
+def test_probe_of_hung_replica_holds_up_no_call(serve, hung):
+    good = serve(ReplicaServer)
+    client = Client(
+        address=[good.address, hung], health_interval=0.05, health_timeout=1,
+        socket_connect_timeout=1,
+    )
+    assert wait_for(lambda: client._balancer.healthy() == [good.address])
+    slowest = 0
+    due_time = time.monotonic() + 1.5
+    while time.monotonic() < due_time:
+        start = time.monotonic()
+        assert client.where() == good.address
+        slowest = max(slowest, time.monotonic()-start)
+    assert slowest < 0.3
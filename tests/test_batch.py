@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from pyrpc import Client, Server, NoSocket
+
+
+class BatchServer(Server):
+    def echo(self, x):
+        return x
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self):
+        raise KeyError('missing')
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('version', [1, 8])
+def test_results_and_errors(serve, engine, version):
+    server = serve(BatchServer, engine=engine)
+    client = Client(address=server.address, protocol=version)
+    with client.batch() as b:
+        futures = [b.echo(i) for i in range(10)]
+        failed = b.fail()
+        unknown = b.no_such_method()
+    assert [f.result() for f in futures] == list(range(10))
+    with pytest.raises(KeyError):
+        failed.result()
+    with pytest.raises(AttributeError):
+        unknown.result()
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_parallel(serve, engine):
+    server = serve(BatchServer, engine=engine)
+    client = Client(address=server.address)
+    start = time.time()
+    with client.batch(parallel=True) as b:
+        futures = [b.sleep(0.3) for _ in range(5)]
+    assert [f.result() for f in futures] == [0.3] * 5
+    assert time.time()-start < 1
+
+
+def test_nonblocking_server(serve):
+    server = serve(BatchServer, nonblocking=True)
+    client = Client(address=server.address)
+    with client.batch() as b:
+        future = b.echo(1)
+    assert future.result() == 1
+
+
+def test_send_failure():
+    client = Client(address='/nonexistent/pyrpc', socket_connect_timeout=1)
+    b = client.batch()
+    future = b.echo(1)
+    with pytest.raises(NoSocket):
+        b.send()
+    with pytest.raises(NoSocket):
+        future.result(timeout=0)
+
+
+def test_cancelled_on_error(serve):
+    server = serve(BatchServer)
+    client = Client(address=server.address)
+    with pytest.raises(ValueError):
+        with client.batch() as b:
+            future = b.echo(1)
+            raise ValueError()
+    assert future.cancelled()
@@ -0,0 +1,50 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+from pyrpc import Client
+
+spec = importlib.util.spec_from_file_location(
+    'bench', os.path.abspath(__file__+'/../../benchmarks/bench.py')
+)
+bench = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bench)
+
+
+def result(**kwargs):
+    r = {
+        'transport': 'unix', 'server': 'threaded', 'size': 10,
+        'concurrency': 1, 'calls': 100, 'calls_per_second': 1000,
+        'latency_p99': 0.001,
+    }
+    r.update(kwargs)
+    return r
+
+
+def test_case_key():
+    assert bench.case_key(result()) == 'unix/threaded/10/1'
+    assert bench.case_key(result(
+        protocol=Client.protocol, codec=Client.codec
+    )) == 'unix/threaded/10/1'
+    assert bench.case_key(result(protocol=7, codec='json')) == \
+        'unix/threaded/10/1/p7/json'
+
+
+def test_compare(tmp_path, capsys):
+    path = tmp_path / 'before.json'
+    path.write_text(json.dumps({'results': [result()]}))
+    assert bench.compare([result(calls_per_second=950)], str(path), 0.1) == 0
+    assert bench.compare([result(calls_per_second=800)], str(path), 0.1) == 1
+    assert bench.compare([result(latency_p99=0.002)], str(path), 0.1) == 1
+    assert 'REGRESSION' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('codec', ['pickle', 'json'])
+def test_run_case(serve, codec):
+    server = serve(bench.EchoServer)
+    r = bench.run_case(server.address, 'threaded', 1000, 4, 0.1, 10,
+                       codec=codec)
+    assert r['calls'] >= 4 and r['errors'] == 0
+    assert r['latency_p50'] <= r['latency_p99'] <= r['latency_max']
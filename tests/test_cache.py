@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc.cache import call_key
+
+
+class CacheServer(Server):
+    cached_methods = {'kind': None, 'counted': None, 'fleeting': 0.2}
+    runs = 0
+
+    def kind(self, *args, **kwargs):
+        return [type(a).__name__ for a in args], \
+            {k: type(v).__name__ for k, v in kwargs.items()}
+
+    def counted(self, x):
+        self.runs += 1
+        return self.runs
+
+    def fleeting(self):
+        self.runs += 1
+        return self.runs
+
+
+def test_keys_of_equal_values_of_other_types():
+    keys = {call_key('f', (x,), {}) for x in (1, True, 1.0, '1', b'1')}
+    assert len(keys) == 5
+    assert call_key('f', ([1],), {}) != call_key('f', ((1,),), {})
+    assert call_key('f', ((1,),), {}) != call_key('f', ((True,),), {})
+    assert call_key('f', ({1: 1},), {}) != call_key('f', ({True: 1},), {})
+    assert call_key('f', (), {'a': 1}) != call_key('f', (), {'a': 1.0})
+    assert call_key('f', ({'a': [1]},), {}) == call_key('f', ({'a': [1]},), {})
+    assert call_key('f', ({1, 2},), {}) != call_key('f', ({1.0, 2},), {})
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_values_of_other_types_not_shared(serve, engine):
+    server = serve(CacheServer, engine=engine)
+    client = Client(address=server.address)
+    for i in range(2):
+        assert client.kind(1) == (['int'], {})
+        assert client.kind(True) == (['bool'], {})
+        assert client.kind(1.0) == (['float'], {})
+        assert client.kind(x=1) == ([], {'x': 'int'})
+        assert client.kind(x=False) == ([], {'x': 'bool'})
+    assert server.cache_stats()['hits'] == 5
+
+
+def test_hits_and_invalidate(serve):
+    server = serve(CacheServer)
+    client = Client(address=server.address)
+    assert client.counted([1, 2]) == 1
+    assert client.counted([1, 2]) == 1
+    assert client.counted((1, 2)) == 2
+    server.invalidate_cache('counted', ([1, 2],))
+    assert client.counted([1, 2]) == 3
+    assert client.counted((1, 2)) == 2
+
+
+def test_unhashable_not_cached(serve):
+    server = serve(CacheServer)
+    client = Client(address=server.address)
+    assert client.counted(bytearray(b'x')) == 1
+    assert client.counted(bytearray(b'x')) == 2
+
+
+def test_ttl(serve):
+    server = serve(CacheServer)
+    client = Client(address=server.address)
+    assert client.fleeting() == client.fleeting() == 1
+    time.sleep(0.3)
+    assert client.fleeting() == 2
@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+
+from pyrpc import Client, Server
+
+
+class CoalescingServer(Server):
+    coalesced_methods = ('kind',)
+    runs = 0
+
+    def kind(self, x):
+        self.runs += 1
+        time.sleep(0.3)
+        return type(x).__name__
+
+
+def call_at_once(func, args):
+    '''Returns the results of func(arg) for each arg, called from threads
+    at the same time.'''
+    results = [None] * len(args)
+    def call(i):
+        results[i] = func(args[i])
+    threads = [
+        threading.Thread(target=call, args=(i,)) for i in range(len(args))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_equal_calls_share_a_run(serve, engine):
+    server = serve(CoalescingServer, engine=engine)
+    client = Client(address=server.address)
+    assert call_at_once(client.kind, [1] * 8) == ['int'] * 8
+    assert server.runs == 1
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_equal_values_of_other_types_run_apart(serve, engine):
+    server = serve(CoalescingServer, engine=engine)
+    client = Client(address=server.address)
+    args = [1, True, 1.0, 1, True, 1.0]
+    assert call_at_once(client.kind, args) == \
+        ['int', 'bool', 'float', 'int', 'bool', 'float']
+    assert server.runs == 3
+
+
+def test_nonblocking(serve):
+    server = serve(CoalescingServer, nonblocking=True)
+    client = Client(address=server.address)
+    assert call_at_once(client.nb_kind, [1, True, 1, True]) == \
+        ['int', 'bool', 'int', 'bool']
+    assert server.runs == 2
@@ -0,0 +1,76 @@
+import pytest
+
+from pyrpc import Client, Server, ProtocolError
+from pyrpc import codec as codecmod
+
+
+class CodecServer(Server):
+    def echo(self, x):
+        return x
+
+    def same(self, x):
+        return x
+
+    def fail(self):
+        raise KeyError('missing')
+
+    def custom_fail(self):
+        raise CustomError('custom')
+
+    def unencodable(self):
+        return lambda: None
+
+
+class CustomError(Exception):pass
+
+
+@pytest.mark.parametrize('name', ['pickle', 'marshal', 'json'])
+def test_roundtrip(name):
+    codec = codecmod.get(name)
+    obj = (None, {'a': [1, 2.5, 'x', True, None]})
+    assert codec.loads(codec.dumps(obj)) == obj
+
+
+@pytest.mark.parametrize('name', ['marshal', 'json'])
+def test_exceptions_rebuilt(name):
+    codec = codecmod.get(name)
+    e = KeyError('k')
+    e.traceback = 'tb'
+    ret, exc = codec.loads(codec.dumps((None, e)))
+    assert type(exc) is KeyError and exc.args == ('k',)
+    assert exc.traceback == 'tb'
+    ret, exc = codec.loads(codec.dumps((None, CustomError('c'))))
+    assert type(exc) is Exception and exc.className == 'CustomError'
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('name', ['pickle', 'marshal', 'json'])
+def test_calls(serve, engine, name):
+    server = serve(CodecServer, engine=engine)
+    client = Client(address=server.address, codec=name)
+    assert client.echo({'a': [1, 'b']}) == {'a': [1, 'b']}
+    with pytest.raises(KeyError):
+        client.fail()
+    with pytest.raises(Exception, match='custom'):
+        client.custom_fail()
+    with pytest.raises(Exception):
+        client.unencodable()
+    assert client.echo(2) == 2
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_method_codecs(serve, engine):
+    server = serve(CodecServer, engine=engine)
+    client = Client(address=server.address, method_codecs={'echo': 'json'})
+    # json arrives as lists, pickle keeps the tuple
+    assert client.echo((1, 2)) == [1, 2]
+    assert client.same((1, 2)) == (1, 2)
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_codec_not_accepted(serve, engine):
+    server = serve(CodecServer, engine=engine, codecs=['pickle'])
+    client = Client(address=server.address, codec='json')
+    with pytest.raises(ProtocolError, match='not accepted'):
+        client.echo(1)
+    assert Client(address=server.address).echo(1) == 1
@@ -0,0 +1,70 @@
+import pytest
+
+from pyrpc import Client, Server, ProtocolError
+from pyrpc import compression
+
+
+class CompressionServer(Server):
+    def echo(self, x):
+        return x
+
+    def zeros(self, n):
+        return bytes(n)
+
+
+@pytest.mark.parametrize('name', ['zlib', 'lzma', 'bz2'])
+def test_roundtrip(name):
+    compressor = compression.get(name)
+    buffers = [b'a' * 1000, memoryview(b'b' * 10), bytearray(b'c')]
+    data = compressor.compress(buffers)
+    assert len(data) < 1011
+    assert compressor.decompress(data) == b''.join(buffers)
+    assert compressor.decompress(data, 1011) == b''.join(buffers)
+
+
+@pytest.mark.parametrize('name', ['zlib', 'lzma', 'bz2'])
+def test_decompress_limited(name):
+    compressor = compression.get(name)
+    data = compressor.compress([bytes(10**6)])
+    with pytest.raises(ProtocolError, match='over'):
+        compressor.decompress(data, 10**6 - 1)
+    with pytest.raises(ProtocolError, match='truncated'):
+        compressor.decompress(data[:len(data)//2])
+    with pytest.raises(ProtocolError):
+        compressor.decompress(b'not compressed')
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('name', ['zlib', 'lzma', 'bz2'])
+def test_calls(serve, engine, name):
+    server = serve(CompressionServer, engine=engine, compress_threshold=100)
+    client = Client(
+        address=server.address, compression=name, compress_threshold=100
+    )
+    assert client.echo(b'x' * 10**5) == b'x' * 10**5
+    assert client.zeros(10**5) == bytes(10**5)
+    assert client.echo('small') == 'small'
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_server_compression(serve, engine):
+    server = serve(
+        CompressionServer, engine=engine, compression='zlib',
+        compress_threshold=100,
+    )
+    client = Client(address=server.address)
+    assert client.zeros(10**6) == bytes(10**6)
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_max_decompressed(serve, engine):
+    server = serve(
+        CompressionServer, engine=engine, max_decompressed=10**5,
+    )
+    client = Client(
+        address=server.address, compression='zlib', compress_threshold=100
+    )
+    with pytest.raises(ProtocolError, match='over 100000 bytes'):
+        client.echo(bytes(10**7))
+    # the connection is still served
+    assert client.echo(bytes(10**4)) == bytes(10**4)
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+
+from pyrpc import Client, Server, Timeout
+
+
+class CoServer(Server):
+    def echo(self, x):
+        return x
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self):
+        raise KeyError('missing')
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('version', [1, 2, 8])
+def test_calls(serve, engine, version):
+    server = serve(CoServer, engine=engine)
+    client = Client(address=server.address, protocol=version)
+    async def main():
+        assert await client.co_echo(b'x' * 10**6) == b'x' * 10**6
+        with pytest.raises(KeyError):
+            await client.co_fail()
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_many_in_flight(serve, engine):
+    server = serve(CoServer, engine=engine, max_workers=200)
+    client = Client(address=server.address)
+    async def main():
+        start = time.time()
+        results = await asyncio.gather(*(
+            client.co_sleep(0.2) for _ in range(100)
+        ))
+        assert results == [0.2] * 100
+        # all at the same time, over one connection
+        assert time.time()-start < 2
+        states = list(client._loop_costate.values())
+        assert len(states) == 1
+        assert len(states[0].address_conn) == 1
+    asyncio.run(main())
+
+
+def test_call_timeout(serve):
+    server = serve(CoServer)
+    client = Client(address=server.address)
+    async def main():
+        with pytest.raises(Timeout):
+            await client.co_sleep(1, call_timeout=0.2)
+        assert await client.co_echo(1) == 1
+    asyncio.run(main())
+
+
+def test_old_server(old_server):
+    client = Client(address=old_server.server_address)
+    async def main():
+        assert await client.co_echo(1) == 1
+        assert await client.co_echo(2) == 2
+    asyncio.run(main())
+
+
+def test_loops_one_after_another(serve):
+    server = serve(CoServer)
+    client = Client(address=server.address)
+    async def main(x):
+        return await client.co_echo(x)
+    for i in range(3):
+        assert asyncio.run(main(i)) == i
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from pyrpc import Client, Server, Timeout, Expired, current_call
+
+from conftest import wait_for
+
+
+class DeadlineServer(Server):
+    def __init__(self, *args, **kwargs):
+        self.ran = []
+        self.checked = []
+        super().__init__(*args, **kwargs)
+
+    def remaining(self):
+        return current_call().remaining()
+
+    def sleep(self, seconds):
+        self.ran.append(seconds)
+        time.sleep(seconds)
+        return seconds
+
+    def check_after(self, seconds):
+        time.sleep(seconds)
+        try:
+            current_call().check()
+        except Expired:
+            self.checked.append('expired')
+            raise
+        self.checked.append('ok')
+        return 'ok'
+
+    async def aremaining(self):
+        return current_call().remaining()
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_remaining(serve, engine):
+    server = serve(DeadlineServer, engine=engine)
+    client = Client(address=server.address)
+    assert 0 < client.remaining(call_timeout=5) <= 5
+    if engine == 'asyncio':
+        assert 0 < client.aremaining(call_timeout=5) <= 5
+
+
+@pytest.mark.parametrize('version', [1, 5])
+def test_no_deadline_from_older_clients(serve, version):
+    server = serve(DeadlineServer)
+    client = Client(address=server.address, protocol=version)
+    assert client.remaining(call_timeout=5) is None
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_shed_before_run(serve, engine):
+    server = serve(DeadlineServer, engine=engine, max_workers=1)
+    client = Client(address=server.address)
+    slow = threading.Thread(target=client.sleep, args=(0.6,))
+    slow.start()
+    assert wait_for(lambda: server.ran == [0.6])
+    with pytest.raises(Timeout):
+        client.sleep(0.01, call_timeout=0.2)
+    slow.join()
+    # dropped when a worker got free, past its deadline
+    time.sleep(0.1)
+    assert server.ran == [0.6]
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_check(serve, engine):
+    server = serve(DeadlineServer, engine=engine)
+    client = Client(address=server.address)
+    assert client.check_after(0, call_timeout=5) == 'ok'
+    with pytest.raises(Timeout):
+        client.check_after(0.4, call_timeout=0.2)
+    assert wait_for(lambda: server.checked == ['ok', 'expired'])
+
+
+def test_expired_is_timeout():
+    assert issubclass(Expired, Timeout)
@@ -0,0 +1,75 @@
+import threading
+import time
+
+from pyrpc import Client, Server
+from pyrpc import jobs
+
+
+def job(id_, due_in):
+    return {'id': id_, 'due_time': time.time() + due_in}
+
+
+def test_expire_due_only():
+    store = jobs.JobStore()
+    for id_, due_in in [(1, -2), (2, 60), (3, -1)]:
+        store.add(job(id_, due_in))
+    request = store.get(1)
+    assert store.expire(0) == [1, 3]
+    assert request['cancelled']
+    assert len(store) == 1 and 2 in store
+
+
+def test_expire_put_again():
+    store = jobs.JobStore()
+    store.add(job(1, -1))
+    store.pop(1)
+    store.add(job(1, 60))
+    # the entry of the first put is stale
+    assert store.expire(0) == []
+    assert 1 in store
+
+
+def test_expire_wakes_for_earlier_job():
+    store = jobs.JobStore()
+    store.add(job(1, 60))
+    expired = []
+    def expire():
+        # as the server does, each call waits for the first due time
+        while not expired:
+            expired.extend(store.expire(5))
+    thread = threading.Thread(target=expire, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    store.add(job(2, 0.1))
+    thread.join(1)
+    assert expired == [2]
+
+
+def test_max_bytes():
+    store = jobs.JobStore(max_bytes=1000)
+    small, big = job(1, 60), job(2, 60)
+    store.add(small)
+    store.add(big)
+    small['ret'] = store.keep(small, b'x' * 500)
+    big['ret'] = store.keep(big, b'y' * 1000)
+    assert small['ret'] == b'x' * 500
+    assert isinstance(big['ret'], jobs._Spilled)
+    assert jobs.result(big) == b'y' * 1000
+    assert 500 < store.nbytes <= 1000
+    store.pop(1)
+    assert store.nbytes == 0
+
+
+class NbServer(Server):
+    nonblocking = True
+
+    def data(self, n):
+        return b'x' * n
+
+
+def test_spilled_results_served(serve):
+    server = serve(NbServer, nb_max_bytes=1000)
+    client = Client(address=server.address)
+    assert client.nb_data(10**6) == b'x' * 10**6
+    assert client.nb_data(10) == b'x' * 10
+    assert server._jobs.nbytes == 0
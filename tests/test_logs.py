@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc import logs
+
+from conftest import wait_for
+
+
+def test_short_repr_bounded():
+    for obj in [b'x' * 10**7, bytearray(10**7), 'x' * 10**7,
+                list(range(10**6)), {i: i for i in range(10**5)},
+                memoryview(bytes(10**7)), KeyError('x' * 10**6)]:
+        assert len(logs.short_repr(obj)) < 400
+
+
+def test_call_msg_bounded():
+    msg = logs.call_msg('m', (b'x' * 10**6,), {'k': 'v' * 10**6}, 'r' * 10**6)
+    assert msg.startswith('m(args=') and len(msg) <= 125
+
+
+def test_short_lines():
+    assert logs.short_lines('a\n' + 'b' * 300, 10) == 'a\n' + 'b' * 10 + '...'
+
+
+def test_writer_thread():
+    written = []
+    def log(msg):
+        written.append((msg, threading.get_ident()))
+    logs.submit(log, str.upper, 'abc')
+    logs.flush(1)
+    assert written[0][0] == 'ABC'
+    assert written[0][1] != threading.get_ident()
+
+
+class LoggedServer(Server):
+    log_async = False
+
+    def __init__(self, *args, **kwargs):
+        self.calls = []
+        self.errors = []
+        super().__init__(*args, **kwargs)
+
+    def echo(self, x):
+        return x
+
+    def fail(self):
+        raise KeyError('missing')
+
+    def get_call_logging_func(self):
+        return self.calls.append
+
+    def get_exception_logging_func(self):
+        return self.errors.append
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_server_logs(serve, engine):
+    server = serve(LoggedServer, engine=engine)
+    client = Client(address=server.address)
+    client.echo(b'x' * 10**6)
+    with pytest.raises(KeyError):
+        client.fail()
+    # logged once the response is sent
+    echoed = lambda: [msg for msg in server.calls if msg.startswith('echo')]
+    assert wait_for(lambda: server.errors and echoed())
+    assert len(echoed()) == 1 and len(echoed()[0]) <= 125
+    assert len(server.errors) == 1 and 'missing' in server.errors[0]
+
+
+def test_sampled(serve):
+    server = serve(LoggedServer, log_sample=0)
+    client = Client(address=server.address)
+    client.echo(1)
+    with pytest.raises(KeyError):
+        client.fail()
+    # failed calls are all logged
+    assert wait_for(lambda: server.errors)
+    assert server.calls == []
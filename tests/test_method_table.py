@@ -0,0 +1,95 @@
+import pytest
+
+from pyrpc import Client, Server, Stub
+from pyrpc import handler
+
+
+class TableServer(Server):
+    def echo(self, x):
+        return x
+
+    def secret(self):
+        return 'secret'
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    '''The requests the server decodes, as the client sent them.'''
+    requests = []
+    decode = handler._decode
+    def spy(parent, codec, body):
+        requests.append(codec.loads(body))
+        return decode(parent, codec, body)
+    monkeypatch.setattr(handler, '_decode', spy)
+    monkeypatch.setattr('pyrpc.aioserver._decode', spy)
+    return requests
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('codec', ['pickle', 'marshal', 'json'])
+def test_calls_by_id(serve, sent, engine, codec):
+    server = serve(TableServer, engine=engine)
+    client = Client(address=server.address, codec=codec)
+    assert client.echo(1) == 1
+    assert type(sent[-1][0]) is int
+    assert client.connected()
+
+
+def test_calls_by_name_over_protocol_7(serve, sent):
+    server = serve(TableServer)
+    client = Client(address=server.address, protocol=7)
+    assert client.echo(1) == 1
+    assert sent[-1][0] == 'echo'
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_replaced_method_called(serve, engine):
+    server = serve(TableServer, engine=engine)
+    old_client = Client(address=server.address)
+    assert old_client.echo(1) == 1
+    server.echo = lambda x: ('v2', x)
+    assert old_client.echo(1) == ('v2', 1)
+    assert Client(address=server.address).echo(1) == ('v2', 1)
+
+
+def test_method_added_later_called_by_name(serve):
+    server = serve(TableServer)
+    client = Client(address=server.address)
+    assert client.echo(1) == 1
+    server.added = lambda: 'added'
+    assert client.added() == 'added'
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_exposed_methods(serve, engine):
+    server = serve(TableServer, engine=engine, exposed_methods=('echo',))
+    for protocol in (8, 1):
+        client = Client(address=server.address, protocol=protocol)
+        assert client.echo(1) == 1
+        assert client.connected()
+        with pytest.raises(AttributeError):
+            client.secret()
+        with pytest.raises(AttributeError):
+            client.shutdown_sync()
+
+
+def test_unknown_id(serve):
+    server = serve(TableServer)
+    client = Client(address=server.address)
+    assert client.echo(1) == 1
+    conn = client._get_mux(server.address, 1, 1)
+    conn.methods = {'echo': 10**6}
+    with pytest.raises(Exception, match='no method id'):
+        client.echo(1)
+
+
+def test_stubs(serve):
+    server = serve(TableServer)
+    client = Client(address=server.address)
+    assert type(client.echo) is Stub
+    assert client.echo is client.echo
+    assert client.echo(1, call_timeout=1) == 1
+    stub = client.echo
+    client.call_timeout = 5
+    assert client.echo is not stub
+    assert client.echo(2) == 2
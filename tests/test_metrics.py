@@ -0,0 +1,80 @@
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc import metrics
+
+from conftest import wait_for
+
+
+class MetricServer(Server):
+    def echo(self, x):
+        return x
+
+    def fail(self):
+        raise KeyError('missing')
+
+
+def test_percentiles():
+    m = metrics.Metrics()
+    for i in range(1, 101):
+        m.begin('f')
+        m.record('f', i / 1000, error=i > 90, phases=[('send', 0.001)])
+    stats = m.snapshot()['f']
+    assert stats['calls'] == 100 and stats['errors'] == 10
+    assert stats['in_progress'] == 0
+    # bucket bounds, within 13%
+    assert 0.050 <= stats['p50'] <= 0.050 * 1.13
+    assert 0.099 <= stats['p99'] <= 0.099 * 1.13
+    assert stats['send_time'] == pytest.approx(0.1)
+
+
+def test_prometheus_format():
+    m = metrics.Metrics()
+    m.begin('a"b')
+    m.record('a"b', 0.01, nbytes_in=10)
+    text = metrics.prometheus('x', m.snapshot(), gauges={'jobs': 3})
+    assert 'x_calls_total{method="a\\"b"} 1' in text
+    assert 'x_latency_seconds_count{method="a\\"b"} 1' in text
+    assert 'x_bytes_total{method="a\\"b",direction="in"} 10' in text
+    assert '# TYPE x_jobs gauge\nx_jobs 3' in text
+    assert text.endswith('\n')
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_server_stats(serve, engine):
+    server = serve(MetricServer, engine=engine, metrics=True)
+    client = Client(address=server.address)
+    for i in range(5):
+        client.echo(b'x' * 100)
+    with pytest.raises(KeyError):
+        client.fail()
+    # recorded just after the response is sent
+    assert wait_for(lambda: client.stats()['methods']['fail']['calls'] == 1)
+    stats = client.stats()
+    echo = stats['methods']['echo']
+    assert echo['calls'] == 5 and echo['errors'] == 0
+    assert echo['execute_count'] == 5
+    assert echo['bytes_in'] > 500 and echo['bytes_out'] > 500
+    assert stats['methods']['fail']['errors'] == 1
+    assert stats['workers_running'] >= 0 and stats['queue_depth'] == 0
+    text = client.stats(format='prometheus')
+    assert 'pyrpc_calls_total{method="echo"} 5' in text
+
+
+def test_stats_without_metrics(serve):
+    server = serve(MetricServer)
+    client = Client(address=server.address)
+    assert client.stats()['methods'] == {}
+
+
+def test_client_stats(serve):
+    server = serve(MetricServer)
+    client = Client(address=server.address, metrics=True)
+    client.echo(1)
+    with pytest.raises(KeyError):
+        client.fail()
+    stats = client.call_stats()
+    assert stats['echo']['calls'] == 1 and stats['fail']['errors'] == 1
+    assert stats['echo']['wait_time'] > 0
+    assert 'pyrpc_client_calls_total{method="echo"} 1' in \
+        client.call_stats(format='prometheus')
@@ -0,0 +1,136 @@
+import threading
+import socket
+import time
+import os
+
+import pytest
+
+from pyrpc import Client, Server, Timeout
+from pyrpc import mux
+
+from conftest import wait_for
+
+
+class MuxServer(Server):
+    def echo(self, x):
+        return x
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self):
+        raise KeyError('missing')
+
+    def count(self, n):
+        return iter(range(n))
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('version', range(1, 9))
+def test_protocol_versions(serve, engine, version):
+    server = serve(MuxServer, engine=engine)
+    client = Client(address=server.address, protocol=version)
+    assert client.echo(b'x' * 10**6) == b'x' * 10**6
+    with pytest.raises(KeyError):
+        client.fail()
+    assert client.echo([1]) == [1]
+    if version > 1:
+        assert len(client._address_mux) == 1
+
+
+@pytest.mark.parametrize('version', [1, 2, 8])
+def test_old_server(old_server, version):
+    client = Client(address=old_server.server_address, protocol=version)
+    for i in range(3):
+        assert client.echo(i) == i
+    if version > 1:
+        assert old_server.server_address in client._legacy_addresses
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_pipelined(serve, engine):
+    server = serve(MuxServer, engine=engine)
+    client = Client(address=server.address)
+    client.echo(0)
+    slow = threading.Thread(target=client.sleep, args=(1,))
+    slow.start()
+    start = time.time()
+    assert client.echo(1) == 1
+    assert time.time()-start < 0.5
+    slow.join()
+    assert len(client._address_mux) == 1
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_concurrent_calls_matched(serve, engine):
+    server = serve(MuxServer, engine=engine)
+    client = Client(address=server.address)
+    errors = []
+    def work(n):
+        for i in range(50):
+            if client.echo((n, i)) != (n, i):
+                errors.append((n, i))
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_timeout_keeps_connection(serve, engine):
+    server = serve(MuxServer, engine=engine)
+    client = Client(address=server.address)
+    with pytest.raises(Timeout):
+        client.sleep(1, call_timeout=0.2)
+    conn = list(client._address_mux.values())[0]
+    assert client.echo(1) == 1
+    assert list(client._address_mux.values())[0] is conn
+
+
+def test_unsent_once_closed_by_peer():
+    a, b = socket.socketpair(socket.AF_UNIX)
+    conn = mux.MuxConnection(a)
+    b.close()
+    # seen closed, or failing to send, never written
+    with pytest.raises(mux.Unsent):
+        conn.call([b'x'], 1)
+    assert conn.closed
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_closed_by_server_while_idle(serve, monkeypatch, stream):
+    server = serve(MuxServer, keepalive_timeout=0.2)
+    client = Client(address=server.address)
+    assert client.echo(1) == 1
+    conn = list(client._address_mux.values())[0]
+    assert wait_for(lambda: conn.closed)
+    # as if the close was not seen yet when the call got the connection
+    known_mux = client._known_mux
+    stale = [conn]
+    def known_stale(address):
+        if stale:
+            return True, stale.pop()
+        return known_mux(address)
+    monkeypatch.setattr(client, '_known_mux', known_stale)
+    if stream:
+        assert list(client.stream_count(3)) == [0, 1, 2]
+    else:
+        assert client.echo(2) == 2
+    assert not stale
+    assert list(client._address_mux.values())[0] is not conn
+
+
+def test_forked_child(serve):
+    server = serve(MuxServer)
+    client = Client(address=server.address)
+    assert client.echo(1) == 1
+    pid = os.fork()
+    if pid == 0:
+        # the connection of the parent is not shared
+        code = 0 if client.echo(2) == 2 else 1
+        os._exit(code)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert client.echo(3) == 3
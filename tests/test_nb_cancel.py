@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from pyrpc import Client, Server, Timeout, Cancelled, current_call
+
+from conftest import wait_for
+
+
+class JobServer(Server):
+    nonblocking = True
+
+    def __init__(self, *args, **kwargs):
+        self.ran = []
+        self.outcomes = []
+        super().__init__(*args, **kwargs)
+
+    def work(self, seconds):
+        self.ran.append(seconds)
+        due_time = time.time() + seconds
+        try:
+            while time.time() < due_time:
+                current_call().check()
+                time.sleep(0.02)
+        except Cancelled:
+            self.outcomes.append('cancelled')
+            raise
+        self.outcomes.append('done')
+        return seconds
+
+    def steps(self, n):
+        for i in range(n):
+            current_call().report((i+1) / n)
+            time.sleep(0.1)
+        return n
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_timed_out_job_cancelled(serve, engine):
+    server = serve(JobServer, engine=engine)
+    client = Client(address=server.address)
+    with pytest.raises(Timeout):
+        client.nb_work(5, call_timeout=0.3, nb_fetch_wait=1)
+    assert wait_for(lambda: server.outcomes == ['cancelled'])
+    assert wait_for(lambda: len(server._jobs) == 0)
+
+
+def test_waiting_job_not_run(serve):
+    server = serve(JobServer, max_workers=1)
+    client = Client(address=server.address)
+    holder = threading.Thread(target=client.nb_work, args=(0.6,))
+    holder.start()
+    assert wait_for(lambda: server.ran == [0.6])
+    with pytest.raises(Timeout):
+        client.nb_work(0.01, call_timeout=0.2, nb_fetch_wait=1)
+    holder.join()
+    time.sleep(0.1)
+    assert server.ran == [0.6]
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_progress(serve, engine):
+    server = serve(JobServer, engine=engine)
+    client = Client(address=server.address)
+    progress = []
+    assert client.nb_steps(
+        5, nb_progress=progress.append, nb_fetch_tick=0.05
+    ) == 5
+    assert progress and progress == sorted(progress)
+    assert set(progress) <= {0.2, 0.4, 0.6, 0.8, 1.0}
+
+
+def test_no_job_outside_nonblocking_calls(serve):
+    server = serve(JobServer)
+    client = Client(address=server.address)
+    # report() is a no-op for blocking calls
+    assert client.steps(1) == 1
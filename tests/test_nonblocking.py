@@ -0,0 +1,140 @@
+import threading
+import signal
+import time
+import os
+
+import pytest
+
+from pyrpc import Client, Server, Timeout
+from pyrpc import handler
+from pyrpc.prefork import Prefork
+
+from conftest import wait_for
+
+
+class NbServer(Server):
+    nonblocking = True
+
+    def echo(self, x):
+        return x
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self):
+        raise KeyError('missing')
+
+    def hold(self, path):
+        with open(path, 'w') as f:
+            f.write(str(os.getpid()))
+        time.sleep(60)
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('version', [1, 8])
+def test_result_pushed(serve, engine, version):
+    server = serve(NbServer, engine=engine)
+    client = Client(address=server.address, protocol=version)
+    start = time.time()
+    # answered as the job finishes, not on the next poll
+    assert client.nb_sleep(0.3, nb_fetch_tick=5, nb_fetch_wait=5) == 0.3
+    assert time.time()-start < 2
+    with pytest.raises(KeyError):
+        client.nb_fail()
+
+
+def test_polled_without_wait(serve):
+    server = serve(NbServer)
+    client = Client(address=server.address)
+    assert client.nb_sleep(0.1, nb_fetch_wait=0, nb_fetch_tick=0.05) == 0.1
+
+
+def test_wait_capped_by_server(serve):
+    server = serve(NbServer, nb_max_wait=0.1)
+    client = Client(address=server.address)
+    assert client.nb_sleep(0.5, nb_fetch_wait=5, nb_fetch_tick=0.05) == 0.5
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_subscribed(serve, engine):
+    server = serve(NbServer, engine=engine)
+    client = Client(address=server.address, nb_subscribe=True)
+    results = {}
+    def work(n):
+        results[n] = client.nb_sleep(0.01 * n)
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {n: 0.01 * n for n in range(20)}
+    with pytest.raises(KeyError):
+        client.nb_fail()
+    assert client._subscriber is not None
+
+
+def test_jobs_dropped_once_fetched(serve):
+    server = serve(NbServer)
+    client = Client(address=server.address)
+    for i in range(5):
+        assert client.nb_echo(i) == i
+    assert wait_for(lambda: len(server._jobs) == 0)
+
+
+def test_subscription_not_understood(serve, monkeypatch):
+    server = serve(NbServer)
+    client = Client(address=server.address, nb_subscribe=True,
+                    nb_fetch_tick=0.05)
+    fetch_subscribed = handler._fetch_subscribed
+    answers = [None]
+    def fetch_once_none(parent, data):
+        if answers:
+            return answers.pop()
+        return fetch_subscribed(parent, data)
+    monkeypatch.setattr(handler, '_fetch_subscribed', fetch_once_none)
+    assert client.nb_sleep(0.2, call_timeout=5) == 0.2
+    assert not answers
+    assert wait_for(lambda: not client._subscriber._worker_ids)
+
+
+@pytest.mark.parametrize('version', [1, 8])
+def test_subscribed_prefork(serve, version):
+    server = serve(NbServer, processes=2)
+    client = Client(address=server.address, protocol=version,
+                    nb_subscribe=True)
+    results = {}
+    def work(n):
+        results[n] = client.nb_sleep(0.01 * n, call_timeout=10)
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {n: 0.01 * n for n in range(10)}
+
+
+@pytest.mark.parametrize('version', [1, 8])
+def test_subscribed_worker_killed(serve, monkeypatch, tmp_path, version):
+    # the worker stays dead while the call is pending
+    monkeypatch.setattr(Prefork, 'restart_interval', 10)
+    server = serve(NbServer, processes=2)
+    client = Client(address=server.address, protocol=version,
+                    nb_subscribe=True, nb_fetch_tick=0.05)
+    path = str(tmp_path / 'pid')
+    errors = []
+    def call():
+        try:
+            client.nb_hold(path, call_timeout=1.5)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=call)
+    thread.start()
+    assert wait_for(lambda: os.path.exists(path) and open(path).read())
+    os.kill(int(open(path).read()), signal.SIGKILL)
+    thread.join()
+    assert len(errors) == 1 and isinstance(errors[0], Timeout)
+    # the subscriber of the dead worker is done with, not stuck
+    assert wait_for(lambda: not client._subscriber._worker_ids)
+    for i in range(3):
+        assert client.nb_echo(i, call_timeout=5) == i
@@ -0,0 +1,73 @@
+import threading
+import socket
+
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc import protocol
+
+BIG = protocol.OOB_THRESHOLD
+
+
+class EchoServer(Server):
+    def echo(self, x):
+        return x
+
+    def types(self, x):
+        return type(x).__name__
+
+
+@pytest.mark.parametrize('obj', [
+    b'x' * BIG,
+    bytearray(b'x' * BIG),
+    (1, {'a': b'x' * BIG}, [b'y' * BIG, 'z']),
+    {'nested': [[memoryview(b'x' * BIG)]]},
+])
+def test_out_of_band(obj):
+    parts = protocol.dumps(obj)
+    assert len(parts) > 1
+    assert protocol.loads(parts) == obj
+
+
+def test_small_in_band():
+    parts = protocol.dumps((b'x' * 100, bytearray(100), 'x' * BIG))
+    assert len(parts) == 1
+
+
+def test_types_kept():
+    bytes_, array, view = protocol.loads(protocol.dumps(
+        (b'x' * BIG, bytearray(BIG), memoryview(bytes(BIG)))
+    ))
+    assert type(bytes_) is bytes
+    assert type(array) is bytearray
+    assert type(view) is memoryview and view.nbytes == BIG
+
+
+def test_frame_roundtrip():
+    a, b = socket.socketpair()
+    obj = (b'x' * BIG, [bytearray(b'y' * BIG)], 'small')
+    def send():
+        protocol.sendall(a, protocol.pack(7, protocol.RESPONSE,
+                                          protocol.dumps(obj)))
+    thread = threading.Thread(target=send)
+    thread.start()
+    id_, kind, flags, parts = protocol.read_frame(b)
+    thread.join()
+    assert (id_, kind) == (7, protocol.RESPONSE)
+    assert flags & protocol.OOB
+    assert protocol.loads(parts) == obj
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('version', [1, 8])
+def test_calls(serve, engine, version):
+    server = serve(EchoServer, engine=engine)
+    client = Client(address=server.address, protocol=version)
+    for obj in [b'x' * 10**7, bytearray(10**6), {'k': [b'v' * BIG]}]:
+        assert client.echo(obj) == obj
+    assert client.types(bytearray(BIG)) == 'bytearray'
+    if version > 1:
+        # plain pickles can't hold memoryviews
+        assert client.types(memoryview(bytes(BIG))) == 'memoryview'
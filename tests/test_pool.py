@@ -0,0 +1,94 @@
+import threading
+import socket
+import time
+
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc.pool import ConnectionPool
+
+
+class ThreadServer(Server):
+    def thread(self):
+        return threading.get_ident()
+
+
+def idle_count(client, address):
+    return len(client._pool._address_idle.get(address, []))
+
+
+def test_legacy_connection_reused(serve):
+    server = serve(ThreadServer)
+    client = Client(address=server.address, protocol=1)
+    # one handler thread serves the calls of one connection
+    assert len({client.thread() for _ in range(10)}) == 1
+    assert idle_count(client, server.address) == 1
+
+
+def test_no_reuse(serve):
+    server = serve(ThreadServer)
+    client = Client(address=server.address, protocol=1, pool_size=0)
+    client.thread()
+    client.thread()
+    assert idle_count(client, server.address) == 0
+
+
+def test_closed_by_server_while_idle(serve):
+    server = serve(ThreadServer, keepalive_timeout=0.1)
+    client = Client(address=server.address, protocol=1)
+    client.thread()
+    time.sleep(0.3)
+    # the pooled connection is found closed and replaced
+    assert isinstance(client.thread(), int)
+    assert idle_count(client, server.address) == 1
+
+
+def test_synchronous_server(serve):
+    server = serve(ThreadServer, synchronous=True)
+    client = Client(address=server.address, protocol=1)
+    for _ in range(5):
+        client.thread()
+
+
+def test_pool_idle_timeout():
+    pool = ConnectionPool(maxsize=2, idle_timeout=0.05)
+    a, b = socket.socketpair()
+    pool.put('x', a)
+    assert pool.get('x') is a
+    pool.put('x', a)
+    time.sleep(0.1)
+    assert pool.get('x') is None
+    assert a.fileno() == -1
+    b.close()
+
+
+def test_pool_drops_dead_and_extra():
+    pool = ConnectionPool(maxsize=1)
+    a, b = socket.socketpair()
+    c, d = socket.socketpair()
+    pool.put('x', a)
+    pool.put('x', c)
+    assert c.fileno() == -1 # beyond maxsize
+    b.close()
+    assert pool.get('x') is None # closed by the peer
+    d.close()
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_concurrent_legacy_calls(serve, engine):
+    server = serve(ThreadServer, engine=engine)
+    client = Client(address=server.address, protocol=1, pool_size=4)
+    errors = []
+    def work():
+        try:
+            for _ in range(20):
+                client.thread()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert idle_count(client, server.address) <= 4
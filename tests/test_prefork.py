@@ -0,0 +1,47 @@
+import stat
+import os
+
+from pyrpc import Client, Server
+
+from conftest import wait_for
+
+
+class PidServer(Server):
+    def pid(self):
+        return os.getpid()
+
+    def echo(self, x):
+        return x
+
+
+def test_clients_spread_over_workers(serve):
+    server = serve(PidServer, processes=2)
+    pids = set()
+    def fresh_client_pid():
+        pids.add(Client(address=server.address).pid())
+        return len(pids) == 2
+    assert wait_for(fresh_client_pid)
+    assert os.getpid() not in pids
+
+
+def test_client_calls_one_worker(serve):
+    server = serve(PidServer, processes=2)
+    client = Client(address=server.address)
+    assert len({client.pid() for _ in range(20)}) == 1
+
+
+def test_peer_sockets_private(serve):
+    server = serve(PidServer, processes=2, nonblocking=True)
+    peer_dir = os.path.dirname(server._prefork.peer_address(0))
+    assert stat.S_IMODE(os.stat(peer_dir).st_mode) == 0o700
+    assert wait_for(lambda: sorted(os.listdir(peer_dir)) == ['0', '1'])
+    server.shutdown_sync()
+    assert not os.path.exists(peer_dir)
+
+
+def test_nb_get_forwarded(serve):
+    server = serve(PidServer, processes=2, nonblocking=True)
+    # legacy clients connect for each request, their gets land on any worker
+    client = Client(address=server.address, protocol=1)
+    for i in range(10):
+        assert client.nb_echo(i, nb_fetch_wait=5) == i
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc.workers import WorkerPool
+
+from conftest import wait_for
+
+
+def run_queued(pool, jobs):
+    '''Queues jobs (name, priority, flow) behind a job holding the only
+    worker, returns the names in the order they ran.'''
+    release = threading.Event()
+    order = []
+    pool.submit(release.wait, priority='hold')
+    for name, priority, flow in jobs:
+        pool.submit(order.append, name, priority=priority, flow=flow)
+    release.set()
+    assert wait_for(lambda: len(order) == len(jobs))
+    return order
+
+
+def test_reserved():
+    pool = WorkerPool(max_workers=4, shares={'a': 1, 'b': 3})
+    classes = pool.classes()
+    assert classes['b']['reserved'] == 2
+    assert classes['a']['reserved'] == classes['default']['reserved'] == 1
+    release = threading.Event()
+    for _ in range(5):
+        pool.submit(release.wait, priority='b')
+    # b never takes the workers reserved to the others
+    assert pool.classes()['b']['running'] == 2
+    started = threading.Event()
+    pool.submit(started.set, priority='a')
+    assert started.wait(1)
+    release.set()
+    assert wait_for(lambda: pool.running == 0)
+
+
+def test_weights():
+    pool = WorkerPool(max_workers=1, shares={'hold': 1, 'a': 1, 'b': 3})
+    order = run_queued(
+        pool, [('a', 'a', None)] * 4 + [('b', 'b', None)] * 12
+    )
+    # b runs three times as often while both wait
+    assert order[:8].count('b') == 6
+
+
+def test_flows_take_turns():
+    pool = WorkerPool(max_workers=1, shares={'hold': 1})
+    order = run_queued(
+        pool, [('x', None, 'x')] * 3 + [('y', None, 'y')] * 3
+    )
+    assert order == ['x', 'y'] * 3
+
+
+class PriorityServer(Server):
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def echo(self, x):
+        return x
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_cheap_calls_not_held_up(serve, engine):
+    server = serve(
+        PriorityServer, engine=engine, max_workers=2,
+        priority_classes={'bulk': 1, 'interactive': 1},
+        method_priorities={'sleep': 'bulk', 'echo': 'bulk'},
+    )
+    client = Client(address=server.address)
+    threads = [
+        threading.Thread(target=client.sleep, args=(0.5,)) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    assert wait_for(lambda: server._workers.queued == 3)
+    start = time.time()
+    # in its own class, not in that of the method
+    assert client.echo(1, call_priority='interactive') == 1
+    assert time.time()-start < 0.3
+    for thread in threads:
+        thread.join()
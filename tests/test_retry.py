@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+from pyrpc import Client, Server, Timeout, Overloaded
+
+from conftest import wait_for
+
+
+class FlakyServer(Server):
+    runs = 0
+    failures = 0
+    delay = 0
+
+    def flaky(self):
+        self.runs += 1
+        if self.runs <= self.failures:
+            raise Overloaded('busy')
+        return self.runs
+
+    def slow(self, seconds):
+        self.runs += 1
+        time.sleep(seconds)
+        return seconds
+
+    def get(self):
+        time.sleep(self.delay)
+        return self.address
+
+
+def test_retried(serve):
+    server = serve(FlakyServer, failures=2)
+    client = Client(address=server.address, idempotent_methods=('flaky',))
+    assert client.flaky() == 3
+
+
+def test_not_idempotent_not_retried(serve):
+    server = serve(FlakyServer, failures=1)
+    client = Client(address=server.address)
+    with pytest.raises(Overloaded):
+        client.flaky()
+    assert server.runs == 1
+
+
+def test_timeout_bounds_retries(serve):
+    server = serve(FlakyServer)
+    client = Client(
+        address=server.address, idempotent_methods=('slow',), retries=2
+    )
+    start = time.monotonic()
+    with pytest.raises(Timeout):
+        client.slow(1, call_timeout=0.5)
+    assert time.monotonic()-start < 0.8
+    assert server.runs == 1
+
+
+def test_timeout_bounds_retries_co(serve):
+    server = serve(FlakyServer)
+    client = Client(
+        address=server.address, idempotent_methods=('slow',), retries=2
+    )
+    async def main():
+        start = time.monotonic()
+        with pytest.raises(Timeout):
+            await client.co_slow(1, call_timeout=0.5)
+        return time.monotonic()-start
+    assert asyncio.run(main()) < 0.8
+    assert server.runs == 1
+
+
+def test_backoff_past_deadline_not_waited(serve):
+    server = serve(FlakyServer, failures=10)
+    client = Client(
+        address=server.address, idempotent_methods=('flaky',), retries=5,
+        retry_backoff=10, retry_backoff_max=10,
+    )
+    start = time.monotonic()
+    with pytest.raises(Overloaded):
+        client.flaky(call_timeout=0.05)
+    assert time.monotonic()-start < 0.5
+
+
+def test_hedged_loser_stops_waiting(serve):
+    fast = serve(FlakyServer)
+    slow = serve(FlakyServer)
+    client = Client(
+        address=[fast.address, slow.address], idempotent_methods=('get',),
+        hedge=True,
+    )
+    for i in range(40):
+        client.get()
+    slow.delay = 1
+    for i in range(10):
+        start = time.monotonic()
+        assert client.get() == fast.address
+        assert time.monotonic()-start < 0.5
+        assert wait_for(
+            lambda: not any(client._balancer.outstanding().values()), 0.5
+        )
@@ -0,0 +1,93 @@
+import threading
+import socket
+import os
+
+import pytest
+
+from pyrpc import Client, Server
+from pyrpc import protocol
+
+BIG = protocol.OOB_THRESHOLD
+
+
+class ShmServer(Server):
+    def echo(self, x):
+        return x
+
+    def fill(self, view):
+        # mapped copy-on-write, writable on this side only
+        view[0] = ord('y')
+        return bytes(view[:2])
+
+
+def shm_fds():
+    '''The open file descriptors of shared memory files.'''
+    fds = []
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            if 'pyrpc' in os.readlink('/proc/self/fd/' + fd):
+                fds.append(fd)
+        except OSError:
+            pass
+    return fds
+
+
+@pytest.fixture
+def shm_frames(monkeypatch):
+    frames = []
+    pack_shm = protocol.pack_shm
+    def spy(*args, **kwargs):
+        frames.append(args[1])
+        return pack_shm(*args, **kwargs)
+    monkeypatch.setattr(protocol, 'pack_shm', spy)
+    return frames
+
+
+def test_frame_roundtrip():
+    a, b = socket.socketpair(socket.AF_UNIX)
+    obj = (memoryview(b'x' * BIG), [bytearray(b'y' * BIG)])
+    frame, fd = protocol.pack_shm(
+        3, protocol.REQUEST, protocol.dumps(obj)
+    )
+    def send():
+        protocol.sendall(a, frame, fd)
+        os.close(fd)
+    thread = threading.Thread(target=send)
+    thread.start()
+    id_, kind, flags, parts = protocol.read_frame(b)
+    thread.join()
+    assert flags & protocol.SHM
+    view, (array,) = protocol.loads(parts)
+    assert view == obj[0] and array == obj[1][0]
+    del view, array, parts
+    a.close()
+    b.close()
+    # the file is closed once sent and once mapped
+    assert shm_fds() == []
+
+
+def test_calls(serve, shm_frames):
+    server = serve(ShmServer, shm_threshold=BIG)
+    client = Client(address=server.address, shm_threshold=BIG)
+    obj = {'data': memoryview(b'x' * 10**6)}
+    assert client.echo(obj)['data'] == obj['data']
+    assert shm_frames == [protocol.REQUEST, protocol.RESPONSE]
+    assert client.echo(b'small') == b'small'
+    assert len(shm_frames) == 2
+    view = memoryview(bytearray(b'x' * BIG))
+    assert client.fill(view) == b'yx'
+    assert view[0] == ord('x')
+
+
+def test_client_only(serve, shm_frames):
+    server = serve(ShmServer)
+    client = Client(address=server.address, shm_threshold=BIG)
+    assert client.echo(bytearray(BIG)) == bytearray(BIG)
+    assert shm_frames == [protocol.REQUEST]
+
+
+def test_asyncio_engine(serve, shm_frames):
+    server = serve(ShmServer, engine='asyncio', shm_threshold=BIG)
+    client = Client(address=server.address, shm_threshold=BIG)
+    assert client.echo(bytearray(BIG)) == bytearray(BIG)
+    assert shm_frames == []
@@ -0,0 +1,60 @@
+import pytest
+
+from pyrpc import Client, Server
+
+from conftest import wait_for
+
+
+class StreamServer(Server):
+    def count(self, n):
+        for i in range(n):
+            yield i
+
+    def echo(self, x):
+        return x
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_items(serve, engine):
+    server = serve(StreamServer, engine=engine)
+    client = Client(address=server.address)
+    assert list(client.stream_count(100, stream_window=4)) == list(range(100))
+    assert list(client.stream_count(0)) == []
+
+
+def test_legacy_protocol(serve):
+    server = serve(StreamServer)
+    client = Client(address=server.address, protocol=1)
+    assert list(client.stream_count(5)) == list(range(5))
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_closed_early(serve, engine):
+    server = serve(StreamServer, engine=engine, max_workers=1)
+    client = Client(address=server.address)
+    items = client.stream_count(10**6, stream_window=2)
+    assert next(items) == 0
+    items.close()
+    assert wait_for(lambda: server._workers.running == 0)
+    assert client.echo(1) == 1
+
+
+def test_dropped_before_next(serve):
+    server = serve(StreamServer, max_workers=2)
+    client = Client(address=server.address)
+    for i in range(4):
+        client.stream_count(1000, stream_window=2)
+    assert client.echo(1, call_timeout=5) == 1
+    assert wait_for(lambda: server._workers.running == 0)
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_stalled_client_given_up(serve, engine):
+    server = serve(StreamServer, engine=engine, keepalive_timeout=0.3,
+                   max_workers=1)
+    client = Client(address=server.address)
+    items = client.stream_count(10**6, stream_window=1)
+    assert next(items) == 0
+    assert wait_for(lambda: server._workers.running == 0)
+    # the server may be closing the connection of the stream meanwhile
+    assert Client(address=server.address).echo(1) == 1
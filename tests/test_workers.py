@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+from pyrpc import Client, Server, Overloaded
+from pyrpc.workers import WorkerPool
+
+from conftest import wait_for
+
+
+class SlowServer(Server):
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def echo(self, x):
+        return x
+
+
+def test_pool_limits():
+    pool = WorkerPool(max_workers=1, max_queue=1)
+    release = threading.Event()
+    done = []
+    pool.submit(release.wait)
+    pool.submit(done.append, 1)
+    assert pool.running == 1 and pool.queued == 1
+    with pytest.raises(Overloaded):
+        pool.submit(done.append, 2)
+    release.set()
+    assert wait_for(lambda: done == [1] and pool.running == 0)
+    assert pool.queued == 0
+
+
+def test_pool_key_limits():
+    pool = WorkerPool(key_limits={'a': 1})
+    release = threading.Event()
+    pool.submit(release.wait, key='a')
+    with pytest.raises(Overloaded):
+        pool.submit(release.wait, key='a')
+    pool.submit(release.wait, key='b')
+    release.set()
+    assert wait_for(lambda: pool.running == 0)
+    pool.submit(release.wait, key='a')
+
+
+def test_pool_reuses_threads():
+    pool = WorkerPool()
+    idents = []
+    for _ in range(5):
+        pool.submit(lambda: idents.append(threading.get_ident()))
+        assert wait_for(lambda: pool._idle == 1)
+    assert len(set(idents)) == 1
+
+
+def in_background(func, *args):
+    thread = threading.Thread(target=func, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_overloaded(serve, engine):
+    server = serve(SlowServer, engine=engine, max_workers=1, max_queue=0)
+    client = Client(address=server.address)
+    slow = in_background(client.sleep, 0.5)
+    assert wait_for(lambda: server._workers.running == 1)
+    with pytest.raises(Overloaded):
+        client.echo(1)
+    slow.join()
+    assert client.echo(1) == 1
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_queued(serve, engine):
+    server = serve(SlowServer, engine=engine, max_workers=1, max_queue=10)
+    client = Client(address=server.address)
+    slow = in_background(client.sleep, 0.3)
+    assert wait_for(lambda: server._workers.running == 1)
+    assert client.echo(1) == 1
+    slow.join()
+
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_method_limits(serve, engine):
+    server = serve(SlowServer, engine=engine, method_limits={'sleep': 1})
+    client = Client(address=server.address)
+    slow = in_background(client.sleep, 0.5)
+    assert wait_for(lambda: server._workers.running == 1)
+    with pytest.raises(Overloaded):
+        client.sleep(0)
+    assert client.echo(1) == 1
+    slow.join()
+
+
+def test_nonblocking_overloaded(serve):
+    server = serve(
+        SlowServer, nonblocking=True, max_workers=1, max_queue=0,
+    )
+    client = Client(address=server.address)
+    slow = in_background(client.nb_sleep, 0.5)
+    assert wait_for(lambda: server._workers.running == 1)
+    with pytest.raises(Overloaded):
+        client.nb_echo(1)
+    slow.join()
+    assert client.nb_echo(1) == 1